@@ -1,4 +1,5 @@
 from .model_handler import ModelHandler
 from .rule_engine import RuleEngine
+from .model_registry import ModelRegistry, model_registry
 
-__all__ = ['ModelHandler', 'RuleEngine']
\ No newline at end of file
+__all__ = ['ModelHandler', 'RuleEngine', 'ModelRegistry', 'model_registry']
\ No newline at end of file
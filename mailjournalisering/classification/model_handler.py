@@ -1,13 +1,21 @@
 import os
+import tempfile
+import threading
+import traceback
 from .rule_engine import RuleEngine
+from .model_registry import model_registry
 from contentextraction.att_extractor import AttExtractor
-from .model import Model
 
 class ModelHandler:
 
     def __init__(self, config):
         self.config = config
         self.model = None
+        self.model_path = None
+
+        # set when the model is loaded or failed to load. TensorFlow is only imported if there is a model.
+        self.model_loaded = threading.Event()
+        self.model_error = None
 
         # load model
         if self.config["MODEL_VERSION"] and self.config["MODEL_PATH"]:
@@ -16,11 +24,15 @@ class ModelHandler:
                 home_dir = os.path.expanduser("~")
                 self.config["MODEL_PATH"] = os.path.join(home_dir, "Droids Agency", "DataScience - Documents", "modeller")
 
-            self.model = Model(os.path.join(self.config["MODEL_PATH"], self.config["MODEL_VERSION"]))
-            self.id_to_category = {id: category for category, id in self.model.category_to_id.items()}
-
-            # model warmup
-            self.model.predict('dette er en test af opstart')
+            # load model in the background, items are classified by rules while it loads
+            if "LOAD_MODEL_IN_BACKGROUND" not in self.config or self.config["LOAD_MODEL_IN_BACKGROUND"]:
+                threading.Thread(target=self._load_model, daemon=True).start()
+            else:
+                self._load_model()
+                if self.model_error is not None:
+                    raise self.model_error
+        else:
+            self.model_loaded.set()
 
         # setup rule engine
         self.rule_engine = self._load_rule_engine(config)
@@ -30,26 +42,87 @@ class ModelHandler:
         if "RECIPIENTS" in self.config and self.config["RECIPIENTS"] and self.config["USE_ATT_EXTRACTOR"]:
             self.att_extractor = AttExtractor(self.config['RECIPIENTS'])
 
+    def _load_model(self):
+        try:
+            # the model is shared with other services of the process using the same model
+            model_path = os.path.join(self.config["MODEL_PATH"], self.config["MODEL_VERSION"])
+            if "VOCABULARY_CACHE_PATH" in self.config:
+                vocabulary_cache = self.config["VOCABULARY_CACHE_PATH"]
+            else:
+                vocabulary_cache = os.path.join(tempfile.gettempdir(), "vocabulary")
+            model = model_registry.acquire(model_path, vocabulary_cache=vocabulary_cache)
+            self.id_to_category = {id: category for category, id in model.category_to_id.items()}
+
+            self.model_path = model_path
+            self.model = model
+
+        except Exception as e:
+            print(e, flush=True)
+            print(traceback.format_exc(), flush=True)
+            self.model_error = e
+
+        finally:
+            self.model_loaded.set()
+
+    def close(self):
+        """Release the model, waiting for it if it is loading"""
+        self.model_loaded.wait()
+        if self.model_path is not None:
+            model_registry.release(self.model_path)
+            self.model = None
+            self.model_path = None
+
+    def _get_model(self, wait):
+        """Return the model, or None if there is no model. If the model is still loading, wait for it if wait is True,
+        else return None."""
+        if wait:
+            self.model_loaded.wait()
+            # the model failed to load, classification with it fails
+            if self.model_error is not None:
+                raise self.model_error
+        return self.model
+
     def classify_item(self, prep_item):
         # classifier method referenced by mail checker service.
-        text = prep_item.extract_text()
+        return self.classify_items([prep_item])[0]
+
+    def classify_items(self, prep_items):
+        """Classify a list of items, with a single model call for all items. Returns a list of classifications in the
+        same format as classify_item."""
+
+        # check rules and att extractor
+        rule_results = [self.rule_engine.execute(prep_item) for prep_item in prep_items]
+        matches = [self._att_match(prep_item) for prep_item in prep_items]
+
+        # wait for the model only if it is needed, that is when no rule nor att extractor applies to an item
+        needs_model = any(not applies and not match for (applies, _, _), match in zip(rule_results, matches))
+        model = self._get_model(wait=needs_model)
+
+        if model:
+            probabilities = model.predict_batch([prep_item.extract_text() for prep_item in prep_items])
+        else:
+            probabilities = [None] * len(prep_items)
+
+        return [self._classify(prep_item, rule_result, match, p, model)
+                for prep_item, rule_result, match, p in zip(prep_items, rule_results, matches, probabilities)]
+
+    def _att_match(self, prep_item):
+        # Check if mail has "att" and we find a match in our Recipients list
+        if self.att_extractor is not None:
+            return self.att_extractor.process(prep_item.subject, prep_item.body)
+        return None
 
-        # check rules
-        applies, classification, r = self.rule_engine.execute(prep_item)
+    def _classify(self, prep_item, rule_result, match, probabilities, model):
+        """Classify item using the results of rules and att extractor and the model probabilities of the item"""
+        applies, classification, r = rule_result
 
-        if self.model:
-            probabilities = self.model.predict(text)
+        if model:
             confidence = probabilities.max()
             model_classification = self.id_to_category[probabilities.argmax()]
         else:
             model_classification = None
             confidence = -1.
 
-        # Check if mail has "att" and we find a match in our Recipients list
-        match = None
-        if self.att_extractor is not None:
-            match = self.att_extractor.process(prep_item.subject, prep_item.body)
-
         # if any rules then use this value, else proceed to classification
         if applies:
             call_type = 'rule ' + r.name
@@ -61,7 +134,7 @@ class ModelHandler:
             call_type = "att_extractor"
             info = f"{prep_item.subject}, classified as: {classification} using ATT extractor."
 
-        elif not self.model:
+        elif not model:
             classification = self.config["FALLBACK_MAIL"]
             call_type = 'no_rule_nor_att_applied'
             info = f"{prep_item.subject}, didn't trigger any rule nor ATTs."
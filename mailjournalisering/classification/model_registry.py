@@ -0,0 +1,94 @@
+import threading
+import time
+
+# text used to warm up a model after loading
+WARMUP_TEXT = 'dette er en test af opstart'
+
+
+class _Entry:
+    def __init__(self):
+        self.model = None
+        self.error = None
+        self.loaded = threading.Event()
+        self.references = 0
+        # time since no service has used the model, None while used
+        self.idle_since = None
+
+
+class ModelRegistry:
+    """Models loaded once per process and shared by all services using the same model path. The models are reference
+    counted, a model that no service uses is kept until unload_idle unloads it, so a service starting again soon after
+    gets the loaded model."""
+
+    def __init__(self):
+        # model path -> _Entry
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, model_path, vocabulary_cache=None):
+        """Return the model at model_path, loading and warming it up if it is not loaded. A successful acquire must be
+        followed by a release when the model is no longer used. See Model for vocabulary_cache."""
+        with self.lock:
+            entry = self.entries.get(model_path)
+            load = entry is None
+            if load:
+                entry = self.entries[model_path] = _Entry()
+            entry.references += 1
+            entry.idle_since = None
+
+        # the model is loaded by the first caller, the others wait for it
+        if load:
+            try:
+                # TensorFlow is imported with the first model
+                from .model import Model
+                model = Model(model_path, vocabulary_cache=vocabulary_cache)
+                model.predict(WARMUP_TEXT)
+                entry.model = model
+                print(f"Model {model_path} loaded.", flush=True)
+
+            except Exception as e:
+                entry.error = e
+                # a later acquire tries to load the model again
+                with self.lock:
+                    if self.entries.get(model_path) is entry:
+                        del self.entries[model_path]
+
+            finally:
+                entry.loaded.set()
+
+        entry.loaded.wait()
+        if entry.error is not None:
+            raise entry.error
+        return entry.model
+
+    def release(self, model_path):
+        """Release a model acquired with acquire"""
+        with self.lock:
+            entry = self.entries.get(model_path)
+            if entry is None:
+                return
+            entry.references = max(entry.references - 1, 0)
+            if entry.references == 0:
+                entry.idle_since = time.time()
+
+    def unload_idle(self, max_idle=0):
+        """Unload models that no service has used for max_idle seconds. Returns the paths of the unloaded models."""
+        now = time.time()
+        with self.lock:
+            paths = [path for path, entry in self.entries.items()
+                     if entry.idle_since is not None and now - entry.idle_since >= max_idle]
+            for path in paths:
+                del self.entries[path]
+
+        for path in paths:
+            print(f"Model {path} unloaded.", flush=True)
+        return paths
+
+    def __str__(self):
+        with self.lock:
+            models = [f"{path} ({entry.references} references)" for path, entry in self.entries.items()]
+        return f"ModelRegistry ({', '.join(models)})"
+
+
+# registry shared by all services of the process
+model_registry = ModelRegistry()
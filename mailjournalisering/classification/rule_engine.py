@@ -1,12 +1,22 @@
 import re
+from .rule_matcher import RuleMatcher
 
 class Condition:
     def _evaluate(self, item):
         pass
 
-    def __call__(self, item):
+    def _evaluate_match(self, match):
+        # evaluate on an item matched by the compiled matcher of the rule engine
+        return self._evaluate(match.item)
+
+    def simple_conditions(self):
+        return [self]
+
+    def __call__(self, item, match=None):
         """Method for evaluating rule in a safe manner"""
         try:
+            if match is not None:
+                return self._evaluate_match(match)
             return self._evaluate(item)
 
         except Exception as e:
@@ -27,10 +37,10 @@ class Rule:
         self.name = name
         self.condition = condition
 
-    def __call__(self, item):
+    def __call__(self, item, match=None):
         """Method for evaluating rule in a safe manner"""
         try:
-            if self.condition(item):
+            if self.condition(item, match):
                 return True, self.return_value
             else:
                 return False, None
@@ -50,24 +60,45 @@ class Rule:
                 attr.append(f"{a}={self.__getattribute__(a)}")
         return f"{self.__class__.__name__} ({', '.join(attr)})"
 
-class SubjectContains(Condition):
+class TokenCondition(Condition):
+    """Condition on a token in a field. With the compiled matcher the field is scanned once for the tokens of all
+    rules."""
+    field = None
+
     def __init__(self, token):
         self.token = token
 
+    def _evaluate_match(self, match):
+        return match.token_found(self.field, self.token.lower())
+
+
+class PatternCondition(Condition):
+    """Condition on a regex pattern in a field. With the compiled matcher the field is scanned for the patterns of
+    all rules together."""
+    field = None
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.regex = re.compile(pattern)
+
+    def _evaluate_match(self, match):
+        return match.pattern_found(self.field, self.pattern)
+
+
+class SubjectContains(TokenCondition):
+    field = 'subject'
+
     def _evaluate(self, item):
         return item.subject is not None and self.token.lower() in item.subject.lower()
 
-class BodyContains(Condition):
-    def __init__(self, token):
-        self.token = token
+class BodyContains(TokenCondition):
+    field = 'body'
 
     def _evaluate(self, item):
         return self.token.lower() in item.body.lower()
 
-class SubjectRegEx(Condition):
-    def __init__(self, pattern):
-        self.pattern = pattern
-        self.regex = re.compile(pattern)
+class SubjectRegEx(PatternCondition):
+    field = 'subject'
 
     # returns True if the number of matches is 1 or more
     def _evaluate(self, item):
@@ -77,26 +108,22 @@ class SubjectRegEx(Condition):
         return len(m) > 0
 
 
-class AttachmentTextContains(Condition):
-    def __init__(self, token):
-        self.token = token
+class AttachmentTextContains(TokenCondition):
+    field = 'attachments'
 
     def _evaluate(self, item):
         return any([self.token.lower() in at.lower() for at in item.attachment_texts])
 
 
-class AnyTextContains(Condition):
-    def __init__(self, token):
-        self.token = token
+class AnyTextContains(TokenCondition):
+    field = 'anytext'
 
     def _evaluate(self, item):
         return self.token.lower() in item.extract_text().lower()
 
 
-class AnyTextRegEx(Condition):
-    def __init__(self, pattern):
-        self.pattern = pattern
-        self.regex = re.compile(pattern)
+class AnyTextRegEx(PatternCondition):
+    field = 'anytext'
 
     # returns True if the number of matches is 1 or more
     def _evaluate(self, item):
@@ -104,10 +131,8 @@ class AnyTextRegEx(Condition):
         return len(m) > 0
 
 
-class AttachmentTextRegEx(Condition):
-    def __init__(self, pattern):
-        self.pattern = pattern
-        self.regex = re.compile(pattern)
+class AttachmentTextRegEx(PatternCondition):
+    field = 'attachments'
 
     # returns True if the number of matches is 1 or more
     def _evaluate(self, item):
@@ -143,11 +168,32 @@ condition_factory = {
 }
 
 
+# rules and conditions that read the text of attachments
+ATTACHMENT_TEXT_RULES = {'AttachmenttextContainsRule', 'AttachmenttextRegEx', 'AnyTextContainsRule', 'AnyTextRegEx'}
+ATTACHMENT_TEXT_CONDITIONS = {'AttachmentTextContains', 'AttachmentTextRegEx', 'AnyTextContains', 'AnyTextRegEx'}
+
+
 def parse_condition(condition):
+    # the configuration of the rule is left as it is, so rules can be built from it again
+    condition = dict(condition)
     condition_type = condition.pop("condition_type")
     return condition_factory[condition_type](**condition)
 
 
+def reads_attachment_text(rule):
+    """True if a rule, given as the arguments of RuleEngine.add_rule, has a condition on the text of attachments"""
+    if rule["rule_type"] in ['AndRule', 'OrRule']:
+        return any(rule[c]["condition_type"] in ATTACHMENT_TEXT_CONDITIONS for c in ['condition1', 'condition2'])
+    return rule["rule_type"] in ATTACHMENT_TEXT_RULES
+
+
+def needs_full_attachment_text(rules):
+    """True if a rule reads the text of attachments and does not set full_text to False. The attachment texts are
+    then extracted in full, also if MAX_ATTACHMENT_CHARS or MAX_TEXT_CHARS is set, so the rules match as without
+    these limits."""
+    return any(reads_attachment_text(rule) and ("full_text" not in rule or rule["full_text"]) for rule in rules)
+
+
 class AndCondition(Condition):
     def __init__(self, condition1: Condition, condition2: Condition):
         self.condition1 = parse_condition(condition1)
@@ -156,6 +202,12 @@ class AndCondition(Condition):
     def _evaluate(self, item):
         return self.condition1(item) and self.condition2(item)
 
+    def _evaluate_match(self, match):
+        return self.condition1(match.item, match) and self.condition2(match.item, match)
+
+    def simple_conditions(self):
+        return self.condition1.simple_conditions() + self.condition2.simple_conditions()
+
 class OrCondition(Condition):
     def __init__(self, condition1: Condition, condition2: Condition):
         self.condition1 = parse_condition(condition1)
@@ -164,6 +216,12 @@ class OrCondition(Condition):
     def _evaluate(self, item):
         return self.condition1(item) or self.condition2(item)
 
+    def _evaluate_match(self, match):
+        return self.condition1(match.item, match) or self.condition2(match.item, match)
+
+    def simple_conditions(self):
+        return self.condition1.simple_conditions() + self.condition2.simple_conditions()
+
 
 class RuleEngine:
 
@@ -188,17 +246,39 @@ class RuleEngine:
 
         self.rules = []
 
-    def add_rule(self, rule_type, **kwargs):
-        """Add rule to engine, e.g. add_rule('SubjectContainsRule', token='test', return_value='test@gmail.com')"""
+        # matcher for the token and pattern conditions of all rules, compiled on first execute after rules are added
+        self.matcher = None
+
+    def add_rule(self, rule_type, full_text=None, **kwargs):
+        """Add rule to engine, e.g. add_rule('SubjectContainsRule', token='test', return_value='test@gmail.com').
+        full_text=False allows a rule on attachment text to match against the text limited by MAX_ATTACHMENT_CHARS and
+        MAX_TEXT_CHARS, see needs_full_attachment_text. It does not change the rule."""
         if rule_type in self.rule_factory:
             self.rules.append(self.rule_factory[rule_type](**kwargs))
+            self.matcher = None
         else:
             print(f"'{rule_type}' is not an allowed rule type. Skipping.")
 
+    def compile(self):
+        """Group the token and pattern conditions of all rules per field in a RuleMatcher"""
+        tokens, patterns = {}, {}
+        for r in self.rules:
+            for c in r.condition.simple_conditions():
+                if isinstance(c, TokenCondition):
+                    tokens.setdefault(c.field, set()).add(c.token.lower())
+                elif isinstance(c, PatternCondition):
+                    patterns.setdefault(c.field, []).append(c.pattern)
+        self.matcher = RuleMatcher(tokens, patterns)
+
     def execute(self, item):
+        if self.matcher is None:
+            self.compile()
+        # fields of the item are scanned for all rules when the first rule needs them
+        match = self.matcher.match(item)
+
         # loop over rules. Returns on the first rule that is true
         for r in self.rules:
-            applies, return_value = r(item)
+            applies, return_value = r(item, match)
             if applies:
                 return applies, return_value, r
 
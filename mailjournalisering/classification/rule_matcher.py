@@ -0,0 +1,171 @@
+import re
+
+# pattern with a global inline flag like (?i), these apply to the whole combined pattern
+_GLOBAL_FLAGS = re.compile(r'\(\?[aiLmsux]+\)')
+
+
+class TokenSet:
+    """Set of tokens matched with a single scan of a text. The tokens are compiled into one regex shaped like a trie,
+    so at each position of the text only the branches of the next character are tried. The regex finds the longest
+    token at each position, the tokens that are prefixes of it are found at the same position."""
+
+    def __init__(self, tokens):
+        self.tokens = set(tokens)
+
+        # the empty token is in every text, it is not part of the regex
+        tokens = [t for t in self.tokens if t]
+        self.regex = re.compile(f"(?=({_trie_pattern(tokens)}))") if tokens else None
+
+    def scan(self, texts):
+        """Return the tokens found in any of texts"""
+        found = set()
+        for text in texts:
+            if '' in self.tokens:
+                found.add('')
+            if self.regex is None:
+                continue
+
+            for m in self.regex.finditer(text):
+                longest = m.group(1)
+                for i in range(1, len(longest) + 1):
+                    if longest[:i] in self.tokens:
+                        found.add(longest[:i])
+                if len(found) == len(self.tokens):
+                    return found
+        return found
+
+
+class PatternSet:
+    """Set of regex patterns matched with as few scans of a text as possible. Patterns without groups are combined
+    into one alternation. A search finds the first position where any of them matches and the first of those patterns.
+    The search is repeated from that position without the patterns found, until no more patterns match. Patterns with
+    groups or global inline flags can not be combined and are searched one by one."""
+
+    def __init__(self, patterns):
+        self.patterns = list(dict.fromkeys(patterns))
+        self.regexes = [re.compile(p) for p in self.patterns]
+
+        self.combinable = tuple(i for i, (p, r) in enumerate(zip(self.patterns, self.regexes))
+                                if r.groups == 0 and not _GLOBAL_FLAGS.search(p))
+        self.single = [i for i in range(len(self.patterns)) if i not in self.combinable]
+
+        # tuple of pattern indices -> combined regex
+        self.combined = {}
+
+    def scan(self, texts):
+        """Return the patterns found in any of texts"""
+        found = set()
+        for text in texts:
+            remaining = tuple(i for i in self.combinable if self.patterns[i] not in found)
+            pos = 0
+            while remaining:
+                m = self._combined(remaining).search(text, pos)
+                if m is None:
+                    break
+                i = remaining[m.lastindex - 1]
+                found.add(self.patterns[i])
+                remaining = tuple(j for j in remaining if j != i)
+                pos = m.start()
+
+            for i in self.single:
+                if self.patterns[i] not in found and self.regexes[i].search(text):
+                    found.add(self.patterns[i])
+
+            if len(found) == len(self.patterns):
+                break
+        return found
+
+    def _combined(self, indices):
+        if indices not in self.combined:
+            # only a few subsets are used, as most texts match few patterns
+            if len(self.combined) > 256:
+                self.combined.clear()
+            self.combined[indices] = re.compile('|'.join(f"({self.patterns[i]})" for i in indices))
+        return self.combined[indices]
+
+
+class RuleMatcher:
+    """Token and pattern conditions of all rules grouped per field, so each field of an item is scanned once for all
+    conditions. Fields are 'subject', 'body', 'attachments' and 'anytext'."""
+
+    def __init__(self, tokens, patterns):
+        """
+                tokens:    field -> tokens of contains conditions, lower case
+                patterns:  field -> patterns of regex conditions
+        """
+        self.tokens = {field: TokenSet(t) for field, t in tokens.items()}
+        self.patterns = {field: PatternSet(p) for field, p in patterns.items()}
+
+    def match(self, item):
+        return ItemMatch(self, item)
+
+
+class ItemMatch:
+    """Result of matching an item against a RuleMatcher. Fields are lower cased and scanned when first needed, so rules
+    that apply before a field is needed never scan it."""
+
+    def __init__(self, matcher, item):
+        self.matcher = matcher
+        self.item = item
+
+        # field -> lower cased texts of field
+        self.texts = {}
+        # field -> tokens/patterns found in field
+        self.tokens_found = {}
+        self.patterns_found = {}
+
+    def token_found(self, field, token):
+        if field not in self.tokens_found:
+            self.tokens_found[field] = self.matcher.tokens[field].scan(self._texts(field))
+        return token in self.tokens_found[field]
+
+    def pattern_found(self, field, pattern):
+        if field not in self.patterns_found:
+            self.patterns_found[field] = self.matcher.patterns[field].scan(self._texts(field))
+        return pattern in self.patterns_found[field]
+
+    def _texts(self, field):
+        if field not in self.texts and hasattr(self.item, 'lower_text'):
+            # preprocessed items keep their lower cased texts, so the model and other rule engines can reuse them
+            if field == 'subject':
+                self.texts[field] = [self.item.lower_subject()] if self.item.lower_subject() is not None else []
+            elif field == 'body':
+                self.texts[field] = [self.item.lower_body()]
+            elif field == 'attachments':
+                self.texts[field] = self.item.lower_attachment_texts()
+            elif field == 'anytext':
+                self.texts[field] = [self.item.lower_text()]
+
+        if field not in self.texts:
+            if field == 'subject':
+                self.texts[field] = [self.item.subject.lower()] if self.item.subject is not None else []
+            elif field == 'body':
+                self.texts[field] = [self.item.body.lower()]
+            elif field == 'attachments':
+                self.texts[field] = [at.lower() for at in self.item.attachment_texts]
+            elif field == 'anytext':
+                self.texts[field] = [self.item.extract_text().lower()]
+            else:
+                raise ValueError(f"Unknown field '{field}'")
+        return self.texts[field]
+
+
+def _trie_pattern(tokens):
+    """Regex matching the longest of tokens at a position, with the tokens merged on common prefixes"""
+    trie = {}
+    for token in tokens:
+        node = trie
+        for c in token:
+            node = node.setdefault(c, {})
+        # end of a token
+        node[''] = {}
+
+    def build(node):
+        branches = [re.escape(c) + build(child) for c, child in sorted(node.items()) if c]
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+        # a token ends here, the longer tokens are optional
+        return f"(?:{pattern})?" if '' in node else pattern
+
+    return build(trie)
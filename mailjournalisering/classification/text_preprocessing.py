@@ -0,0 +1,67 @@
+import re
+import string
+
+# patterns are compiled once, at import
+TAG = re.compile(r"<.*?>")
+BRACKETS = re.compile(r"\[.*?\]")
+MAIL = re.compile(r"[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+")
+NUMBER = re.compile(r"[0-9]+")
+TOKEN = re.compile(r"\w+|\S+")
+WHITESPACE = re.compile(r"\s")
+
+PUNCTUATION = str.maketrans(string.punctuation, ' ' * len(string.punctuation))
+
+# max number of tokens used by the model
+MAX_TOKENS = 1000
+
+
+def _mask_number(m):
+    # numbers of 2-4 digits are masked digit by digit, longer numbers by 5 #'s and single digits are kept. This is
+    # the same as masking 5 or more digits, then 4, 3 and 2 digits.
+    n = len(m.group(0))
+    if n == 1:
+        return m.group(0)
+    return '#' * min(n, 5)
+
+
+def _preprocess_chunk(text):
+    text = BRACKETS.sub(" ", text)
+    text = MAIL.sub("EMAILTOKEN", text)
+    text = text.translate(PUNCTUATION)
+    text = NUMBER.sub(_mask_number, text)
+    return TOKEN.findall(text.lower())
+
+
+def _unclosed(text, open_char, close_char):
+    """True if the last open_char of text is not followed by a close_char, so a match could continue after text"""
+    return text.rfind(open_char) > text.rfind(close_char)
+
+
+def preprocess_text(text, max_tokens=MAX_TOKENS, chunk_size=4096):
+    """Tokens of text for the model, at most max_tokens (all if None).
+
+    The text is processed in chunks that end at white-space and stop when there are enough tokens. No pattern matches
+    white-space except tags and brackets, so a chunk is only ended where no tag or brackets are open. Then the tokens
+    are the same as if the whole text was processed at once."""
+    tokens = []
+    pos = 0
+    while pos < len(text) and (max_tokens is None or len(tokens) < max_tokens):
+        end = pos + chunk_size
+        while True:
+            # end chunk at white-space, the rest of the text is the last chunk if there is no white-space
+            m = WHITESPACE.search(text, end) if end < len(text) else None
+            end = m.start() if m is not None else len(text)
+            chunk = TAG.sub(" ", text[pos:end])
+            if end == len(text) or not (_unclosed(text[pos:end], '<', '>') or _unclosed(chunk, '[', ']')):
+                break
+            end += chunk_size
+
+        tokens.extend(_preprocess_chunk(chunk))
+        pos = end
+
+    return tokens if max_tokens is None else tokens[:max_tokens]
+
+
+def texts_to_ids(texts, word_index, max_tokens=MAX_TOKENS):
+    """Token ids of a list of texts, unknown tokens are 0"""
+    return [[word_index.get(t, 0) for t in preprocess_text(text, max_tokens=max_tokens)] for text in texts]
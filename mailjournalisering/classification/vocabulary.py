@@ -0,0 +1,102 @@
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+import zlib
+
+MAGIC = b'VOCAB001'
+
+# magic, number of slots, number of entries
+_HEADER = struct.Struct('<8sQQ')
+# offset of key, length of key in bytes and value. Keys are never empty, so length 0 marks an empty slot.
+_SLOT = struct.Struct('<IIi')
+
+
+class VocabularyTable:
+    """Read-only hash table of token -> id in a memory-mapped file, used like the word_index dict of a model. The pages
+    of the file are shared by all processes using it, instead of each process holding a dict of the vocabulary.
+
+    The file holds a table of slots with open addressing (linear probing) on the crc32 of the key, followed by the
+    utf-8 encoded keys."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.n_slots, self.n_entries = _HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a vocabulary table")
+
+    def get(self, token, default=None):
+        key = token.encode('utf-8')
+        i = zlib.crc32(key) % self.n_slots
+        while True:
+            offset, length, value = _SLOT.unpack_from(self.mm, _HEADER.size + i * _SLOT.size)
+            if length == 0:
+                return default
+            if length == len(key) and self.mm[offset:offset + length] == key:
+                return value
+            i = (i + 1) % self.n_slots
+
+    def __getitem__(self, token):
+        value = self.get(token)
+        if value is None:
+            raise KeyError(token)
+        return value
+
+    def __contains__(self, token):
+        return self.get(token) is not None
+
+    def __len__(self):
+        return self.n_entries
+
+    def close(self):
+        self.mm.close()
+
+    def __str__(self):
+        return f"VocabularyTable (path={self.path}, entries={self.n_entries})"
+
+    @staticmethod
+    def build(word_index, path):
+        """Write a table of word_index to path. The file is written to a temporary file first, so a table is never
+        read while it is written."""
+        entries = [(token.encode('utf-8'), value) for token, value in word_index.items() if token]
+
+        # at most half of the slots are used, so lookups of missing tokens are short
+        n_slots = max(2 * len(entries), 1)
+        slots = [None] * n_slots
+        keys = bytearray()
+        keys_offset = _HEADER.size + n_slots * _SLOT.size
+        for key, value in entries:
+            i = zlib.crc32(key) % n_slots
+            while slots[i] is not None:
+                i = (i + 1) % n_slots
+            slots[i] = (keys_offset + len(keys), len(key), value)
+            keys += key
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, n_slots, len(entries)))
+            for slot in slots:
+                f.write(_SLOT.pack(*slot) if slot is not None else _SLOT.pack(0, 0, 0))
+            f.write(keys)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def from_pickle(cls, pickle_path, cache_path):
+        """Open the table of a pickled word_index, building it in the directory cache_path if it is not there. The
+        table is named by the path, size and modification time of the pickle, so a changed vocabulary gets a new
+        table."""
+        pickle_path = os.path.abspath(os.fsdecode(pickle_path))
+        stat = os.stat(pickle_path)
+        name = hashlib.sha1(f"{pickle_path}:{stat.st_size}:{stat.st_mtime_ns}".encode('utf-8')).hexdigest()
+        path = os.path.join(cache_path, name + '.vocab')
+
+        if not os.path.exists(path):
+            os.makedirs(cache_path, exist_ok=True)
+            with open(pickle_path, 'rb') as fh:
+                cls.build(pickle.load(fh), path)
+
+        return cls(path)
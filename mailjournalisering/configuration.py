@@ -19,7 +19,9 @@ class ConfigurationHandler:
     "datetime": lambda x: datetime.datetime.strptime(x, "%Y-%m-%d %H:%M:%S")}
 
 
-    def __init__(self,system_config_file, environment, customer_ids):
+    def __init__(self,system_config_file, environment, customer_ids, skip_failed_customers=False):
+        """Load system configuration and configurations of customer_ids. If skip_failed_customers is True, a customer
+        whose configuration fails to load is left out of customer_config, else the exception is raised."""
 
         self.environment = environment
         self.system_config_file = system_config_file
@@ -45,28 +47,39 @@ class ConfigurationHandler:
 
 
             for cid in customer_ids:
-                self.customer_config[cid] = self.load_config(cid)
-
-                # Add the settings from SYSTEM_CONFIG to CONFIG without overwriting
-                for k, v in self.system_config.items():
-                    if k not in self.customer_config[cid]:
-                        self.customer_config[cid][k] = v
-
-                if "EXCHANGE_PW" not in self.customer_config[cid]:
-                    self.customer_config[cid]["EXCHANGE_PW"] = self.customer_config[cid][
-                        self.customer_config[cid]["EXCHANGE_PASSWORD_VAULT_KEY"]]
-
-                # setup monitoring service
-                if self.customer_config[cid]["USE_STD_MONITOR"]:
-                    self.customer_config[cid]['MONITOR'] = dataaccess.stdoutmonitor.STDOutMonitor()
-                else:
-                    self.customer_config[cid]['MONITOR'] = dataaccess.monitoring.monitor(self.customer_config[cid])
+                try:
+                    self._load_customer(cid)
+                except Exception as e:
+                    if not skip_failed_customers:
+                        raise e
+                    self.customer_config.pop(cid, None)
+                    print(f"Failed to load configuration for customer id {cid}. Skipping it.", flush=True)
+                    print(e, flush=True)
+                    print(traceback.format_exc(), flush=True)
         
         except Exception as e:
             print(e, flush=True)
             print(traceback.format_exc(), flush=True)
             raise e
 
+    def _load_customer(self, cid):
+        self.customer_config[cid] = self.load_config(cid)
+
+        # Add the settings from SYSTEM_CONFIG to CONFIG without overwriting
+        for k, v in self.system_config.items():
+            if k not in self.customer_config[cid]:
+                self.customer_config[cid][k] = v
+
+        if "EXCHANGE_PW" not in self.customer_config[cid]:
+            self.customer_config[cid]["EXCHANGE_PW"] = self.customer_config[cid][
+                self.customer_config[cid]["EXCHANGE_PASSWORD_VAULT_KEY"]]
+
+        # setup monitoring service
+        if self.customer_config[cid]["USE_STD_MONITOR"]:
+            self.customer_config[cid]['MONITOR'] = dataaccess.stdoutmonitor.STDOutMonitor()
+        else:
+            self.customer_config[cid]['MONITOR'] = dataaccess.monitoring.monitor(self.customer_config[cid])
+
     def _get_secrets(self, secret_path):
         """Add secrets from volume to dict and return it"""
         # get list of secrets
@@ -133,4 +146,5 @@ class ConfigurationHandler:
                         destinations[a] = {"method": "forward", "folderparts": "", "mailbox": a}
 
         config['DESTINATIONS'] = destinations
+        conn.close()
         return config
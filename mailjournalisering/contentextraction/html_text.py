@@ -0,0 +1,77 @@
+import html.parser
+import re
+
+# elements whose content is not text
+SKIP_ELEMENTS = {'script', 'style', 'template', 'noscript'}
+
+# elements that separate words, like Tika puts a newline after them
+BLOCK_ELEMENTS = {'address', 'article', 'aside', 'blockquote', 'br', 'caption', 'dd', 'div', 'dl', 'dt', 'fieldset',
+                  'figcaption', 'figure', 'footer', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li',
+                  'main', 'nav', 'ol', 'p', 'pre', 'section', 'table', 'tbody', 'td', 'tfoot', 'th', 'thead', 'title',
+                  'tr', 'ul'}
+
+_CHARSET = re.compile(rb"<meta[^>]*charset=[\"']?([0-9a-z_\-]+)", flags=re.IGNORECASE)
+_WHITESPACE = re.compile(r'\s+')
+
+
+class _TextExtractor(html.parser.HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        # depth of elements without text
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_ELEMENTS:
+            self.skip += 1
+        elif tag in BLOCK_ELEMENTS:
+            self.parts.append(' ')
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in BLOCK_ELEMENTS:
+            self.parts.append(' ')
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_ELEMENTS:
+            self.skip = max(self.skip - 1, 0)
+        elif tag in BLOCK_ELEMENTS:
+            self.parts.append(' ')
+
+    def handle_data(self, data):
+        if self.skip == 0:
+            self.parts.append(data)
+
+
+def decode(content):
+    """Decode bytes with the charset of the <meta> tag, or utf-8 if there is none"""
+    m = _CHARSET.search(content[:4096])
+    if m is not None:
+        try:
+            return content.decode(m.group(1).decode('ascii'), errors='replace')
+        except LookupError:
+            # unknown charset
+            pass
+    return content.decode('utf-8', errors='replace')
+
+
+def html_to_text(content, chunk_size=64 * 1024):
+    """Extract the text of an html document (str or bytes). White-space is replaced by a single white-space, like the
+    text extracted by Tika in PreprocessedItem. Returns a single white-space if there is no text."""
+    if isinstance(content, bytes):
+        content = decode(content)
+
+    extractor = _TextExtractor()
+    for i in range(0, len(content), chunk_size):
+        extractor.feed(content[i:i + chunk_size])
+    extractor.close()
+
+    text = _WHITESPACE.sub(' ', ''.join(extractor.parts)).strip()
+    return text if text else " "
+
+
+def plain_text(content):
+    """Replace white-space of a plain text by a single white-space, like html_to_text"""
+    if isinstance(content, bytes):
+        content = content.decode('utf-8', errors='replace')
+    text = _WHITESPACE.sub(' ', content).strip()
+    return text if text else " "
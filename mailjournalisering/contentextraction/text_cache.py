@@ -0,0 +1,127 @@
+import collections
+import hashlib
+import os
+import threading
+
+
+class TextCache:
+    """Bounded on-disk cache of extracted texts keyed by a hash of the file content. Least recently used texts are
+    evicted when the cache holds more than max_entries texts or more than max_bytes in total."""
+
+    def __init__(self, path, max_bytes=512 * 1024 * 1024, max_entries=100000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+
+        # key -> size of cached file, least recently used first
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+
+        os.makedirs(self.path, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def key(content):
+        """Key of file content (bytes or str)"""
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        key_hash = TextCache.key_hash()
+        key_hash.update(content)
+        return key_hash.hexdigest()
+
+    @staticmethod
+    def key_hash():
+        """Hash for computing the key of content in chunks. The key is the hexdigest() of the hash."""
+        return hashlib.sha256()
+
+    def get(self, key):
+        """Return cached text for key or None if it is not in the cache"""
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            try:
+                with open(self._file(key), 'r', encoding='utf-8') as f:
+                    text = f.read()
+            except OSError:
+                # file was removed behind our back, treat as a miss
+                self._remove(key)
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+
+            # the modification time keeps the lru order when the index is loaded again
+            try:
+                os.utime(self._file(key))
+            except OSError:
+                pass
+
+            return text
+
+    def put(self, key, text):
+        """Add text to the cache and evict least recently used texts if the cache is full"""
+        data = text.encode('utf-8')
+        if len(data) > self.max_bytes:
+            return
+
+        with self.lock:
+            # write to temporary file first, so other processes never read a partial file
+            tmp_file = f"{self._file(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_file, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_file, self._file(key))
+            except OSError as e:
+                print(f"Failed to write {key} to text cache: {e}", flush=True)
+                return
+
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)
+            self.entries[key] = len(data)
+            self.total_bytes += len(data)
+
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.
+
+    def __str__(self):
+        return f"TextCache (path={self.path}, entries={len(self.entries)}, bytes={self.total_bytes}, " \
+               f"hits={self.hits}, misses={self.misses})"
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.txt')
+
+    def _remove(self, key):
+        self.total_bytes -= self.entries.pop(key)
+        try:
+            os.remove(self._file(key))
+        except OSError:
+            pass
+
+    def _load_index(self):
+        """Build index from the files in the cache directory, oldest first"""
+        files = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.txt'):
+                continue
+            stat = os.stat(os.path.join(self.path, name))
+            files.append((stat.st_mtime, name[:-len('.txt')], stat.st_size))
+
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.total_bytes += size
+
+        # the cache may have been created with larger limits
+        while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
@@ -0,0 +1,228 @@
+import itertools
+import threading
+import time
+import requests
+
+
+class TikaUnavailableError(Exception):
+    """Raised when no Tika endpoint could handle a request"""
+    pass
+
+
+class TikaEndpoint:
+    """A Tika server with its own pool of keep-alive connections and a circuit breaker. After failure_threshold
+    failures in a row the circuit opens and the endpoint is not used for reset_timeout seconds. Then a health check
+    decides if it is used again."""
+
+    def __init__(self, url, pool_size=10, failure_threshold=3, reset_timeout=30):
+        self.url = url.rstrip('/')
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # number of requests in progress
+        self.outstanding = 0
+        self.failures = 0
+        # time when an open circuit may be closed again, None if the circuit is closed
+        self.open_until = None
+
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def is_open(self):
+        return self.open_until is not None
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.open_until = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.open_until is None:
+                    print(f"Tika endpoint {self.url} is not responding. Not using it for {self.reset_timeout} seconds.",
+                          flush=True)
+                self.open_until = time.time() + self.reset_timeout
+
+    def health_check_due(self):
+        """Return True if the circuit is open and the reset timeout has passed. Only one caller gets True, the
+        others wait for its health check."""
+        with self.lock:
+            if self.open_until is None or time.time() < self.open_until:
+                return False
+            self.open_until = time.time() + self.reset_timeout
+            return True
+
+    def health_check(self, timeout):
+        """Return True if the server responds, and close the circuit if it does"""
+        try:
+            response = self.session.get(f"{self.url}/tika", timeout=timeout)
+            healthy = response.status_code == 200
+        except requests.RequestException:
+            healthy = False
+
+        if healthy:
+            print(f"Tika endpoint {self.url} is responding again.", flush=True)
+            self.success()
+        else:
+            with self.lock:
+                self.open_until = time.time() + self.reset_timeout
+        return healthy
+
+    def __str__(self):
+        return f"TikaEndpoint (url={self.url}, outstanding={self.outstanding}, requests={self.requests}, " \
+               f"open={self.is_open()})"
+
+
+class TikaClient:
+    """Client for one or more Tika servers. Requests are routed to the endpoints round-robin (routing='round_robin') or
+    to the endpoint with the fewest requests in progress (routing='least_outstanding'). Endpoints that stop responding
+    are skipped until a health check succeeds. A failed request is tried again on the next endpoint.
+
+    from_buffer returns the same dict as tika.parser.from_buffer, so it can replace it."""
+
+    def __init__(self, endpoints, routing='round_robin', timeout=60, connect_timeout=5, pool_size=10,
+                 failure_threshold=3, reset_timeout=30):
+        """
+                endpoints:          list of urls of Tika servers, e.g. ['http://localhost:9998']
+                routing:            'round_robin' or 'least_outstanding'
+                timeout:            seconds to wait for Tika to parse a document
+                connect_timeout:    seconds to wait for a connection, and for a health check
+                pool_size:          max number of kept-alive connections per endpoint
+                failure_threshold:  failures in a row before an endpoint is skipped
+                reset_timeout:      seconds before a skipped endpoint is checked again
+        """
+        if routing not in ['round_robin', 'least_outstanding']:
+            raise ValueError(f"Routing must be in ['round_robin', 'least_outstanding'], not '{routing}'")
+        if len(endpoints) == 0:
+            raise ValueError("At least one Tika endpoint is required")
+
+        self.endpoints = [TikaEndpoint(url, pool_size=pool_size, failure_threshold=failure_threshold,
+                                       reset_timeout=reset_timeout) for url in endpoints]
+        self.routing = routing
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def from_buffer(self, content, headers=None):
+        """Extract text and metadata from content (bytes, str or file-like object). Returns a dict with 'status',
+        'content' and 'metadata' like tika.parser.from_buffer. A document that Tika does not parse within the timeout
+        raises requests.ReadTimeout."""
+        request_headers = {'Accept': 'application/json'}
+        if headers is not None:
+            request_headers.update(headers)
+
+        # requests sends a str body as latin-1, Tika expects utf-8 like tika.parser sends it
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+
+        # a file-like object can only be sent again if it can be rewound
+        retry = isinstance(content, bytes) or hasattr(content, 'seek')
+        attempts = len(self.endpoints) if retry else 1
+
+        tried = []
+        last_error = None
+        for _ in range(attempts):
+            endpoint = self._choose(tried)
+            if endpoint is None:
+                break
+            tried.append(endpoint)
+
+            if hasattr(content, 'seek') and len(tried) > 1:
+                content.seek(0)
+
+            try:
+                response = self._put(endpoint, '/rmeta/text', content, request_headers)
+            except requests.ReadTimeout:
+                # the document is too slow to parse, it would be just as slow on the other endpoints. The timeout
+                # counts as a failure of the endpoint, so an endpoint that hangs is skipped.
+                raise
+            except requests.RequestException as e:
+                print(f"Tika request to {endpoint.url} failed. Error: {e}", flush=True)
+                last_error = e
+                continue
+
+            return _parse(response)
+
+        raise TikaUnavailableError(f"No Tika endpoint could handle the request. Last error: {last_error}")
+
+    def _put(self, endpoint, path, content, headers):
+        with endpoint.lock:
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+        try:
+            response = endpoint.session.put(endpoint.url + path, data=content, headers=headers,
+                                            timeout=(self.connect_timeout, self.timeout))
+            # server errors count as failures of the endpoint, client errors are caused by the document
+            if response.status_code >= 500:
+                raise requests.HTTPError(f"{response.status_code} Server Error", response=response)
+            endpoint.success()
+            return response
+
+        except requests.RequestException:
+            endpoint.failure()
+            raise
+
+        finally:
+            with endpoint.lock:
+                endpoint.outstanding -= 1
+
+    def _choose(self, tried):
+        """Choose endpoint for the next request, None if there are no endpoints left to try"""
+        candidates = [e for e in self.endpoints if e not in tried]
+
+        # endpoints with an open circuit are health checked when their reset timeout has passed
+        available = []
+        for e in candidates:
+            if not e.is_open():
+                available.append(e)
+            elif e.health_check_due() and e.health_check(self.connect_timeout):
+                available.append(e)
+        if not available:
+            return None
+
+        if self.routing == 'least_outstanding':
+            return min(available, key=lambda e: e.outstanding)
+
+        with self.lock:
+            i = next(self.counter)
+        return available[i % len(available)]
+
+    def __str__(self):
+        return f"TikaClient (routing={self.routing}, endpoints=[{', '.join(str(e) for e in self.endpoints)}])"
+
+
+def _parse(response):
+    """Parse response of /rmeta/text like tika.parser does"""
+    parsed = {'status': response.status_code, 'content': None, 'metadata': None}
+    if not response.text:
+        return parsed
+
+    documents = response.json()
+
+    # the content of embedded documents is added to the content of the document
+    content = "".join(d['X-TIKA:content'] for d in documents if d.get('X-TIKA:content') is not None)
+    parsed['content'] = content if content != "" else None
+
+    # metadata of all documents, values of a key found in more documents are put in a list
+    parsed['metadata'] = {}
+    for d in documents:
+        for k, v in d.items():
+            if k == 'X-TIKA:content':
+                continue
+            if k in parsed['metadata']:
+                if not isinstance(parsed['metadata'][k], list):
+                    parsed['metadata'][k] = [parsed['metadata'][k]]
+                parsed['metadata'][k].append(v)
+            else:
+                parsed['metadata'][k] = v
+
+    return parsed
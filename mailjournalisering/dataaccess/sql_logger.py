@@ -2,6 +2,8 @@ import pyodbc
 from datetime import datetime
 import random
 import time
+import threading
+import functools
 
 class TranslationLookup:
     """Translation lookup table for use with str.translate. All utf-8 characters with more than 2 bytes are replaced with a replacement char (default=' ')."""
@@ -21,9 +23,20 @@ class TranslationLookup:
             return self.replacementord
 
 
+def synchronized(method):
+    """Decorator for SQLLogger methods using the connection. A pyodbc connection must not be used by several threads
+    at the same time."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class SQLLogger:
 
-    def __init__(self, server = 'tcp:maildroiddev.database.windows.net', port = 1433, database = 'MailDroidDev', table="", username="", password=""):
+    def __init__(self, server = 'tcp:maildroiddev.database.windows.net', port = 1433, database = 'MailDroidDev', table="", username="", password="",
+                 buffer_size=100, flush_interval=30):
 
         # get drivers and select the last one with highest number
         all_drivers = [item for item in pyodbc.drivers() if 'ODBC Driver' in item]
@@ -36,6 +49,18 @@ class SQLLogger:
         self.conn = None
         self.cursor = None
 
+        # lock for using the connection from several threads
+        self.lock = threading.RLock()
+
+        # rows queued with queue_entry are inserted when there are buffer_size rows or the oldest row is
+        # flush_interval seconds old
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.buffer_time = None
+        # flushes the queued rows flush_interval seconds after the first is queued, also if no more rows are queued
+        self.flush_timer = None
+
         # connection string (copied from Azure and modified)
         self.connection_str = f"Driver={{{driver}}};Server={server},{port};Database={database};Uid={{{username}}};Pwd={{{password}}};Encrypt=yes;TrustServerCertificate=no;Connection Timeout=30;"
         
@@ -63,6 +88,19 @@ class SQLLogger:
             self.column_properties[row.name] = {'data_type': row.data_type, 'max_length': row.max_length,
                                                 'is_nullable': row.is_nullable}
 
+    def _column_type(self, name):
+        """SQL type of a character column in the auditlog, e.g. 'varchar(500)'"""
+        properties = self.column_properties[name]
+        max_length = properties['max_length']
+        if max_length == -1:
+            length = 'max'
+        elif properties['data_type'] in ['nvarchar', 'nchar']:
+            # max_length is in bytes, two per character
+            length = max_length // 2
+        else:
+            length = max_length
+        return f"{properties['data_type']}({length})"
+
     def connect(self, retry=10):
         # open connection to database server and setup cursor. Implements exponential backoff.
         print(f"Open connection to auditlog table '{self.table}' in database '{self.database}' on server '{self.server}'")
@@ -94,6 +132,7 @@ class SQLLogger:
         return True
 
 
+    @synchronized
     def alive(self):
         # dummy method for testing connection and reconnecting if lost
         try:
@@ -129,6 +168,7 @@ class SQLLogger:
 
         return vals
 
+    @synchronized
     def log_entry(self, message_id: str, t_in: datetime, t_out: datetime, t_email: datetime, sender: str, clas,
                   conf: float, call_type: str, text: str, sorting_threshold: float, sorting_threshold_type: str,
                   model_classification: str, customer_id: int, modelversion: str):
@@ -156,6 +196,89 @@ class SQLLogger:
         # commit changes
         self.conn.commit()
 
+    @synchronized
+    def queue_entry(self, message_id: str, t_in: datetime, t_out: datetime, t_email: datetime, sender: str, clas,
+                    conf: float, call_type: str, text: str, sorting_threshold: float, sorting_threshold_type: str,
+                    model_classification: str, customer_id: int, modelversion: str):
+        """Queue an entry for insertion with flush. Same arguments as log_entry. The queued entries are flushed when
+        the buffer is full or the oldest entry is flush_interval seconds old, by a timer if no entry is queued then."""
+        clas_list = clas if isinstance(clas, list) else [clas]
+        for c in clas_list:
+            # preprocess values to ensure they match the database. The output tuple 'vals' must match self.insert_str
+            vals = self.preprocessvalues(message_id, t_in, t_out, t_email, sender, c, conf, call_type, text,
+                                         sorting_threshold, sorting_threshold_type, model_classification, customer_id,
+                                         modelversion)
+            self.buffer.append(vals)
+
+        if self.buffer_time is None:
+            self.buffer_time = time.time()
+
+        if len(self.buffer) >= self.buffer_size or time.time() - self.buffer_time >= self.flush_interval:
+            self.flush()
+        elif self.flush_timer is None:
+            self._start_flush_timer(self.flush_interval)
+
+    def _start_flush_timer(self, delay):
+        self.flush_timer = threading.Timer(delay, self._flush_if_due)
+        self.flush_timer.daemon = True
+        self.flush_timer.start()
+
+    @synchronized
+    def _flush_if_due(self):
+        """Called by the flush timer. Flush if the oldest entry is flush_interval seconds old, else wait for it."""
+        self.flush_timer = None
+        if not self.buffer:
+            return
+        age = time.time() - self.buffer_time
+        if age < self.flush_interval:
+            # the entries that were due have been flushed, wait for the entries queued since then
+            self._start_flush_timer(self.flush_interval - age)
+            return
+        try:
+            self.flush()
+        except Exception as e:
+            # the entries stay queued, try again later
+            print(f"Flushing auditlog failed. Error: {e}", flush=True)
+            self._start_flush_timer(self.flush_interval)
+
+    @synchronized
+    def flush(self):
+        """Insert all queued entries in a single transaction"""
+        if not self.buffer:
+            return
+
+        try:
+            self._insert_many(self.buffer)
+        except:
+            print(f"Failed at inserting {len(self.buffer)} entries")
+            # something failed. Wait a few seconds to try to get a decent close of connection, reconnect and execute again
+            time.sleep(30)
+            self.connect()
+            self._insert_many(self.buffer)
+
+        # commit changes
+        self.conn.commit()
+
+        self.buffer = []
+        self.buffer_time = None
+
+    def _insert_many(self, rows):
+        self._insert_many_into(self.insert_str, rows)
+
+    def _insert_many_into(self, insert_str, rows):
+        # send all rows in one round trip, fast_executemany is specific to pyodbc. The cursor is shared by the other
+        # statements, so the setting is restored after the insert
+        if not hasattr(self.cursor, 'fast_executemany'):
+            self.cursor.executemany(insert_str, rows)
+            return
+        fast_executemany = self.cursor.fast_executemany
+        self.cursor.fast_executemany = True
+        try:
+            self.cursor.executemany(insert_str, rows)
+        finally:
+            self.cursor.fast_executemany = fast_executemany
+
+    @synchronized
     def get_processed_ids(self, customer_id, limit=500):
         """Get item ids of alrady processed messages in the auditlog. Limit by default to 500. First item is the oldest"""
         
@@ -179,6 +302,31 @@ class SQLLogger:
 
         return ids
 
+    @synchronized
+    def get_processed_items(self, customer_id, since, limit=100000):
+        """Get (message_id, timestamp_email) of processed messages in the auditlog with timestamp_email after since.
+        Limit by default to 100000. First item is the oldest"""
+
+        id_str = "SELECT TOP (?) message_id,timestamp_email FROM auditlog where customerID=? and timestamp_email>? ORDER BY timestamp_email DESC"
+        params = (limit, customer_id, since)
+
+        try:
+            # execute query
+            self.cursor.execute(id_str, params)
+        except:
+            # something failed. Wait a few seconds to try to get a decent close of connection, reconnect and execute again
+            time.sleep(30)
+            self.connect()
+            self.cursor.execute(id_str, params)
+
+        # stream rows from the cursor instead of fetching all rows at once
+        items = [(row.message_id, row.timestamp_email) for row in self.cursor]
+        # flip left-right
+        items = items[::-1]
+
+        return items
+
+    @synchronized
     def contains_id(self, message_id, customer_id):
         """Query database if id exist there"""
         
@@ -208,6 +356,7 @@ class SQLLogger:
         return count > 0
 
 
+    @synchronized
     def contains_item(self, item, customer_id):
         """Query database if item exist there"""
         
@@ -228,3 +377,45 @@ class SQLLogger:
         count = self.cursor.fetchone()[0]
 
         return count > 0
+
+    @synchronized
+    def contains_items(self, items, customer_id):
+        """Query database for which of the items exist there, using a single set-based query. Returns a list of
+        booleans in the order of items."""
+
+        if len(items) == 0:
+            return []
+
+        # candidates are inserted into a temporary table and joined with the auditlog. Unlike the ABS(DATEDIFF(...))
+        # predicate in contains_item, the range on timestamp_email can use an index. The message_id column has the type
+        # of the auditlog column and the collation of the database, as tempdb might have another collation.
+        create_str = f"CREATE TABLE #candidates (idx int NOT NULL, message_id {self._column_type('message_id')} COLLATE DATABASE_DEFAULT NOT NULL, timestamp_email datetime2(7) NOT NULL)"
+        insert_str = "INSERT INTO #candidates (idx, message_id, timestamp_email) VALUES (?, ?, ?)"
+        select_str = """SELECT DISTINCT c.idx FROM #candidates AS c
+            INNER JOIN auditlog AS a
+              ON a.customerID=? and a.message_id=c.message_id
+              and a.timestamp_email > DATEADD(millisecond, -1000, c.timestamp_email)
+              and a.timestamp_email < DATEADD(millisecond, 1000, c.timestamp_email)"""
+        rows = [(i, item.id, item.received_time) for i, item in enumerate(items)]
+
+        def query():
+            self.cursor.execute("IF OBJECT_ID('tempdb..#candidates') IS NOT NULL DROP TABLE #candidates")
+            self.cursor.execute(create_str)
+            self._insert_many_into(insert_str, rows)
+            self.cursor.execute(select_str, customer_id)
+            found = {row[0] for row in self.cursor.fetchall()}
+            self.cursor.execute("DROP TABLE #candidates")
+            return found
+
+        try:
+            found = query()
+        except:
+            # something failed. Wait a few seconds to try to get a decent close of connection, reconnect and execute again
+            time.sleep(30)
+            self.connect()
+            found = query()
+
+        # end transaction
+        self.conn.commit()
+
+        return [i in found for i in range(len(items))]
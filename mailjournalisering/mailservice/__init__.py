@@ -1,5 +1,6 @@
 from .preprocessed_item import PreprocessedItem
 from .mailservices import MailCheckService
 from .mail_distributor import MailDistributor
+from .host import MailCheckHost
 
-__all__ = ['PreprocessedItem', 'MailCheckService', 'MailDistributor']
\ No newline at end of file
+__all__ = ['PreprocessedItem', 'MailCheckService', 'MailDistributor', 'MailCheckHost']
\ No newline at end of file
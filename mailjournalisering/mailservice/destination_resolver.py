@@ -0,0 +1,151 @@
+import concurrent.futures
+import json
+import os
+import threading
+import traceback
+import exchangelib as ews
+from exchangelib.folders import FolderId
+
+# errors of a copy or move to a folder that no longer exists, e.g. a stale folder id
+FOLDER_ERRORS = (ews.errors.ErrorToFolderNotFound, ews.errors.ErrorFolderNotFound, ews.errors.ErrorInvalidIdMalformed)
+
+
+def _folder_key(mailbox, folderparts):
+    return f"{mailbox.lower()}/{'/'.join(folderparts)}"
+
+
+class DestinationResolver:
+    """Resolves the Exchange folders of destinations. Accounts are created once per mailbox and folders are cached by
+    mailbox and path, so destinations in the same mailbox share the folder tree fetched for the first of them.
+
+    The ids of resolved folders can be persisted in a file. At the next start these folders are then referenced by id
+    without any calls to Exchange. A folder id that turns out to be stale is resolved again with refresh."""
+
+    def __init__(self, account, auto_create_folders=False, folder_map_path=None, workers=8):
+        """
+                account:              account with access to all destination accounts
+                auto_create_folders:  create folders that do not exist
+                folder_map_path:      json file with the ids of resolved folders, not persisted if None
+                workers:              max number of mailboxes resolved in parallel
+        """
+        self.account = account
+        self.auto_create_folders = auto_create_folders
+        self.folder_map_path = folder_map_path
+        self.workers = workers
+
+        # mailbox -> account and folder key -> folder
+        self.accounts = {}
+        self.folders = {}
+        self.lock = threading.Lock()
+
+        # folder key -> folder id, persisted in folder_map_path
+        self.folder_map = self._load_folder_map()
+
+    def resolve_all(self, destinations):
+        """Resolve the folders of the move and copy destinations in a list. Mailboxes are resolved in parallel, and
+        the folders of a mailbox one at a time, as they share its folder tree. Returns the folders in the order of
+        destinations, 'n/a' for forwards."""
+        mailboxes = {}
+        for i, d in enumerate(destinations):
+            if d['method'] in ['move', 'copy']:
+                mailboxes.setdefault(d['mailbox'].lower(), []).append(i)
+
+        folders = ['n/a'] * len(destinations)
+
+        def resolve_mailbox(indices):
+            for i in indices:
+                folders[i] = self.folder(destinations[i]['mailbox'], destinations[i]['folderparts'])
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(resolve_mailbox, indices) for indices in mailboxes.values()]
+            for future in futures:
+                future.result()
+
+        self._save_folder_map()
+        return folders
+
+    def folder(self, mailbox, folderparts):
+        """Return the folder at the path folderparts in mailbox, from the cache if it is resolved"""
+        key = _folder_key(mailbox, folderparts)
+        with self.lock:
+            if key in self.folders:
+                return self.folders[key]
+            folder_id = self.folder_map.get(key)
+
+        if folder_id is not None:
+            folder = FolderId(id=folder_id)
+        else:
+            folder = self._resolve_path(mailbox, folderparts)
+
+        with self.lock:
+            self.folders[key] = folder
+            self.folder_map[key] = folder.id
+        return folder
+
+    def refresh(self, mailbox, folderparts):
+        """Resolve a folder again by its path, e.g. when its id is stale"""
+        key = _folder_key(mailbox, folderparts)
+        with self.lock:
+            self.folders.pop(key, None)
+            self.folder_map.pop(key, None)
+
+        folder = self.folder(mailbox, folderparts)
+        self._save_folder_map()
+        return folder
+
+    def account_for(self, mailbox):
+        """Return the account of mailbox, created once per mailbox"""
+        with self.lock:
+            if mailbox.lower() not in self.accounts:
+                self.accounts[mailbox.lower()] = ews.Account(primary_smtp_address=mailbox, autodiscover=False,
+                                                             config=self.account.protocol.config,
+                                                             access_type=ews.DELEGATE)
+            return self.accounts[mailbox.lower()]
+
+    def _resolve_path(self, mailbox, folderparts):
+        account = self.account_for(mailbox)
+
+        if len(folderparts) == 1 and folderparts[0] == "Inbox":
+            return account.inbox
+
+        folder = account.root.tois
+        for p in folderparts:
+            try:
+                folder = folder.__truediv__(p)
+            except ews.errors.ErrorFolderNotFound:
+                if self.auto_create_folders:
+                    folder = ews.Folder(parent=folder, name=p)
+                    folder.folder_class = "IPF.Note"
+                    folder.save()
+                else:
+                    raise
+        return folder
+
+    def _load_folder_map(self):
+        if not self.folder_map_path:
+            return {}
+        try:
+            with open(self.folder_map_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            # no map or a damaged map, folders are resolved by path
+            return {}
+
+    def _save_folder_map(self):
+        if not self.folder_map_path:
+            return
+        try:
+            # folders resolved by other services using the same file are kept
+            folder_map = self._load_folder_map()
+            with self.lock:
+                folder_map.update(self.folder_map)
+
+            # write to temporary file first, so a crash never leaves a partial map
+            tmp_file = f"{self.folder_map_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(folder_map, f)
+            os.replace(tmp_file, self.folder_map_path)
+
+        except OSError as e:
+            print(f"Failed to save folder map to {self.folder_map_path}. Error: {e}", flush=True)
+            print(traceback.format_exc(), flush=True)
@@ -0,0 +1,213 @@
+import concurrent.futures
+import threading
+import time
+import traceback
+from .mailservices import MailCheckService, create_auditlog
+from classification import model_registry
+from contentextraction.text_cache import TextCache
+from contentextraction.tika_client import TikaClient
+
+
+class _Customer:
+    """Scheduling state of a customer in MailCheckHost"""
+
+    def __init__(self, customer_id, config):
+        self.customer_id = customer_id
+        self.config = config
+        self.service = None
+
+        # time of next poll, the poll in progress and number of failed polls in a row
+        self.next_poll = 0.
+        self.future = None
+        self.failures = 0
+
+
+class MailCheckHost(threading.Thread):
+    """Runs the mail checks of several customers in one process, instead of a MailCheckService thread per customer.
+
+    The polls of the customers run on a shared pool of worker threads. A customer has at most one poll in progress
+    and polls at most max_items_per_poll items, so a customer with many new items does not hold back the others. The
+    customer is then polled again after the customers that are already due. A failing customer does not stop the
+    others, it is polled again with an exponential backoff.
+
+    The customers share the Tika clients, text caches and attachment executor of equal configurations and a pool of
+    auditlog connections per database. Customers using the same model share it through the model registry.
+    """
+
+    def __init__(self, configs, workers=4, max_items_per_poll=100, audit_log_connections=2, max_backoff=900,
+                 model_idle_timeout=600):
+        """
+                configs:                dict of customer id -> configuration
+                workers:                number of threads polling customers
+                max_items_per_poll:     max number of items processed in one poll of a customer
+                audit_log_connections:  number of database connections shared by the auditlogs of the customers
+                max_backoff:            max seconds between polls of a failing customer
+                model_idle_timeout:     seconds before a model no customer uses is unloaded
+        """
+        super().__init__()
+
+        self.customers = [_Customer(customer_id, config) for customer_id, config in configs.items()]
+        self.workers = workers
+        self.max_items_per_poll = max_items_per_poll
+        self.audit_log_connections = audit_log_connections
+        self.max_backoff = max_backoff
+        self.model_idle_timeout = model_idle_timeout
+
+        # threading for gracefull shutting down
+        self.terminated_event = threading.Event()
+
+        # set when a poll is done, so the scheduler can start the next
+        self.wake_event = threading.Event()
+
+        # connection key -> auditlogs shared by the customers using them, and number of customers assigned to them.
+        # The auditlogs are created at the first poll of a customer, so a database that is down only fails its
+        # customers.
+        self.auditlogs = {}
+        self.assigned = {}
+        self.auditlog_locks = {}
+        self.lock = threading.Lock()
+
+        self.attachment_executor = None
+        self._share_resources()
+
+    def _share_resources(self):
+        """Put resources shared by the customers in their configurations, MailCheckService uses them instead of
+        creating its own"""
+        tika_clients = {}
+        text_caches = {}
+
+        for customer in self.customers:
+            config = customer.config
+
+            if "TIKA_ENDPOINTS" in config and config["TIKA_ENDPOINTS"]:
+                key = tuple(config["TIKA_ENDPOINTS"])
+                if key not in tika_clients:
+                    tika_clients[key] = TikaClient(config["TIKA_ENDPOINTS"],
+                                                   routing=config["TIKA_ROUTING"] if "TIKA_ROUTING" in config else 'round_robin',
+                                                   timeout=config["TIKA_TIMEOUT"] if "TIKA_TIMEOUT" in config else 60,
+                                                   pool_size=config["TIKA_POOL_SIZE"] if "TIKA_POOL_SIZE" in config else 10)
+                config["TIKA_CLIENT"] = tika_clients[key]
+
+            # texts are cached by hash of the content, so a cache can be shared, but a directory must only be used by
+            # one cache
+            if "TEXT_CACHE_PATH" in config and config["TEXT_CACHE_PATH"]:
+                key = config["TEXT_CACHE_PATH"]
+                if key not in text_caches:
+                    text_caches[key] = TextCache(config["TEXT_CACHE_PATH"],
+                                                 max_bytes=config["TEXT_CACHE_MAX_BYTES"] if "TEXT_CACHE_MAX_BYTES" in config else 512 * 1024 * 1024,
+                                                 max_entries=config["TEXT_CACHE_MAX_ENTRIES"] if "TEXT_CACHE_MAX_ENTRIES" in config else 100000)
+                config["TEXT_CACHE"] = text_caches[key]
+
+        # a single executor for attachments, with the largest number of workers of the customers
+        attachment_workers = [config["ATTACHMENT_WORKERS"] for config in (c.config for c in self.customers)
+                              if "ATTACHMENT_WORKERS" in config and config["ATTACHMENT_WORKERS"]]
+        if attachment_workers:
+            self.attachment_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(attachment_workers))
+            for customer in self.customers:
+                customer.config["ATTACHMENT_EXECUTOR"] = self.attachment_executor
+
+        print(f"MailCheckHost: {len(self.customers)} customers share {len(tika_clients)} Tika clients and "
+              f"{len(text_caches)} text caches.", flush=True)
+
+    def _auditlog(self, config):
+        """Auditlog of a customer. Auditlog entries hold the customer id, so customers in the same database with the
+        same auditlog settings share up to audit_log_connections auditlogs, assigned round-robin. The auditlogs are
+        created when first needed."""
+        key = (config['DATABASE_URI'], config['DATABASE_NAME'], config['AUDIT_LOG_TABLE_NAME'],
+               config['DATABASE_USER_NAME'],
+               config['AUDIT_LOG_BUFFER_SIZE'] if 'AUDIT_LOG_BUFFER_SIZE' in config else None,
+               config['AUDIT_LOG_FLUSH_INTERVAL'] if 'AUDIT_LOG_FLUSH_INTERVAL' in config else None)
+
+        # connecting to one database does not hold back the customers of the others
+        with self.lock:
+            lock = self.auditlog_locks.setdefault(key, threading.Lock())
+        with lock:
+            connections = self.auditlogs.setdefault(key, [])
+            if len(connections) < self.audit_log_connections:
+                connections.append(create_auditlog(config))
+            self.assigned[key] = self.assigned.get(key, 0) + 1
+            return connections[(self.assigned[key] - 1) % len(connections)]
+
+    def run(self):
+        """Poll the customers when they are due, until terminated"""
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+
+        while not self.terminated_event.is_set():
+            self.wake_event.clear()
+
+            # start polls of due customers, the ones that have waited the longest first
+            now = time.time()
+            for customer in sorted(self.customers, key=lambda c: c.next_poll):
+                if customer.future is None and self._due(customer, now):
+                    customer.future = executor.submit(self._poll, customer)
+                    customer.future.add_done_callback(lambda _: self.wake_event.set())
+
+            # wait until a poll is done or the next customer is due, and check notifications every second
+            idle = [c.next_poll for c in self.customers if c.future is None]
+            timeout = min(min(idle) - time.time(), 1.) if idle else 1.
+            if timeout > 0:
+                self.wake_event.wait(timeout)
+
+            for customer in self.customers:
+                if customer.future is not None and customer.future.done():
+                    customer.future = None
+
+            model_registry.unload_idle(self.model_idle_timeout)
+
+        # stop polls in progress
+        for customer in self.customers:
+            if customer.service is not None:
+                customer.service.terminated_event.set()
+        executor.shutdown(wait=True)
+
+        for customer in self.customers:
+            if customer.service is not None:
+                customer.service.teardown()
+
+        if self.attachment_executor is not None:
+            self.attachment_executor.shutdown(wait=True)
+
+        print("MailCheckHost exiting.")
+
+    def _due(self, customer, now):
+        if customer.next_poll <= now:
+            return True
+        # customers with streaming notifications are polled when new items arrive, unless they are failing
+        return customer.failures == 0 and customer.service is not None and customer.service.has_notifications()
+
+    def _poll(self, customer):
+        """Poll a customer and schedule its next poll. The service of the customer is created at its first poll."""
+        config = customer.config
+        try:
+            if customer.service is None:
+                if "AUDIT_LOG" not in config:
+                    config["AUDIT_LOG"] = self._auditlog(config)
+                service = MailCheckService(config)
+                try:
+                    service.setup()
+                except Exception:
+                    # the service is created again at the next poll, so stop the threads this one has started
+                    service.terminated_event.set()
+                    service.teardown()
+                    raise
+                if self.terminated_event.is_set():
+                    service.terminated_event.set()
+                customer.service = service
+
+            complete = customer.service.poll_once(max_items=self.max_items_per_poll)
+            customer.failures = 0
+            delay = config["SLEEP_DURATION"] if complete else 0
+
+        except Exception as e:
+            print(f"MailCheckHost: Poll of customer {customer.customer_id} failed.", flush=True)
+            print(e, flush=True)
+            print(traceback.format_exc(), flush=True)
+            try:
+                config['MONITOR'].exception('MailCheckHost: Poll failed')
+            except Exception:
+                pass
+
+            customer.failures += 1
+            delay = min(config["SLEEP_DURATION"] * 2 ** customer.failures, self.max_backoff)
+
+        customer.next_poll = time.time() + delay
@@ -1,14 +1,21 @@
 import utils
 import exchangelib as ews
 import re
+import traceback
+import concurrent.futures
+from .destination_resolver import DestinationResolver, FOLDER_ERRORS
 
 class MailDistributor():
 
-    def __init__(self, account, terminated_event, mode='stdout', destinations={}, auto_create_folders=False):
+    def __init__(self, account, terminated_event, mode='stdout', destinations={}, auto_create_folders=False,
+                 workers=4, folder_map_path=None, resolver_workers=8):
         """Maildistributor.
                 account:            account with access to all destination accounts
                 terminated_event:   sig_term event
                 mode:               log to [stdout] / run in [test]-mode / run in [production]
+                workers:            max number of copies and forwards of an item distributed concurrently
+                folder_map_path:    json file with ids of destination folders, see DestinationResolver
+                resolver_workers:   max number of mailboxes resolved in parallel
         """
 
         # account with access to all destination accounts
@@ -29,6 +36,10 @@ class MailDistributor():
         self.distribution_handler = self.distribution_factory[self.mode]
         print(self.mode)
 
+        # resolver of destination folders, folders are cached across validations of the destinations
+        self.resolver = DestinationResolver(account, auto_create_folders=auto_create_folders,
+                                            folder_map_path=folder_map_path, workers=resolver_workers)
+
         # setup destinations
         self.destinations = destinations
         self.check_destinations()
@@ -36,12 +47,24 @@ class MailDistributor():
         # sig_term event
         self.terminated_event = terminated_event
 
+        # executor for distributing an item to several destinations concurrently
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
     def check_destinations(self):
         """Read or update destinations from database and """
 
         # TODO: Perform a check of the new_destinations here before assignmet
         new_destinations = {}
 
+        # resolve the folders of all destinations in parallel, they are then taken from the cache of the resolver
+        destinations = []
+        for dest in self.destinations.values():
+            destinations.extend(dest if type(dest) is list else [dest])
+        self.resolver.resolve_all(destinations)
+
         for key, dest in self.destinations.items():
             # single destination
             if type(dest) is dict:
@@ -57,12 +80,12 @@ class MailDistributor():
                 destlist = []
                 for d in dest:
                     # perform check here - simple email check for now
-                    valid, folder = self._validate_destination(dest)
+                    valid, folder = self._validate_destination(d)
                     if not valid:
                         raise ValueError(f"For key: [{key}]  destination {d} is not valid.")
                     d['exchange_folder'] = folder
                     destlist.append(d)
-                new_destinations[key] = dest
+                new_destinations[key] = destlist
 
         # check for valid fallback key in destinations
         if 'fallback' not in new_destinations.keys():
@@ -78,11 +101,11 @@ class MailDistributor():
 
     def _move_item(self, item, folder):
         """Move item to folder"""
-        utils.run_function_with_retry(self.account.bulk_move, [item], folder, event=self.terminated_event)
+        _raise_error(utils.run_function_with_retry(self.account.bulk_move, [item], folder, event=self.terminated_event))
 
     def _copy_item(self, item, folder):
         """Copy item to folder"""
-        utils.run_function_with_retry(self.account.bulk_copy, [item], folder, event=self.terminated_event)
+        _raise_error(utils.run_function_with_retry(self.account.bulk_copy, [item], folder, event=self.terminated_event))
 
     def _forward_item(self, item, smtp_address, comment=""):
         """Forward item to email address"""
@@ -129,14 +152,18 @@ class MailDistributor():
     def _distribute_production(self, item, destination):
         """Distribute item when mode is 'production'"""
 
-        if destination['method'] == 'move':
-            self._move_item(item, destination['exchange_folder'])
-        elif destination['method'] == 'copy':
-            self._copy_item(item, destination['exchange_folder'])
-        elif destination['method'] == 'forward':
-            self._forward_item(item, destination['mailbox'])
-        else:
-            raise ValueError("destination['method'] must be move, copy or forward.")
+        try:
+            if destination['method'] == 'move':
+                self._move_item(item, destination['exchange_folder'])
+            elif destination['method'] == 'copy':
+                self._copy_item(item, destination['exchange_folder'])
+            elif destination['method'] == 'forward':
+                self._forward_item(item, destination['mailbox'])
+            else:
+                raise ValueError("destination['method'] must be move, copy or forward.")
+        except FOLDER_ERRORS:
+            self._refresh_folder(destination)
+            raise
 
         return True
 
@@ -158,16 +185,151 @@ class MailDistributor():
         return success
 
     def distribute_to_many(self, item, destination_keys):
+        """Distribute item to several destinations, return True if it succeeded for all. Copies and forwards are
+        distributed concurrently, then the item is moved if a destination is a move and the others succeeded."""
+        destinations = self._resolve_destinations(destination_keys)
+
+        # copies and forwards leave the item in the source folder, so they can run in any order. The move is last, as
+        # the item is gone from the source folder afterwards.
+        futures = [self.executor.submit(self.distribute, item, None, d) for d in destinations
+                   if d["method"] != "move"]
+        concurrent.futures.wait(futures)
+        # raises the exception of a failed distribution
+        success = all([future.result() for future in futures])
+
+        moves = [d for d in destinations if d["method"] == "move"]
+        if success and moves:
+            success = self.distribute(item, dest=moves[0])
+        return success
+
+    def _resolve_destinations(self, destination_keys):
+        """Destinations of a destination key or list of keys. Unknown keys go to the fallback, and a destination
+        listed under several keys is only returned once."""
+        if not isinstance(destination_keys, list):
+            destination_keys = [destination_keys]
         destinations = [self.destinations['fallback'] if destination_key not in self.destinations else
                         self.destinations[destination_key] for destination_key in destination_keys]
-        sorting_func = lambda x: 0 if x["method"] == "copy" else 1 if x["method"] == "forward" else 2
-        destinations = sorted(destinations, key=sorting_func)
+
+        unique_destinations = {}
+        for d in destinations:
+            unique_destinations.setdefault(_destination_key(d), d)
+        destinations = list(unique_destinations.values())
 
         if sum([d["method"] == "move" for d in destinations]) > 1:
             print("Can't move to multiple mailboxes. Distributing to manuel")
-            return self.distribute(item, destination_key="fallback")
+            return [self.destinations['fallback']]
+        return destinations
+
+    def distribute_batch(self, items_and_keys):
+        """Distribute a list of (item, destination key or list of keys). Returns a list with True for the items that
+        were distributed to all their destinations and False for the others.
+
+        Items copied or moved to the same folder are distributed with a single bulk call, so a batch costs a call per
+        folder instead of a call per item. First all copies and forwards are done, then the items whose copies and
+        forwards succeeded are moved. The calls for different folders run concurrently."""
+        if self.mode == 'stdout':
+            return [self.distribute(item, destination_key=keys) if not isinstance(keys, list) else
+                    self.distribute_to_many(item, keys) for item, keys in items_and_keys]
+
+        success = [True] * len(items_and_keys)
+
+        # destination key -> (destination, indices of items). In test_copy mode all destinations are copies.
+        copies = {}
+        moves = {}
+        forwards = []
+        for i, (item, keys) in enumerate(items_and_keys):
+            for d in self._resolve_destinations(keys):
+                method = 'copy' if self.mode == 'test_copy' else d['method']
+                if method == 'forward':
+                    forwards.append((i, d))
+                elif method in ['copy', 'move']:
+                    group = copies if method == 'copy' else moves
+                    group.setdefault(_destination_key(d), (d, []))[1].append(i)
+                else:
+                    raise ValueError("destination['method'] must be move, copy or forward.")
+
+        def run(calls):
+            # calls are (indices of items, function, args), items of a failed call are not distributed
+            futures = [(indices, self.executor.submit(function, *args)) for indices, function, args in calls]
+            for indices, future in futures:
+                try:
+                    item_success = future.result()
+                except Exception as e:
+                    print(f"Distribution of {len(indices)} items failed. Error: {e}", flush=True)
+                    print(traceback.format_exc(), flush=True)
+                    item_success = [False] * len(indices)
+                for i, s in zip(indices, item_success):
+                    success[i] = success[i] and s
+
+        items = [item for item, _ in items_and_keys]
+        run([(indices, self._bulk, (self.account.bulk_copy, [items[i] for i in indices], d))
+             for d, indices in copies.values()] +
+            [([i], self._forward, (items[i], d)) for i, d in forwards])
+
+        # move only the items that are still to be distributed to all other destinations
+        calls = []
+        for d, indices in moves.values():
+            indices = [i for i in indices if success[i]]
+            if indices:
+                calls.append((indices, self._bulk, (self.account.bulk_move, [items[i] for i in indices], d)))
+        run(calls)
+
+        return success
 
-        return all([self.distribute(item, dest=d) for d in destinations])
+    def _bulk(self, bulk_function, items, destination):
+        """Copy or move items to the folder of destination with a single call. Returns the success of each item.
+
+        For a folder in another mailbox EWS only returns the errors of the failed items, so they can't be told apart in
+        a batch. There the items are copied or moved one at a time, so each item gets its own result."""
+        if len(items) > 1 and destination['mailbox'].lower() != self.account.primary_smtp_address.lower():
+            success = []
+            for item in items:
+                try:
+                    success.extend(self._bulk(bulk_function, [item], destination))
+                except Exception as e:
+                    print(f"Distribution of {item.id} failed. Error: {e}", flush=True)
+                    print(traceback.format_exc(), flush=True)
+                    success.append(False)
+            return success
+
+        print(f"Distributing {len(items)} items with {bulk_function.__name__}, to: {destination}", flush=True)
+        try:
+            results = utils.run_function_with_retry(bulk_function, items, destination['exchange_folder'],
+                                                    event=self.terminated_event)
+        except FOLDER_ERRORS:
+            self._refresh_folder(destination)
+            raise
+        # nothing is done if terminated before the call
+        if results is None:
+            return [False] * len(items)
+        if any(isinstance(result, FOLDER_ERRORS) for result in results):
+            self._refresh_folder(destination)
+        # results are in the order of the items, except for a folder in another mailbox. There nothing is returned for
+        # an item that succeeded, only the exceptions of the failed items.
+        if len(results) == len(items):
+            return [not isinstance(result, Exception) for result in results]
+        if not any(isinstance(result, Exception) for result in results):
+            return [True] * len(items)
+        print(f"{len(results)} of {len(items)} items failed with {bulk_function.__name__}, to: {destination}. "
+              f"Errors: {results}", flush=True)
+        return [False] * len(items)
+
+    def _refresh_folder(self, destination):
+        """Resolve the folder of a destination again after a copy or move to it failed, so the items are distributed
+        to the right folder when they are tried again"""
+        if destination['method'] not in ['move', 'copy']:
+            return
+        print(f"Folder of {destination} not found. Resolving it again.", flush=True)
+        try:
+            destination['exchange_folder'] = self.resolver.refresh(destination['mailbox'], destination['folderparts'])
+        except Exception as e:
+            print(f"Failed to resolve folder of {destination}. Error: {e}", flush=True)
+            print(traceback.format_exc(), flush=True)
+
+    def _forward(self, item, destination):
+        print(f"Distributing {item.id} with forward, to: {destination}", flush=True)
+        self._forward_item(item, destination['mailbox'])
+        return [True]
 
     def _validate_destinations_email(self, destinations: dict):
         # loop over emails in destination, return false if any is not valid
@@ -205,22 +367,20 @@ class MailDistributor():
         # get folder reference
         folder = 'n/a'
         if dest['method'] in ['move', 'copy']:
-            account = ews.Account(primary_smtp_address=dest['mailbox'], autodiscover=False,
-                                  config=self.account.protocol.config, access_type=ews.DELEGATE)
+            folder = self.resolver.folder(dest['mailbox'], dest['folderparts'])
 
-            if len(dest["folderparts"]) == 1 and dest["folderparts"][0] == "Inbox":
-                folder = account.inbox
-            else:
-                folder = account.root.tois
-                for p in dest['folderparts']:
-                    try:
-                        folder = folder.__truediv__(p)
-                    except ews.errors.ErrorFolderNotFound:
-                        if self.auto_create_folders:
-                            folder = ews.Folder(parent=folder, name=p)
-                            folder.folder_class = "IPF.Note"
-                            folder.save()
-                        else:
-                            raise
-
-        return valid, folder
\ No newline at end of file
+        return valid, folder
+
+
+def _raise_error(results):
+    """Raise the first exception in the results of a bulk call, which returns errors instead of raising them"""
+    for result in results or []:
+        if isinstance(result, Exception):
+            raise result
+
+
+def _destination_key(destination):
+    """Key of a destination, equal for destinations that distribute an item the same way"""
+    folderparts = destination['folderparts']
+    return (destination['method'], destination['mailbox'].lower(),
+            tuple(folderparts) if isinstance(folderparts, list) else folderparts)
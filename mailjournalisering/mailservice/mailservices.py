@@ -13,13 +13,21 @@ import os
 import time
 import threading
 from classification import ModelHandler
+from classification.rule_engine import needs_full_attachment_text
 from .preprocessed_item import PreprocessedItem
 import dataaccess
 import utils
 from pytz import timezone
 import datetime
 import collections
+import concurrent.futures
 from .mail_distributor import MailDistributor
+from .pipeline import ItemPipeline
+from .processed_cache import ProcessedItemCache
+from .sync_state import SyncStateStore
+from .notifications import StreamingNotificationListener
+from contentextraction.text_cache import TextCache
+from contentextraction.tika_client import TikaClient
 
 
 class MailCheckService(threading.Thread):
@@ -70,23 +78,71 @@ class MailCheckService(threading.Thread):
         self.source_folders = self._build_folders(self.source_account.root, config["SOURCE_FOLDERS"])
         # TODO: make it a setting in the database 
 
-        # setup auditlog
-        self.auditlog = dataaccess.SQLLogger(server=self.config['DATABASE_URI'],
-                             port=self.config['DATABASE_PORT'],
-                             database=self.config['DATABASE_NAME'],
-                             table=self.config['AUDIT_LOG_TABLE_NAME'],
-                             username=self.config['DATABASE_USER_NAME'],
-                             password=self.config['DATABASE_PASSWORD'])
+        # setup auditlog, unless it is shared with other customers, see MailCheckHost
+        if "AUDIT_LOG" in config:
+            self.auditlog = config["AUDIT_LOG"]
+        else:
+            self.auditlog = create_auditlog(self.config)
+
+        # queue auditlog entries and insert them in bulk, instead of inserting them one by one
+        if "AUDIT_LOG_BUFFER_SIZE" in config and config["AUDIT_LOG_BUFFER_SIZE"]:
+            self.log_audit_entry = self.auditlog.queue_entry
+        else:
+            self.log_audit_entry = self.auditlog.log_entry
+
+        # setup cache of texts extracted from attachments
+        if "TEXT_CACHE_PATH" in config and config["TEXT_CACHE_PATH"] and "TEXT_CACHE" not in config:
+            self.config["TEXT_CACHE"] = TextCache(config["TEXT_CACHE_PATH"],
+                                                  max_bytes=config["TEXT_CACHE_MAX_BYTES"] if "TEXT_CACHE_MAX_BYTES" in config else 512 * 1024 * 1024,
+                                                  max_entries=config["TEXT_CACHE_MAX_ENTRIES"] if "TEXT_CACHE_MAX_ENTRIES" in config else 100000)
+
+        # setup client for a pool of Tika servers, else the single server of the tika package is used
+        if "TIKA_ENDPOINTS" in config and config["TIKA_ENDPOINTS"] and "TIKA_CLIENT" not in config:
+            self.config["TIKA_CLIENT"] = TikaClient(config["TIKA_ENDPOINTS"],
+                                                    routing=config["TIKA_ROUTING"] if "TIKA_ROUTING" in config else 'round_robin',
+                                                    timeout=config["TIKA_TIMEOUT"] if "TIKA_TIMEOUT" in config else 60,
+                                                    pool_size=config["TIKA_POOL_SIZE"] if "TIKA_POOL_SIZE" in config else 10)
+
+        # MAX_ATTACHMENT_CHARS and MAX_TEXT_CHARS limit the text extracted from attachments. Rules on attachment text
+        # get the full text, so the limits do not change which items they match, unless all of them set
+        # "full_text": false in their configuration.
+        if needs_full_attachment_text(config["RULES"]):
+            self.config["FULL_ATTACHMENT_TEXT"] = True
+            if any(key in config and config[key] for key in ["MAX_ATTACHMENT_CHARS", "MAX_TEXT_CHARS"]):
+                print("Rules read the text of attachments, so it is extracted in full. MAX_ATTACHMENT_CHARS and "
+                      "MAX_TEXT_CHARS apply to attachments when the rules set \"full_text\": false.", flush=True)
+
+        # setup executor for extracting texts of attachments concurrently. It is separate from the pipeline threads,
+        # as these wait for the attachments of their item.
+        self.owns_attachment_executor = False
+        if "ATTACHMENT_WORKERS" in config and config["ATTACHMENT_WORKERS"] and "ATTACHMENT_EXECUTOR" not in config:
+            self.config["ATTACHMENT_EXECUTOR"] = concurrent.futures.ThreadPoolExecutor(max_workers=config["ATTACHMENT_WORKERS"])
+            self.owns_attachment_executor = True
+
+        # setup store of sync states for incremental sync of source folders
+        if "INCREMENTAL_SYNC" in config and config["INCREMENTAL_SYNC"]:
+            self.config["SYNC_STATE_STORE"] = SyncStateStore(config["SYNC_STATE_PATH"],
+                                                             full_scan_interval=config["FULL_SCAN_INTERVAL"] if "FULL_SCAN_INTERVAL" in config else 3600)
 
         # setup mail distributor
         self.distributor = MailDistributor(self.executor_account, self.terminated_event,
                                            mode=config["DISTRIBUTION_MODE"], destinations=config['DESTINATIONS'],
                                            auto_create_folders="AUTO_CREATE_FOLDERS" in config and
-                                                               config["AUTO_CREATE_FOLDERS"])
+                                                               config["AUTO_CREATE_FOLDERS"],
+                                           workers=config["DISTRIBUTION_WORKERS"] if "DISTRIBUTION_WORKERS" in config else 4,
+                                           folder_map_path=config["DESTINATION_FOLDER_MAP_PATH"] if "DESTINATION_FOLDER_MAP_PATH" in config else None)
 
         # init list of processed items
         self.processed_items = processed_item_handler(self.auditlog, self.config)
 
+        # model, pipeline and notification listener are created in setup
+        self.model_handler = None
+        self.pipeline = None
+        self.listener = None
+
+        # number of items of the current poll that could not be distributed
+        self.failed_items = 0
+
         # print banner
         self._print_init_banner()
 
@@ -117,122 +173,313 @@ class MailCheckService(threading.Thread):
         """Create an item generator for new item in source folders."""
         return item_generator(self.source_folders.values(), self.processed_items, self.config, self.terminated_event)
 
+    def new_full_items(self):
+        """Create a generator of (reduced preprocessed item, full item) for new items in source folders."""
+        return full_item_generator(self.source_folders.values(), self.processed_items, self.config,
+                                   self.terminated_event)
+
+    def notified_full_items(self, item_ids):
+        """Create a generator of (reduced preprocessed item, full item) for new items with the given ids."""
+        return notified_item_generator(self.source_folders.values(), item_ids, self.processed_items, self.config,
+                                       self.terminated_event)
+
     def run(self):
         """Look up new emails, classify them and distribute them accordingly."""
 
-        time_zone = timezone(self.config['TIME_ZONE'])
-
-        # The model should be created on the running thread
-        model_handler = ModelHandler(self.config)
-        classifier_service = model_handler.classify_item
+        self.setup()
 
         # TODO: add log here stating that we started processing - should each process have a process id?
         while not self.terminated_event.is_set():
-            print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} - Execute mailcheck")
-
             try:
-                # send heartbeat
-                self.config['MONITOR'].send_heartbeat()
-
-                # check for unprocessed emails
-                for prep_item in self.new_items():
-                    if self.terminated_event.is_set():
-                        print('Event is terminated')
-                        break
-
-                    t_in = datetime.datetime.now(time_zone)
-
-                    classification_successful = False
-                    try:
-                        # Clunky way of making sure that mails with error during preprocessing are being handled
-                        if isinstance(prep_item, ErrorDuringMailRetrieving):
-                            e = prep_item.error
-                            prep_item = prep_item.prep_item
-                            raise e
-
-                        print(f"[{t_in}] MailCheckService:run - Got '{prep_item.subject}' for processing.")
-                        # classify
-                        classification_dict = classifier_service(prep_item)
-
-                        if (classification_dict["conf"] and
-                            classification_dict["conf"] >= self.config["THRESHOLD"]) or \
-                                "rule" in classification_dict["call_type"] or \
-                                "att_extractor" in classification_dict["call_type"]:
-                            key = classification_dict["classification"]
-                        else:
-                            print(f'Confidence less than {self.config["THRESHOLD"]}, distribute to manual.',
-                                    flush=True)
-                            key = self.config["FALLBACK_KEY"]
-
-                        classification_successful = True
-                    
-                    except Exception as e:
-                        import traceback
-                        # classification failed, use fallback key
-                        print("................. Classification failed!")
-                        print(e)
-                        print(traceback.format_exc(), flush=True)
-                        self.config['MONITOR'].exception('MailServices:Run: Classification failed')
-                        key = self.config["FALLBACK_KEY"]
-                    
-                    finally:
-                        # distribute and mark them as processed if successfull
-
-                        if isinstance(key, list):
-                            success = self.distributor.distribute_to_many(prep_item.item, key)
-                        else:
-                            success = self.distributor.distribute(prep_item.item, key)
-
-                        t_out = datetime.datetime.now(time_zone)
-                        if success:
-                            print(f"Succesfully distributed {prep_item.item.id} to {key}.", flush=True)
-                            if classification_successful:
-                                call_type = classification_dict["call_type"]
-                                confidence = classification_dict["conf"]
-                                sorting_threshold = self.config["THRESHOLD"]
-                                sorting_threshold_type = 'default_threshold'
-                                model_classification = classification_dict["model_classification"]
-                            else:
-                                call_type = "model"
-                                confidence = 0.0
-                                sorting_threshold = 0.0
-                                sorting_threshold_type = 'Model failed prediction'
-                                model_classification = None
-
-                            # create entry in auditlog
-                            self.auditlog.log_entry(message_id=prep_item.id, t_in=t_in, t_out=t_out,
-                                               t_email=prep_item.received_time,
-                                               sender= "" if prep_item.sender is None else prep_item.sender.email_address,
-                                               clas=key,
-                                               conf=confidence,
-                                               call_type=call_type,
-                                               text=prep_item.extract_text(),
-                                               sorting_threshold=sorting_threshold,
-                                               sorting_threshold_type=sorting_threshold_type,
-                                               model_classification=model_classification,
-                                               customer_id=self.config['CUSTOMERID'],
-                                               modelversion=self.config['MODEL_VERSION'])
-
-                            # log succesful handling of email
-                            self.config['MONITOR'].email_handling_success(prep_item)
-
-                        else:
-                            self.config['MONITOR'].exception('Distribution failed!')
-                            print(50*"*")
-                            print("................. Distribution failed!")
-                            print("................. Should not be marked as processed so will be processed again later.")
-                            print(50*"*", flush=True)
-
+                self.poll_once()
             except Exception as e:
                 import traceback
                 print(e, flush=True)
                 print(traceback.format_exc(), flush=True)
                 self.config['MONITOR'].exception('MailServices:Run: Main loop failed')
 
-            self.terminated_event.wait(self.config["SLEEP_DURATION"])
+            if self.listener is not None:
+                # wake up on notifications, else send heartbeat and check if the fallback poll is due
+                self.listener.wait(self.config["SLEEP_DURATION"])
+            else:
+                self.terminated_event.wait(self.config["SLEEP_DURATION"])
+
+        self.teardown()
+
+    def setup(self):
+        """Setup model, pipeline and notification listener. Called on the thread that polls, before poll_once."""
+
+        self.time_zone = timezone(self.config['TIME_ZONE'])
+
+        # The model should be created on the running thread
+        self.model_handler = ModelHandler(self.config)
+
+        # setup pipeline for preprocessing items concurrently with classification and distribution
+        self.pipeline = None
+        if "PREPROCESSING_WORKERS" in self.config and self.config["PREPROCESSING_WORKERS"]:
+            queue_size = self.config["PIPELINE_QUEUE_SIZE"] if "PIPELINE_QUEUE_SIZE" in self.config else 16
+            batch_size = self.config["CLASSIFY_BATCH_SIZE"] if "CLASSIFY_BATCH_SIZE" in self.config else 1
+            self.pipeline = ItemPipeline(self.terminated_event, workers=self.config["PREPROCESSING_WORKERS"],
+                                         queue_size=queue_size, batch_size=batch_size,
+                                         distribute_batch_size=self._distribution_batch_size())
+
+        # setup listener for streaming notifications on new items. The source folders are then polled in full
+        # every STREAMING_FALLBACK_INTERVAL seconds, in case a notification is lost.
+        self.listener = None
+        if "USE_STREAMING_NOTIFICATIONS" in self.config and self.config["USE_STREAMING_NOTIFICATIONS"]:
+            self.listener = StreamingNotificationListener(self.source_folders.values(), self.terminated_event)
+            self.listener.start()
+        self.fallback_interval = self.config["STREAMING_FALLBACK_INTERVAL"] if "STREAMING_FALLBACK_INTERVAL" in self.config else 900
+        self.last_poll = None
+
+    def poll_once(self, max_items=None):
+        """Check for new emails once and process them. At most max_items items are processed (all if None), the rest
+        are left for the next poll. Returns False if items may have been left, else True. Exceptions are raised to the
+        caller, after queued auditlog entries have been inserted."""
+
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} - Execute mailcheck")
+
+        try:
+            # send heartbeat
+            self.config['MONITOR'].send_heartbeat()
+
+            # check for unprocessed emails, either all in source folders or the ones we got notifications on
+            full_items = None
+            if self.listener is None or self.last_poll is None or time.time() - self.last_poll >= self.fallback_interval:
+                self.last_poll = time.time()
+                full_items = self.new_full_items()
+            else:
+                item_ids = self.listener.pop_item_ids()
+                if item_ids is not None:
+                    full_items = self.notified_full_items(item_ids)
+
+            if full_items is None:
+                return True
+
+            count = [0]
+            if max_items is not None:
+                full_items = _limit_items(full_items, max_items, count)
+
+            self.failed_items = 0
+            self._process(full_items, self.pipeline, self.model_handler, self.time_zone)
+            self._save_sync_states()
+
+            if max_items is not None and count[0] >= max_items:
+                # the notified ids that were left are gone, so the next poll is a full poll
+                self.last_poll = None
+                return False
+            return True
+
+        finally:
+            # sync states of a poll that failed are not saved, the next poll syncs the items again
+            if "SYNC_STATE_STORE" in self.config:
+                self.config["SYNC_STATE_STORE"].discard()
+
+            # insert queued auditlog entries, so the items are seen as processed in the next mail check
+            self._flush_auditlog()
+
+            if "TEXT_CACHE" in self.config:
+                print(f"  {self.config['TEXT_CACHE']}, hit rate {round(self.config['TEXT_CACHE'].hit_rate(), 2)}")
+
+    def has_notifications(self):
+        """True if notifications on new items have arrived since the last poll"""
+        return self.listener is not None and self.listener.new_items_event.is_set()
+
+    def teardown(self):
+        """Stop pipeline and insert queued auditlog entries. Also called if setup failed part of the way."""
+        if self.pipeline is not None:
+            self.pipeline.shutdown()
+
+        if self.owns_attachment_executor:
+            self.config["ATTACHMENT_EXECUTOR"].shutdown(wait=True)
+
+        # release the model, so it can be unloaded if no other service uses it
+        if self.model_handler is not None:
+            self.model_handler.close()
+
+        self.distributor.shutdown()
+
+        self._flush_auditlog()
 
         print("MailCheckerService exiting.")
 
+    def _process(self, full_items, pipeline, model_handler, time_zone):
+        """Preprocess, classify and distribute new items"""
+        if pipeline is not None:
+            pipeline.run(full_items,
+                         preprocess=lambda redud_prep, full_item: _preprocess_full_item(redud_prep, full_item,
+                                                                                        self.config),
+                         classify=lambda prep_items: self._classify_batch(prep_items, model_handler, time_zone),
+                         distribute=lambda classified: self._distribute_and_log_batch(classified, time_zone))
+        else:
+            # classified items waiting to be distributed together
+            batch = []
+            for redud_prep, full_item in full_items:
+                if self.terminated_event.is_set():
+                    print('Event is terminated')
+                    break
+
+                prep_item = _preprocess_full_item(redud_prep, full_item, self.config)
+                batch.append(self._classify(prep_item, model_handler.classify_item, time_zone))
+                if len(batch) >= self._distribution_batch_size():
+                    self._distribute_and_log_batch(batch, time_zone)
+                    batch = []
+
+            if batch:
+                self._distribute_and_log_batch(batch, time_zone)
+
+    def _save_sync_states(self):
+        """Save the sync states of the folders synced in this poll, if all their items were distributed. Else the
+        next poll syncs from the previous states, so the items that failed are tried again."""
+        if "SYNC_STATE_STORE" not in self.config:
+            return
+        if self.failed_items or self.terminated_event.is_set():
+            print(f"  Not saving sync states, {self.failed_items} items were not distributed.", flush=True)
+            self.config["SYNC_STATE_STORE"].discard()
+        else:
+            self.config["SYNC_STATE_STORE"].commit()
+
+    def _distribution_batch_size(self):
+        return self.config["DISTRIBUTION_BATCH_SIZE"] if "DISTRIBUTION_BATCH_SIZE" in self.config else 1
+
+    def _flush_auditlog(self):
+        """Insert queued auditlog entries"""
+        try:
+            self.auditlog.flush()
+        except Exception as e:
+            import traceback
+            print(e, flush=True)
+            print(traceback.format_exc(), flush=True)
+            self.config['MONITOR'].exception('MailServices:Run: Flushing auditlog failed')
+
+    def _classify_batch(self, prep_items, model_handler, time_zone):
+        """Classify a list of items with a single model call. Returns a list of results like _classify."""
+        items = [prep_item for prep_item in prep_items if not isinstance(prep_item, ErrorDuringMailRetrieving)]
+
+        # id of item -> classification_dict
+        classifications = {}
+        if len(items) > 1:
+            try:
+                for prep_item, classification_dict in zip(items, model_handler.classify_items(items)):
+                    classifications[id(prep_item)] = classification_dict
+            except Exception as e:
+                # classify the items one at a time instead, so one bad item does not fail the others
+                import traceback
+                print(e, flush=True)
+                print(traceback.format_exc(), flush=True)
+
+        def classifier_service(prep_item):
+            if id(prep_item) in classifications:
+                return classifications[id(prep_item)]
+            return model_handler.classify_item(prep_item)
+
+        return [self._classify(prep_item, classifier_service, time_zone) for prep_item in prep_items]
+
+    def _classify(self, prep_item, classifier_service, time_zone):
+        """Classify an item. Returns (prep_item, t_in, key, classification_dict) where classification_dict is None
+        if the classification failed and the item should be distributed to the fallback key."""
+
+        t_in = datetime.datetime.now(time_zone)
+
+        try:
+            # Clunky way of making sure that mails with error during preprocessing are being handled
+            if isinstance(prep_item, ErrorDuringMailRetrieving):
+                e = prep_item.error
+                prep_item = prep_item.prep_item
+                raise e
+
+            print(f"[{t_in}] MailCheckService:run - Got '{prep_item.subject}' for processing.")
+            # classify
+            classification_dict = classifier_service(prep_item)
+
+            if (classification_dict["conf"] and
+                classification_dict["conf"] >= self.config["THRESHOLD"]) or \
+                    "rule" in classification_dict["call_type"] or \
+                    "att_extractor" in classification_dict["call_type"]:
+                key = classification_dict["classification"]
+            else:
+                print(f'Confidence less than {self.config["THRESHOLD"]}, distribute to manual.',
+                        flush=True)
+                key = self.config["FALLBACK_KEY"]
+
+            return prep_item, t_in, key, classification_dict
+
+        except Exception as e:
+            import traceback
+            # classification failed, use fallback key
+            print("................. Classification failed!")
+            print(e)
+            print(traceback.format_exc(), flush=True)
+            self.config['MONITOR'].exception('MailServices:Run: Classification failed')
+            return prep_item, t_in, self.config["FALLBACK_KEY"], None
+
+    def _distribute_and_log_batch(self, classified, time_zone):
+        """Distribute a list of classified items with bulk calls and mark the successfully distributed items as
+        processed in the auditlog"""
+        if len(classified) == 1:
+            self._distribute_and_log(*classified[0], time_zone)
+            return
+
+        successes = self.distributor.distribute_batch([(prep_item.item, key) for prep_item, _, key, _ in classified])
+        for (prep_item, t_in, key, classification_dict), success in zip(classified, successes):
+            self._log_distribution(prep_item, t_in, key, classification_dict, time_zone, success)
+
+    def _distribute_and_log(self, prep_item, t_in, key, classification_dict, time_zone):
+        """Distribute a classified item and mark it as processed in the auditlog if successfull"""
+
+        if isinstance(key, list):
+            success = self.distributor.distribute_to_many(prep_item.item, key)
+        else:
+            success = self.distributor.distribute(prep_item.item, key)
+
+        self._log_distribution(prep_item, t_in, key, classification_dict, time_zone, success)
+
+    def _log_distribution(self, prep_item, t_in, key, classification_dict, time_zone, success):
+        """Mark a distributed item as processed in the auditlog if successfull"""
+        t_out = datetime.datetime.now(time_zone)
+        if success:
+            print(f"Succesfully distributed {prep_item.item.id} to {key}.", flush=True)
+            if classification_dict is not None:
+                call_type = classification_dict["call_type"]
+                confidence = classification_dict["conf"]
+                sorting_threshold = self.config["THRESHOLD"]
+                sorting_threshold_type = 'default_threshold'
+                model_classification = classification_dict["model_classification"]
+            else:
+                call_type = "model"
+                confidence = 0.0
+                sorting_threshold = 0.0
+                sorting_threshold_type = 'Model failed prediction'
+                model_classification = None
+
+            # create entry in auditlog
+            self.log_audit_entry(message_id=prep_item.id, t_in=t_in, t_out=t_out,
+                               t_email=prep_item.received_time,
+                               sender= "" if prep_item.sender is None else prep_item.sender.email_address,
+                               clas=key,
+                               conf=confidence,
+                               call_type=call_type,
+                               text=prep_item.extract_text(),
+                               sorting_threshold=sorting_threshold,
+                               sorting_threshold_type=sorting_threshold_type,
+                               model_classification=model_classification,
+                               customer_id=self.config['CUSTOMERID'],
+                               modelversion=self.config['MODEL_VERSION'])
+
+            # mark as processed, so the next mail check does not need to look it up in the auditlog
+            self.processed_items.add(prep_item)
+
+            # log succesful handling of email
+            self.config['MONITOR'].email_handling_success(prep_item)
+
+        else:
+            self.failed_items += 1
+            self.config['MONITOR'].exception('Distribution failed!')
+            print(50*"*")
+            print("................. Distribution failed!")
+            print("................. Should not be marked as processed so will be processed again later.")
+            print(50*"*", flush=True)
+
     def _build_folders(self, root, names):
         """Build a reference to a folder from a list of strings.
 
@@ -266,6 +513,29 @@ class MailCheckService(threading.Thread):
         return folders
 
 
+def create_auditlog(config):
+    """Create the auditlog of a configuration"""
+    return dataaccess.SQLLogger(server=config['DATABASE_URI'],
+                                port=config['DATABASE_PORT'],
+                                database=config['DATABASE_NAME'],
+                                table=config['AUDIT_LOG_TABLE_NAME'],
+                                username=config['DATABASE_USER_NAME'],
+                                password=config['DATABASE_PASSWORD'],
+                                buffer_size=config['AUDIT_LOG_BUFFER_SIZE'] if 'AUDIT_LOG_BUFFER_SIZE' in config else 100,
+                                flush_interval=config['AUDIT_LOG_FLUSH_INTERVAL'] if 'AUDIT_LOG_FLUSH_INTERVAL' in config else 30)
+
+
+def _limit_items(items, max_items, count):
+    """Yield at most max_items of items, counting them in count[0]"""
+    if max_items <= 0:
+        return
+    for item in items:
+        count[0] += 1
+        yield item
+        if count[0] >= max_items:
+            return
+
+
 class processed_item_handler():
     """Class for containing and handling already processed items"""
 
@@ -274,41 +544,82 @@ class processed_item_handler():
         # init
         self.config = config
         self.auditlog = auditlog
+        maxlen = config["PROCESSED_CACHE_MAXLEN"] if "PROCESSED_CACHE_MAXLEN" in config else maxlen
+        eviction = config["PROCESSED_CACHE_EVICTION"] if "PROCESSED_CACHE_EVICTION" in config else 'lru'
 
         # timezone handling
-        # TODO: should be in a specified object that handles preprocessing of items
-        #self.time_zone = timezone(self.config['TIME_ZONE'])
-        #self.email_time_zone = timezone(self.config['EMAIL_TIME_ZONE'])
+        self.time_zone = timezone(self.config['TIME_ZONE'])
 
-        # get alrady processed from DB
-        ## TODO: Update this function to get key-pair (id, datetime)
-        #processed_in_db = self.auditlog.get_processed_ids(customer_id=self.config['CUSTOMERID'])
-        processed_in_db = []
+        self.processed_items = ProcessedItemCache(maxlen=maxlen, eviction=eviction)
 
-        self.processed_items = collections.deque(processed_in_db, maxlen=maxlen)
-        
-        
+        # get alrady processed from DB
+        window = config["PROCESSED_CACHE_WINDOW_HOURS"] if "PROCESSED_CACHE_WINDOW_HOURS" in config else 28
+        since = datetime.datetime.now(self.time_zone) - datetime.timedelta(hours=window)
+        try:
+            processed_in_db = self.auditlog.get_processed_items(customer_id=self.config['CUSTOMERID'],
+                                                               since=self._local_time(since), limit=maxlen)
+        except Exception as e:
+            # start with an empty list, items are then checked against the DB
+            print(e, flush=True)
+            print(traceback.format_exc(), flush=True)
+            self.config['MONITOR'].exception('processed_item_handler: Failed to load processed items')
+            processed_in_db = []
+
+        for message_id, timestamp in processed_in_db:
+            self.processed_items.add(message_id, timestamp)
+        print(f"Loaded {len(self.processed_items)} processed items from the last {window} hours.")
 
     def __contains__(self, item):
         """Contain method"""
 
-        key = (item.id, item.received_time)
         # check for presence in local list
-        if key in self.processed_items:
+        if self.processed_items.contains(item.id, self._local_time(item.received_time)):
             return True
 
         # if not in local list, check DB
         if self._item_in_database(item):
-            self.processed_items.append(key)
+            self.add(item)
             return True
         else:
             return False
 
+    def add(self, item):
+        """Mark item as processed"""
+        self.processed_items.add(item.id, self._local_time(item.received_time))
+
+    def __str__(self):
+        return f"{self.processed_items}, hit rate {round(self.processed_items.hit_rate(), 2)}"
+
+    def _local_time(self, timestamp):
+        # timestamps are compared as local time without timezone, like they are stored in the auditlog
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(self.time_zone).replace(tzinfo=None)
+        return timestamp
+
+    def contains_items(self, items):
+        """Bulk version of the contain method. Items not in the local list are checked against the DB in a single
+        query. Returns a list of booleans in the order of items."""
+
+        processed = [self.processed_items.contains(item.id, self._local_time(item.received_time)) for item in items]
+
+        # check the rest in DB
+        unknown = [i for i, p in enumerate(processed) if not p]
+        for i, in_database in zip(unknown, self._items_in_database([items[i] for i in unknown])):
+            if in_database:
+                processed[i] = True
+                self.add(items[i])
+
+        return processed
+
 
     def _item_in_database(self, item):
         """Check for item_id in database"""
         return self.auditlog.contains_item(item, self.config['CUSTOMERID'])
 
+    def _items_in_database(self, items):
+        """Check for a list of items in database"""
+        return self.auditlog.contains_items(items, self.config['CUSTOMERID'])
+
 
 class ErrorDuringMailRetrieving:
     """Error type used in case the item_generator throws an exception while handling an email. If this type is yielded
@@ -320,6 +631,13 @@ class ErrorDuringMailRetrieving:
 def item_generator(source_folders, processed_items, config, terminated_event=None):
     """Generator with new items from source folders. First checks against internal list of
     processed items and secondly checks against DB."""
+    for redud_prep, full_item in full_item_generator(source_folders, processed_items, config, terminated_event):
+        yield _preprocess_full_item(redud_prep, full_item, config)
+
+
+def full_item_generator(source_folders, processed_items, config, terminated_event=None):
+    """Generator of (reduced preprocessed item, full item) for new items in source folders. The full item is an
+    exception if it could not be retrieved. Use _preprocess_full_item to get the preprocessed item."""
 
     #print("Item generator for folders:")
     #for folder in source_folders:
@@ -333,6 +651,9 @@ def item_generator(source_folders, processed_items, config, terminated_event=Non
         initial_run = False
     config["INITIAL_RUN"]=False
 
+    # store of sync states, if incremental sync is enabled
+    sync_store = config["SYNC_STATE_STORE"] if "SYNC_STATE_STORE" in config else None
+
     for folder in source_folders:
 
         print(f"[{time.ctime()}] Opening folder: {folder.account.primary_smtp_address}/{folder.name}")
@@ -352,56 +673,170 @@ def item_generator(source_folders, processed_items, config, terminated_event=Non
                 delta = datetime.timedelta(hours=28)
                 t = max(now-delta, config["START_TIME"])
                 start_time = folder.account.default_timezone.localize(ews.EWSDateTime.from_datetime(t))
-
-            source_queryset = utils.run_function_with_retry(folder.filter(datetime_received__gt=start_time).only, *fields)
         else:
             start_time = folder.account.default_timezone.localize(datetime.datetime(2020,1,1,12,0,0)) # not needed here but we set it to be able to print it
-            source_queryset = utils.run_function_with_retry(folder.all().only, *fields)
-        
+
+        # only get items created or changed since last mail check, unless it is time for a full scan
+        sync_state = None
+        if sync_store is not None and not initial_run and not sync_store.full_scan_due(folder):
+            try:
+                source_items, sync_state = utils.run_function_with_retry(_sync_items, folder, sync_store.load(folder),
+                                                                         fields, event=terminated_event)
+                if "START_TIME" in config:
+                    source_items = [item for item in source_items if item.datetime_received > start_time]
+            except Exception as e:
+                # the sync state might be invalid, start over and fall back to a full scan
+                print(f"Incremental sync failed, falling back to full scan. Error: {e}", flush=True)
+                config['MONITOR'].warning(f"Incremental sync of {folder.name} failed: {e}")
+                sync_store.clear(folder)
+                sync_state = None
+
+        if sync_state is None:
+            if "START_TIME" in config:
+                source_queryset = utils.run_function_with_retry(folder.filter(datetime_received__gt=start_time).only, *fields)
+            else:
+                source_queryset = utils.run_function_with_retry(folder.all().only, *fields)
+            source_items = list(source_queryset)
+            if sync_store is not None:
+                sync_store.full_scan_done(folder)
 
         # init counters
-        source_items = list(source_queryset)
         item_count = len(source_items)
-        proc_count = 0
-        new_count = 0
+        new_items = _new_items(source_items, processed_items, config)
+        new_count = len(new_items)
+        proc_count = item_count - new_count
 
-        for item in source_items:
+        yield from _fetch_full_items(folder, new_items, config, terminated_event)
 
-            # preprocess reduced item - this is mainly to get the timestamp correct wrt timezones
-            redud_prep = PreprocessedItem(item, config)
+        if sync_state is not None:
+            # all new items have been fetched. The state is saved when they are distributed, see SyncStateStore.commit
+            sync_store.stage(folder, sync_state)
+            print(f"  {folder.account.primary_smtp_address}/{folder.name}: {new_count} new. {proc_count} already processed. {item_count} changed since last sync.")
+        else:
+            print(f"  {folder.account.primary_smtp_address}/{folder.name}: {new_count} new. {proc_count} already processed. {item_count} in total since {start_time.strftime('%Y-%m-%d %H:%m:%S')}.")
+        print(f"  {processed_items}")
 
-            # check if item is already processed, if not, then get the full item and preprocess it before yielding
-            if redud_prep in processed_items:
-                proc_count = proc_count + 1
-            else:
-                new_count = new_count + 1
-                
-                try:
-                    # item is new so get full item from id
-                    full_item = utils.run_function_with_retry(_get_item_by_id, folder, item.id)
+def notified_item_generator(source_folders, item_ids, processed_items, config, terminated_event=None):
+    """Generator of (reduced preprocessed item, full item) for new items with the given (id, changekey). Items that
+    are already processed or no longer exist are skipped."""
 
-                    # preprocess item
-                    prep = PreprocessedItem(full_item, config)
+    # any folder can be used for fetching items by id
+    folder = next(iter(source_folders))
 
-                    #print("New item. Yielding: ", prep.received_time, prep.subject)
-                    config['MONITOR'].email_trace(prep, 'New item. Yielding.')
+    # an item can be notified more than once, e.g. created and then moved between source folders. Each item is
+    # fetched once, with its latest changekey.
+    item_ids = list(dict(item_ids).items())
 
-                    yield prep
+    fields = ('id','subject','datetime_received')
+    source_items = utils.run_function_with_retry(_get_items_by_ids, folder, item_ids, fields, event=terminated_event)
+    if source_items is None:
+        return
 
-                except Exception as e:
-                    # error occured, monitor it and continue
-                    config['MONITOR'].exception(str(e))
+    # the item might have been moved or deleted since the notification was sent
+    source_items = [item for item in source_items if not isinstance(item, Exception)]
+    new_items = _new_items(source_items, processed_items, config)
 
-                    print(e, flush=True)
-                    print(traceback.format_exc(), flush=True)
+    yield from _fetch_full_items(folder, new_items, config, terminated_event)
 
-                    yield ErrorDuringMailRetrieving(redud_prep, error=e)
+    print(f"  Notifications: {len(new_items)} new. {len(source_items) - len(new_items)} already processed.")
 
-                    
 
-        
-        print(f"  {folder.account.primary_smtp_address}/{folder.name}: {new_count} new. {proc_count} already processed. {item_count} in total since {start_time.strftime('%Y-%m-%d %H:%m:%S')}.")
+def _new_items(source_items, processed_items, config):
+    """Return list of (item, reduced preprocessed item) for the source items that are not yet processed"""
+
+    # items that are not yet processed, paired with their reduced preprocessed item
+    new_items = []
+
+    # preprocess reduced items - this is mainly to get the timestamp correct wrt timezones
+    redud_preps = [PreprocessedItem(item, config) for item in source_items]
+
+    # check which items are already processed
+    for item, redud_prep, processed in zip(source_items, redud_preps, processed_items.contains_items(redud_preps)):
+        if not processed:
+            new_items.append((item, redud_prep))
+
+    return new_items
+
+
+def _fetch_full_items(folder, new_items, config, terminated_event=None):
+    """Generator of (reduced preprocessed item, full item or exception) for the new items"""
+    if "FETCH_BATCH_SIZE" in config and config["FETCH_BATCH_SIZE"]:
+        # get full items in chunks with a single EWS request per chunk
+        return _fetch_items_batched(folder, new_items, config["FETCH_BATCH_SIZE"], terminated_event)
+    else:
+        # get full items one by one
+        return _fetch_items_single(folder, new_items)
+
+
+def _preprocess_full_item(redud_prep, full_item, config):
+    """Preprocess a full item. Returns ErrorDuringMailRetrieving if the item could not be retrieved or preprocessed."""
+    try:
+        # the item could not be retrieved from EWS, rethrow to handle it below
+        if isinstance(full_item, Exception):
+            raise full_item
+
+        # preprocess item
+        prep = PreprocessedItem(full_item, config)
+
+        #print("New item. Yielding: ", prep.received_time, prep.subject)
+        config['MONITOR'].email_trace(prep, 'New item. Yielding.')
+
+        return prep
+
+    except Exception as e:
+        # error occured, monitor it and continue
+        config['MONITOR'].exception(str(e))
+
+        print(e, flush=True)
+        print(traceback.format_exc(), flush=True)
+
+        return ErrorDuringMailRetrieving(redud_prep, error=e)
+
+
+def _fetch_items_single(folder, new_items):
+    """Generator of (reduced preprocessed item, full item or exception), using one EWS request per item"""
+    for item, redud_prep in new_items:
+        try:
+            # item is new so get full item from id
+            full_item = utils.run_function_with_retry(_get_item_by_id, folder, item.id)
+        except Exception as e:
+            full_item = e
+        yield redud_prep, full_item
+
+
+def _fetch_items_batched(folder, new_items, batch_size, terminated_event=None):
+    """Generator of (reduced preprocessed item, full item or exception), using one EWS request per chunk of
+    batch_size items. account.fetch returns the items, or an exception per failed item, in the same order as the ids."""
+    for i in range(0, len(new_items), batch_size):
+        chunk = new_items[i:i + batch_size]
+        try:
+            full_items = utils.run_function_with_retry(_get_items_by_ids, folder, [item for item, _ in chunk],
+                                                       event=terminated_event)
+        except Exception as e:
+            # the whole request failed, every item in the chunk gets the error
+            full_items = [e] * len(chunk)
+
+        # run_function_with_retry returns None if terminated before the call
+        if full_items is None:
+            return
+
+        for (_, redud_prep), full_item in zip(chunk, full_items):
+            yield redud_prep, full_item
+
+
+def _sync_items(folder, sync_state, fields):
+    """Helper function for use with retry function. Returns items created or changed since sync_state and the new
+    sync state"""
+    items = [item for change_type, item in folder.sync_items(sync_state=sync_state, only_fields=fields)
+             if change_type in ['create', 'update']]
+    return items, folder.item_sync_state
+
 
 def _get_item_by_id(folder, item_id):
     """Helper function for use with retry function"""
     return folder.get(id=item_id)
+
+
+def _get_items_by_ids(folder, items, only_fields=None):
+    """Helper function for use with retry function. Returns a list of items or exceptions in the order of items"""
+    return list(folder.account.fetch(ids=items, folder=folder, only_fields=only_fields))
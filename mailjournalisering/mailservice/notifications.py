@@ -0,0 +1,91 @@
+import exchangelib as ews
+import threading
+import time
+import traceback
+
+# events that can bring a new item into a source folder
+NEW_ITEM_EVENTS = ['NewMailEvent', 'CreatedEvent', 'MovedEvent', 'CopiedEvent']
+
+
+class StreamingNotificationListener(threading.Thread):
+    """Listens for EWS streaming notifications on the source folders and collects the ids of new items. Waiters are
+    woken when new ids arrive."""
+
+    def __init__(self, source_folders, terminated_event, connection_timeout=1, retry_sleep=30):
+        """
+                source_folders:      folders to subscribe to, all in the same account
+                terminated_event:    sig_term event
+                connection_timeout:  minutes before a streaming connection is closed and opened again
+                retry_sleep:         seconds to wait before subscribing again after an error
+        """
+        super().__init__(daemon=True)
+
+        self.source_folders = list(source_folders)
+        # only events of items in these folders are new items, moves and copies to other folders are not
+        self.folder_ids = {folder.id for folder in self.source_folders}
+        self.terminated_event = terminated_event
+        self.connection_timeout = connection_timeout
+        self.retry_sleep = retry_sleep
+
+        # ids of new items as (id, changekey), in order of arrival
+        self.item_ids = []
+        self.lock = threading.Lock()
+        self.new_items_event = threading.Event()
+
+    def run(self):
+        folder = self.source_folders[0]
+        while not self.terminated_event.is_set():
+            subscription_id = None
+            try:
+                # a collection returns a subscription id, or the error of the subscription
+                subscription = next(ews.FolderCollection(account=folder.account, folders=self.source_folders)
+                                    .subscribe_to_streaming(event_types=NEW_ITEM_EVENTS))
+                if isinstance(subscription, Exception):
+                    raise subscription
+                subscription_id = subscription
+                print(f"Subscribed to streaming notifications for {len(self.source_folders)} folders.", flush=True)
+
+                # each call blocks until the connection times out, then we open a new connection
+                while not self.terminated_event.is_set():
+                    for notification in folder.get_streaming_events(subscription_id,
+                                                                    connection_timeout=self.connection_timeout):
+                        self._handle_notification(notification)
+                        if self.terminated_event.is_set():
+                            break
+
+            except Exception as e:
+                # subscription expired or connection failed, subscribe again after a while. Items are not lost,
+                # as the fallback poll picks them up.
+                print(f"Streaming notifications failed. Error: {e}", flush=True)
+                print(traceback.format_exc(), flush=True)
+                self.terminated_event.wait(self.retry_sleep)
+
+            finally:
+                if subscription_id is not None:
+                    try:
+                        folder.unsubscribe(subscription_id)
+                    except Exception:
+                        pass
+
+    def _handle_notification(self, notification):
+        item_ids = [(event.item_id.id, event.item_id.changekey) for event in notification.events
+                    if event.ELEMENT_NAME in NEW_ITEM_EVENTS and getattr(event, 'item_id', None) is not None
+                    and event.parent_folder_id is not None and event.parent_folder_id.id in self.folder_ids]
+        if item_ids:
+            with self.lock:
+                self.item_ids.extend(item_ids)
+            self.new_items_event.set()
+
+    def pop_item_ids(self):
+        """Return the ids of new items since last call, or None if there are none"""
+        with self.lock:
+            item_ids, self.item_ids = self.item_ids, []
+            self.new_items_event.clear()
+        return item_ids if item_ids else None
+
+    def wait(self, timeout):
+        """Wait until there are new items, the service is terminated or timeout seconds have passed"""
+        deadline = time.time() + timeout
+        while not self.terminated_event.is_set() and time.time() < deadline:
+            if self.new_items_event.wait(min(1, deadline - time.time())):
+                return
@@ -0,0 +1,170 @@
+import concurrent.futures
+import queue
+import threading
+import traceback
+
+# marks the end of the items in a queue between two stages
+_END = object()
+
+
+class ItemPipeline:
+    """Staged processing of new items: fetch -> preprocess -> classify -> distribute and log.
+
+    Fetching and distribution run on their own threads, preprocessing runs on a bounded thread pool and
+    classification runs on the calling thread, as the model should be used on the thread it was created on. Items that
+    are preprocessed when the classifier gets to them are classified together, up to batch_size items at a time.
+    Likewise, items that are classified when the distributor gets to them are distributed together, up to
+    distribute_batch_size items at a time.
+    The stages are connected by bounded queues, so a slow stage holds back the ones before it. Items keep their order
+    through all stages.
+    """
+
+    def __init__(self, terminated_event, workers=4, queue_size=16, batch_size=1, distribute_batch_size=1):
+        """
+                terminated_event:       sig_term event
+                workers:                number of threads for preprocessing items
+                queue_size:             max number of items waiting between two stages
+                batch_size:             max number of items classified together
+                distribute_batch_size:  max number of items distributed together
+        """
+        self.terminated_event = terminated_event
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.distribute_batch_size = distribute_batch_size
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def run(self, items, preprocess, classify, distribute):
+        """Process all items and return when done or when terminated.
+
+                items:       iterable of argument tuples for preprocess, iterated on the fetch thread
+                preprocess:  function returning a preprocessed item, run on the thread pool
+                classify:    function taking a list of preprocessed items and returning a list of argument tuples for
+                             distribute
+                distribute:  function distributing and logging a list of classified items
+        """
+        # set if a stage fails in a way where the following stages should not continue
+        stop = threading.Event()
+        errors = []
+
+        prep_queue = queue.Queue(maxsize=self.queue_size)
+        dist_queue = queue.Queue(maxsize=self.queue_size)
+
+        def fetch_stage():
+            for args in items:
+                if self._stopping(stop):
+                    break
+                if not self._put(prep_queue, self.executor.submit(preprocess, *args), stop):
+                    break
+
+        def classify_stage():
+            while True:
+                future = self._get(prep_queue, stop)
+                if future is _END or self._stopping(stop):
+                    break
+
+                # take the following items as well while they are already preprocessed
+                futures = [future]
+                end = False
+                while len(futures) < self.batch_size and futures[-1].done():
+                    try:
+                        future = prep_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if future is _END:
+                        end = True
+                        break
+                    futures.append(future)
+
+                # preprocess never raises, errors are returned as ErrorDuringMailRetrieving
+                for classified in classify([future.result() for future in futures]):
+                    if not self._put(dist_queue, classified, stop):
+                        return
+                if end:
+                    break
+
+        def distribute_stage():
+            while True:
+                classified = self._get(dist_queue, stop)
+                if classified is _END or self._stopping(stop):
+                    break
+
+                # take the following items as well while they are already classified
+                batch = [classified]
+                end = False
+                while len(batch) < self.distribute_batch_size:
+                    try:
+                        classified = dist_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if classified is _END:
+                        end = True
+                        break
+                    batch.append(classified)
+
+                distribute(batch)
+                if end:
+                    break
+
+        # an error while fetching ends the input, items already fetched are still processed
+        fetcher = threading.Thread(target=self._run_stage, args=(fetch_stage, prep_queue, stop, errors, False))
+        distributor = threading.Thread(target=self._run_stage, args=(distribute_stage, None, stop, errors, True))
+        fetcher.start()
+        distributor.start()
+
+        self._run_stage(classify_stage, dist_queue, stop, errors, True)
+
+        fetcher.join()
+        distributor.join()
+
+        # cancel preprocessing of items that were never classified, they will be picked up again at next run
+        while not prep_queue.empty():
+            future = prep_queue.get_nowait()
+            if future is not _END:
+                future.cancel()
+
+        if self.terminated_event.is_set():
+            print('Event is terminated')
+
+        # raise the first error, like an error in the sequential loop would
+        if errors:
+            raise errors[0]
+
+    def shutdown(self):
+        """Stop the preprocessing threads"""
+        self.executor.shutdown(wait=True)
+
+    def _stopping(self, stop):
+        return stop.is_set() or self.terminated_event.is_set()
+
+    def _put(self, q, obj, stop):
+        """Put obj in queue. Returns False if the pipeline is stopping before there is room in the queue."""
+        while True:
+            try:
+                q.put(obj, timeout=1)
+                return True
+            except queue.Full:
+                if self._stopping(stop):
+                    return False
+
+    def _get(self, q, stop):
+        """Get next object from queue. Returns _END if the pipeline is stopping while the queue is empty."""
+        while True:
+            try:
+                return q.get(timeout=1)
+            except queue.Empty:
+                if self._stopping(stop):
+                    return _END
+
+    def _run_stage(self, stage, out_queue, stop, errors, stop_on_error):
+        """Run a stage and signal the end of its output to the next stage"""
+        try:
+            stage()
+        except Exception as e:
+            print(e, flush=True)
+            print(traceback.format_exc(), flush=True)
+            errors.append(e)
+            if stop_on_error:
+                stop.set()
+        finally:
+            if out_queue is not None:
+                self._put(out_queue, _END, stop)
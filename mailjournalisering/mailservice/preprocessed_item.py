@@ -4,21 +4,31 @@ import exchangelib as ews
 import re
 from pytz import timezone
 import collections
+import datetime
+import tempfile
 from dataaccess.stdoutmonitor import STDOutMonitor
+from contentextraction.html_text import html_to_text, plain_text
+from contentextraction.text_cache import TextCache
 
 # start tika
 print(f"Tika server endpoint: {parser.ServerEndpoint}", flush=True)
 
 
 class PreprocessedItem(object):
-    """Class for holding text preprocessed Exchange item"""
+    """Class for holding text preprocessed Exchange item. Attributes that are not set on this object are read from the
+    item. The combined text and the lower cased texts are computed once, when first used."""
+
+    __slots__ = ['item', 'config', 'body', 'attachment_texts', 'time_zone', 'email_time_zone', 'received_time',
+                 '_memo']
 
     def __init__(self, item, config):
         self.config = config
         self.item = item
+        # name -> memoized text
+        self._memo = {}
 
         try:
-            self.body = self._clean_html(item.body)
+            self.body = self._clean_html(item.body, max_string_length=self._text_limit('MAX_BODY_CHARS'))
         except Exception as E:
             print(E)
             import traceback
@@ -30,80 +40,250 @@ class PreprocessedItem(object):
         self.time_zone = timezone(self.config['TIME_ZONE'])
         self.email_time_zone = timezone(self.config['EMAIL_TIME_ZONE'])
 
-        self.received_time = item.datetime_received.replace(tzinfo=self.email_time_zone).astimezone(self.time_zone)
+        # EWSDateTime only takes an EWSTimeZone, so the time is converted as a plain datetime
+        received = item.datetime_received
+        received = datetime.datetime.combine(received.date(), received.time())
+        self.received_time = received.replace(tzinfo=self.email_time_zone).astimezone(self.time_zone)
+
+    # attributes of the item that are read for every item, as properties they are found without __getattr__
+    @property
+    def id(self):
+        return self.item.id
+
+    @property
+    def subject(self):
+        return self.item.subject
+
+    @property
+    def sender(self):
+        return self.item.sender
 
-    def __getattribute__(self, attr):
-        # if attribute exist in this object then return that, else return the attribute from the item
-        if attr in ['item', 'body', 'attachment_texts', 'config', '_clean_html', '_get_text', '_get_attachment_texts',
-                    'extract_text', 'time_zone', 'email_time_zone', 'received_time']:
-            return object.__getattribute__(self, attr)
-        else:
-            return self.item.__getattribute__(attr)
+    @property
+    def attachments(self):
+        return self.item.attachments
+
+    @property
+    def datetime_received(self):
+        return self.item.datetime_received
+
+    def __getattr__(self, attr):
+        # only called if the attribute does not exist in this object, return the attribute from the item. The item is
+        # looked up without __getattr__, so a missing item raises AttributeError instead of recursing.
+        return getattr(object.__getattribute__(self, 'item'), attr)
 
     def extract_text(self):
         # concat texts
-        return str(self.subject) + " " + str(self.body) + " ".join(self.attachment_texts)
+        if 'text' not in self._memo:
+            self._memo['text'] = str(self.subject) + " " + str(self.body) + " ".join(self.attachment_texts)
+        return self._memo['text']
+
+    def lower_text(self):
+        """Lower cased extract_text()"""
+        if 'lower_text' not in self._memo:
+            self._memo['lower_text'] = self.extract_text().lower()
+        return self._memo['lower_text']
+
+    def lower_subject(self):
+        """Lower cased subject, None if there is no subject"""
+        if 'lower_subject' not in self._memo:
+            self._memo['lower_subject'] = self.subject.lower() if self.subject is not None else None
+        return self._memo['lower_subject']
+
+    def lower_body(self):
+        if 'lower_body' not in self._memo:
+            self._memo['lower_body'] = self.body.lower()
+        return self._memo['lower_body']
+
+    def lower_attachment_texts(self):
+        if 'lower_attachment_texts' not in self._memo:
+            self._memo['lower_attachment_texts'] = [at.lower() for at in self.attachment_texts]
+        return self._memo['lower_attachment_texts']
 
     def _get_attachment_texts(self, item, allowed_content_type):
-        """Helper method for getting text from attachments"""
+        """Helper method for getting text from attachments. If there is an ATTACHMENT_EXECUTOR in config, the texts of
+        all file attachments, also the ones in attached messages, are extracted concurrently on the executor."""
+        executor = self.config['ATTACHMENT_EXECUTOR'] if 'ATTACHMENT_EXECUTOR' in self.config else None
 
-        # set max size of attachment to process to 10 MB
-        # TODO: change to a user setting, not hardcoded
-        max_attachment_size = 10 * 1024 * 1024
+        # stop extracting when the item has MAX_TEXT_CHARS of text, the rest of the attachments are empty
+        remaining = self._text_limit('MAX_TEXT_CHARS') - len(str(item.subject)) - len(self.body)
+        if remaining <= 0:
+            # the subject and body fill the budget, so no extraction is started on the executor
+            executor = None
 
+        futures = []
+        getters = self._attachment_text_getters(item, allowed_content_type, executor, futures)
         attachment_texts = []
+        for get_text in getters:
+            if remaining <= 0:
+                attachment_texts.append(" ")
+                continue
+            text = get_text()
+            remaining -= len(text)
+            attachment_texts.append(text)
+
+            if remaining <= 0:
+                # extractions that have not started are not needed
+                for future in futures:
+                    future.cancel()
+
+        return attachment_texts
+
+    def _attachment_text_getters(self, item, allowed_content_type, executor, futures):
+        """Start extracting the texts of the attachments of item on executor, or prepare extracting them if executor
+        is None. Returns a function per attachment, in order, that returns the text of the attachment. Futures of the
+        extractions are added to futures."""
+
+        # max size of attachment to process, 10 MB by default
+        max_attachment_size = self.config['MAX_ATTACHMENT_SIZE'] if 'MAX_ATTACHMENT_SIZE' in self.config else 10 * 1024 * 1024
+
+        getters = []
         for attachment in item.attachments:
             if isinstance(attachment, ews.FileAttachment):
-                if (attachment.content_type in allowed_content_type) and (attachment.size < max_attachment_size):
+                # only the metadata of the attachment is fetched with the item, the content is fetched when it is
+                # read. Attachments of unknown size are checked while they are downloaded.
+                if (attachment.content_type in allowed_content_type) and \
+                        (attachment.size is None or attachment.size < max_attachment_size):
 
                     # if attachment is a file of relevant type extract text
-                    try:
-                        text = self._get_text(attachment.content)
-                        attachment_texts.append(text)
-                    except Exception as e:
-                        # extraction failed, return empty string - should also throw an error to log
-                        import traceback
-                        print(e)
-                        print(traceback.format_exc(), flush=True)
-                        self.config['MONITOR'].exception(str(e))
-                        attachment_texts.append(" ")
+                    if executor is not None:
+                        future = executor.submit(self._get_file_attachment_text, attachment)
+                        futures.append(future)
+                        getters.append(future.result)
+                    else:
+                        getters.append(lambda attachment=attachment: self._get_file_attachment_text(attachment))
                 else:
                     # if not, return empty string
-                    attachment_texts.append(" ")
+                    getters.append(lambda: " ")
 
             elif isinstance(attachment, ews.ItemAttachment):
                 # if attachment is a message then extract subject and body
                 if isinstance(attachment.item, ews.Message):
-                    try:
-                        text = attachment.item.subject
-                        text = text + " " + self._clean_html(attachment.item.body) + " " + " ".join(self._get_attachment_texts(attachment.item, allowed_content_type))
-                        attachment_texts.append(text)
-                    except Exception as e:
-                        # if text extraction from item attachment fails, then append an empty string
-                        attachment_texts.append(" ")
-                        import traceback
-                        print(e)
-                        print(traceback.format_exc(), flush=True)
-                        self.config['MONITOR'].exception(str(e))
+                    getters.append(self._item_attachment_text_getter(attachment, allowed_content_type, executor,
+                                                                     futures))
                 else:
                     # if not a message, return empty string
-                    attachment_texts.append(" ")
+                    getters.append(lambda: " ")
 
-        return attachment_texts
+        return getters
+
+    def _get_file_attachment_text(self, attachment):
+        try:
+            # large attachments are streamed from Exchange to a temporary file, instead of being held in memory.
+            # Attachments that were fetched with their content are used as they are.
+            stream_size = self.config['STREAM_ATTACHMENT_SIZE'] if 'STREAM_ATTACHMENT_SIZE' in self.config else 1024 * 1024
+            if attachment.attachment_id is not None and getattr(attachment, '_content', None) is None and \
+                    (attachment.size is None or attachment.size >= stream_size):
+                return self._get_streamed_text(attachment)
+
+            return self._get_cached_text(attachment.content, max_string_length=self._text_limit('MAX_ATTACHMENT_CHARS'))
+        except Exception as e:
+            # extraction failed, return empty string - should also throw an error to log
+            import traceback
+            print(e)
+            print(traceback.format_exc(), flush=True)
+            self.config['MONITOR'].exception(str(e))
+            return " "
+
+    def _item_attachment_text_getter(self, attachment, allowed_content_type, executor, futures):
+        """Start extracting the text of an attached message. Returns a function that returns the text."""
+
+        def failed(e):
+            # if text extraction from item attachment fails, then return an empty string
+            import traceback
+            print(e)
+            print(traceback.format_exc(), flush=True)
+            self.config['MONITOR'].exception(str(e))
+            return " "
+
+        try:
+            nested_getters = self._attachment_text_getters(attachment.item, allowed_content_type, executor, futures)
+        except Exception as e:
+            text = failed(e)
+            return lambda: text
+
+        def get_text():
+            try:
+                text = attachment.item.subject
+                text = text + " " + self._clean_html(attachment.item.body) + " " + " ".join([get() for get in nested_getters])
+                return text[:int(self._text_limit('MAX_ATTACHMENT_CHARS'))]
+            except Exception as e:
+                return failed(e)
+
+        return get_text
+
+    def _text_limit(self, key):
+        """Max number of chars of text from config, 1e30 if there is no limit. Attachment texts are not limited if a
+        rule needs the full text (FULL_ATTACHMENT_TEXT)."""
+        if key != 'MAX_BODY_CHARS' and 'FULL_ATTACHMENT_TEXT' in self.config and self.config['FULL_ATTACHMENT_TEXT']:
+            return 1e30
+        return self.config[key] if key in self.config and self.config[key] else 1e30
+
+    def _get_streamed_text(self, attachment, chunk_size=64 * 1024):
+        """Stream content of attachment to a temporary file and extract the text from the file. The cache key is
+        computed while streaming."""
+        max_attachment_size = self.config['MAX_ATTACHMENT_SIZE'] if 'MAX_ATTACHMENT_SIZE' in self.config else 10 * 1024 * 1024
+
+        with tempfile.SpooledTemporaryFile(max_size=chunk_size) as f:
+            key_hash = TextCache.key_hash()
+            size = 0
+            with attachment.fp as fp:
+                while True:
+                    chunk = fp.read(chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size >= max_attachment_size:
+                        print(f"Attachment {attachment.name} is larger than {max_attachment_size} bytes. Skipping.",
+                              flush=True)
+                        return " "
+                    key_hash.update(chunk)
+                    f.write(chunk)
+
+            f.seek(0)
+            return self._get_cached_text(f, key=key_hash.hexdigest(),
+                                         max_string_length=self._text_limit('MAX_ATTACHMENT_CHARS'))
+
+    def _get_cached_text(self, byte_string, key=None, max_string_length=1e30):
+        """Get text from the text cache if the same content has been extracted before, else extract it using _get_text.
+        byte_string can also be a file, then key is the key of its content."""
+        if 'TEXT_CACHE' not in self.config or self.config['TEXT_CACHE'] is None:
+            return self._get_text(byte_string, max_string_length)
+
+        text_cache = self.config['TEXT_CACHE']
+        if key is None:
+            key = text_cache.key(byte_string)
+        if max_string_length < 1e30:
+            # texts extracted with a limit are cached apart from the full texts
+            key = f"{key}.{int(max_string_length)}"
+        text = text_cache.get(key)
+        if text is None:
+            text = self._get_text(byte_string, max_string_length)
+            # failed extractions also return a single white-space, these are not cached
+            if text != " ":
+                text_cache.put(key, text)
+        return text
 
     # Tika is able to extract both pdf and docx
     def _get_text(self, byte_string, max_string_length=1e30):
         content = ""
         try:
+            # ask Tika to stop writing text when there is enough. The limit is doubled, as white-space is replaced
+            # below. Tika servers that do not know the header ignore it.
+            headers = {'writeLimit': str(2 * int(max_string_length))} if max_string_length < 1e30 else None
+
             # try to extract content
-            f  = parser.from_buffer(byte_string)
+            if 'TIKA_CLIENT' in self.config and self.config['TIKA_CLIENT'] is not None:
+                f = self.config['TIKA_CLIENT'].from_buffer(byte_string, headers=headers)
+            else:
+                f = parser.from_buffer(byte_string, headers=headers)
             content = f['content']
 
             if content is None:
                 content = " "
             else:
                 # replace white-space, tabs, newlines, etc with a single white-space
-                content = re.sub(r'\s+', ' ', content).strip()
+                content = content[:2 * int(max_string_length)]
+                content = re.sub(r'\s+', ' ', content).strip()[:int(max_string_length)]
         except Exception as e:
             # if an exception occurs, return empty string
             import traceback
@@ -115,12 +295,23 @@ class PreprocessedItem(object):
             return content
 
 
-    def _clean_html(self, mail):
-        """Strip html for anything else but content text"""
+    def _clean_html(self, mail, max_string_length=1e30):
+        """Strip html for anything else but content text. Returns at most max_string_length chars."""
 
         if mail is None:
             return " "
 
+        # strip html in process, unless Tika is configured for bodies
+        if 'BODY_EXTRACTOR' not in self.config or self.config['BODY_EXTRACTOR'] != 'tika':
+            try:
+                if isinstance(mail, ews.Body) and not isinstance(mail, ews.HTMLBody):
+                    return plain_text(mail)[:int(max_string_length)]
+                return html_to_text(mail)[:int(max_string_length)]
+            except Exception as e:
+                msg = f"Failed to strip html of email: {e}. Defaulting to Tika...."
+                print(msg)
+                self.config['MONITOR'].warning(msg)
+
         encoding = re.findall(r"<meta.*charset=([0-9\-a-z]*)\">", mail, flags=re.IGNORECASE)
         if len(encoding) > 0:
             try:
@@ -132,7 +323,7 @@ class PreprocessedItem(object):
 
         try:
             # get content by using tika
-            return self._get_text(mail)
+            return self._get_text(mail, max_string_length)
         except UnicodeEncodeError:
             msg = "Tika failed to parse email. Defaulting to beautiful soup...."
             print(msg)
@@ -142,7 +333,7 @@ class PreprocessedItem(object):
         mail = re.sub(r"\n", " ", mail)
         mail = re.sub(r"\r\n", " ", mail)
         mail = re.sub(r"<!--.*-->", "", mail)
-        return BeautifulSoup(mail, features="html.parser").get_text()
+        return BeautifulSoup(mail, features="html.parser").get_text()[:int(max_string_length)]
 
     def __str__(self):
         return f"timestamp={self.received_time}, sender={'None' if self.sender is None else self.sender.email_address}, subject={self.subject}"
@@ -0,0 +1,68 @@
+import collections
+import threading
+
+
+class ProcessedItemCache:
+    """Bounded set of processed items, keyed on message id with the timestamp of the item. Two timestamps within
+    tolerance seconds are the same, like in SQLLogger.contains_item. Membership is a dict lookup.
+
+    When the cache holds more than maxlen items, the least recently used message ids are removed (eviction='lru') or
+    the first added (eviction='fifo')."""
+
+    def __init__(self, maxlen=2000, eviction='lru', tolerance=1.):
+        if eviction not in ['lru', 'fifo']:
+            raise ValueError(f"Eviction must be in ['lru', 'fifo'], not '{eviction}'")
+
+        self.maxlen = maxlen
+        self.eviction = eviction
+        self.tolerance = tolerance
+
+        # message id -> list of timestamps, the id to evict first is first
+        self.items = collections.OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+
+    def contains(self, message_id, timestamp):
+        with self.lock:
+            timestamps = self.items.get(message_id)
+            if timestamps is not None and any(abs((timestamp - t).total_seconds()) < self.tolerance for t in timestamps):
+                self.hits += 1
+                if self.eviction == 'lru':
+                    self.items.move_to_end(message_id)
+                return True
+
+            self.misses += 1
+            return False
+
+    def add(self, message_id, timestamp):
+        with self.lock:
+            timestamps = self.items.get(message_id)
+            if timestamps is None:
+                self.items[message_id] = [timestamp]
+            elif any(abs((timestamp - t).total_seconds()) < self.tolerance for t in timestamps):
+                # already there
+                return
+            else:
+                timestamps.append(timestamp)
+                if self.eviction == 'lru':
+                    self.items.move_to_end(message_id)
+            self.size += 1
+
+            # remove items until there is room
+            while self.size > self.maxlen:
+                _, timestamps = self.items.popitem(last=False)
+                self.size -= len(timestamps)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return f"ProcessedItemCache (size={self.size}, maxlen={self.maxlen}, hits={self.hits}, misses={self.misses})"
@@ -0,0 +1,73 @@
+import hashlib
+import os
+import time
+
+
+class SyncStateStore:
+    """Persists the EWS SyncFolderItems state of source folders in files, one file per folder, so an incremental
+    sync can continue after a restart. Also keeps track of when each folder was last scanned in full."""
+
+    def __init__(self, path, full_scan_interval=3600):
+        """
+                path:                directory for the state files
+                full_scan_interval:  seconds between full scans of a folder
+        """
+        self.path = path
+        self.full_scan_interval = full_scan_interval
+
+        # folder key -> time of last full scan
+        self.last_full_scan = {}
+
+        # folder key -> (folder, sync state) of syncs whose items are not yet distributed
+        self.pending = {}
+
+        os.makedirs(self.path, exist_ok=True)
+
+    def load(self, folder):
+        """Return the stored sync state of folder or None if there is none"""
+        try:
+            with open(self._file(folder), 'r') as f:
+                return f.read() or None
+        except OSError:
+            return None
+
+    def save(self, folder, sync_state):
+        # write to temporary file first, so a crash never leaves a partial state
+        tmp_file = self._file(folder) + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(sync_state)
+        os.replace(tmp_file, self._file(folder))
+
+    def stage(self, folder, sync_state):
+        """Keep sync_state of folder until commit, which is called when the items of the sync are distributed"""
+        self.pending[self._key(folder)] = (folder, sync_state)
+
+    def commit(self):
+        """Save the staged sync states"""
+        for folder, sync_state in self.pending.values():
+            self.save(folder, sync_state)
+        self.pending = {}
+
+    def discard(self):
+        """Forget the staged sync states, the next sync continues from the saved states"""
+        self.pending = {}
+
+    def clear(self, folder):
+        """Remove the stored sync state, the next sync starts from scratch"""
+        try:
+            os.remove(self._file(folder))
+        except OSError:
+            pass
+
+    def full_scan_due(self, folder):
+        key = self._key(folder)
+        return key not in self.last_full_scan or time.time() - self.last_full_scan[key] >= self.full_scan_interval
+
+    def full_scan_done(self, folder):
+        self.last_full_scan[self._key(folder)] = time.time()
+
+    def _key(self, folder):
+        return hashlib.sha1(f"{folder.account.primary_smtp_address}/{folder.id}".encode('utf-8')).hexdigest()
+
+    def _file(self, folder):
+        return os.path.join(self.path, self._key(folder) + '.state')
@@ -8,16 +8,34 @@ import mailservice
 ## load configuration
 system_config_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), "system_config.yaml")
 
-configuration = configuration.ConfigurationHandler(system_config_file, os.environ["ENV"], [os.environ["CUSTOMER_ID"]])
+# CUSTOMER_IDS is a comma separated list of customers run by a single MailCheckHost, else CUSTOMER_ID is run by a
+# MailCheckService
+if "CUSTOMER_IDS" in os.environ and os.environ["CUSTOMER_IDS"]:
+    customer_ids = [cid.strip() for cid in os.environ["CUSTOMER_IDS"].split(",") if cid.strip()]
+else:
+    customer_ids = [os.environ["CUSTOMER_ID"]]
 
-configuration.customer_config[os.environ["CUSTOMER_ID"]]["DISTRIBUTION_MODE"] = os.environ["DISTRIBUTION_MODE"]
+configuration = configuration.ConfigurationHandler(system_config_file, os.environ["ENV"], customer_ids,
+                                                   skip_failed_customers=len(customer_ids) > 1)
 
-# set flag INITIAL_RUN==True, this will be set to False after first run
-configuration.customer_config[os.environ["CUSTOMER_ID"]]["INITIAL_RUN"] = True
+for cid in configuration.customer_config:
+    configuration.customer_config[cid]["DISTRIBUTION_MODE"] = os.environ["DISTRIBUTION_MODE"]
 
-# init mail checker
-configuration.customer_config[os.environ["CUSTOMER_ID"]]["MONITOR"].info('Main: Configauration loaded. Initialising mailchecker.')
-mailchecker = mailservice.MailCheckService(configuration.customer_config[os.environ["CUSTOMER_ID"]])
+    # set flag INITIAL_RUN==True, this will be set to False after first run
+    configuration.customer_config[cid]["INITIAL_RUN"] = True
+
+    # init mail checker
+    configuration.customer_config[cid]["MONITOR"].info('Main: Configauration loaded. Initialising mailchecker.')
+
+if len(customer_ids) > 1:
+    system_config = configuration.system_config
+    mailchecker = mailservice.MailCheckHost(configuration.customer_config,
+                                            workers=system_config["HOST_WORKERS"] if "HOST_WORKERS" in system_config else 4,
+                                            max_items_per_poll=system_config["HOST_MAX_ITEMS_PER_POLL"] if "HOST_MAX_ITEMS_PER_POLL" in system_config else 100,
+                                            audit_log_connections=system_config["AUDIT_LOG_CONNECTIONS"] if "AUDIT_LOG_CONNECTIONS" in system_config else 2,
+                                            model_idle_timeout=system_config["MODEL_IDLE_TIMEOUT"] if "MODEL_IDLE_TIMEOUT" in system_config else 600)
+else:
+    mailchecker = mailservice.MailCheckService(configuration.customer_config[customer_ids[0]])
 
 
 def term(signalNumber, _):
@@ -27,7 +45,6 @@ def term(signalNumber, _):
     mailchecker.join()
     print("mailcheck quitted")
 
-
 if __name__ == "__main__":
     signal.signal(signal.SIGTERM, term)
     signal.signal(signal.SIGINT, term)
@@ -0,0 +1,112 @@
+import sys
+import threading
+import numpy as np
+import pytest
+from classification.model_handler import ModelHandler
+
+
+class DummyItem:
+    def __init__(self, subject, body=""):
+        self.subject = subject
+        self.body = body
+        self.attachment_texts = []
+
+    def extract_text(self):
+        return f"{self.subject} {self.body}"
+
+
+class DummyModel:
+    """Model predicting category 'kat' for texts with 'kat', else 'hund'. Records the texts of each call."""
+    category_to_id = {'hund': 0, 'kat': 1}
+
+    def __init__(self):
+        self.calls = []
+
+    def predict_batch(self, texts):
+        self.calls.append(texts)
+        return np.array([[0.1, 0.9] if 'kat' in text else [0.8, 0.2] for text in texts])
+
+
+class DummyRegistry:
+    """Registry returning model when loaded is set"""
+
+    def __init__(self, model):
+        self.model = model
+        self.loaded = threading.Event()
+        self.loaded.set()
+
+    def acquire(self, model_path, vocabulary_cache=None):
+        self.loaded.wait(10)
+        return self.model
+
+    def release(self, model_path):
+        pass
+
+
+@pytest.fixture()
+def registry(mocker):
+    registry = DummyRegistry(DummyModel())
+    mocker.patch("classification.model_handler.model_registry", registry)
+    return registry
+
+
+@pytest.fixture()
+def config(tmp_path):
+    return {"MODEL_VERSION": "v1", "MODEL_PATH": str(tmp_path), "USE_ATT_EXTRACTOR": False,
+            "FALLBACK_MAIL": "manuel@kommune.dk", "LOAD_MODEL_IN_BACKGROUND": False,
+            "RULES": [{"rule_type": "SubjectContainsRule", "token": "faktura", "return_value": "faktura@kommune.dk",
+                       "name": "faktura"}]}
+
+
+def test_items_are_classified_with_one_model_call(registry, config):
+    model_handler = ModelHandler(config)
+    items = [DummyItem("Min kat"), DummyItem("Faktura", "for kat"), DummyItem("Min hund")]
+    results = model_handler.classify_items(items)
+
+    assert registry.model.calls == [["Min kat ", "Faktura for kat", "Min hund "]]
+    assert [r["classification"] for r in results] == ['kat', 'faktura@kommune.dk', 'hund']
+    assert [r["call_type"] for r in results] == ['model', 'rule faktura', 'model']
+    # items classified by a rule still get the classification of the model
+    assert [r["model_classification"] for r in results] == ['kat', 'kat', 'hund']
+    assert [round(float(r["conf"]), 1) for r in results] == [0.9, 0.9, 0.8]
+
+
+def test_classify_item_is_a_batch_of_one(registry, config):
+    model_handler = ModelHandler(config)
+    assert model_handler.classify_item(DummyItem("Min kat"))["classification"] == 'kat'
+    assert registry.model.calls == [["Min kat "]]
+
+
+def test_rules_do_not_wait_for_model_loading_in_background(registry, config):
+    config["LOAD_MODEL_IN_BACKGROUND"] = True
+    registry.loaded.clear()
+    model_handler = ModelHandler(config)
+
+    # a rule applies, so the item is classified while the model loads
+    result = model_handler.classify_item(DummyItem("Faktura"))
+    assert result["classification"] == 'faktura@kommune.dk' and result["model_classification"] is None
+
+    # an item without a rule waits for the model
+    threading.Timer(0.2, registry.loaded.set).start()
+    assert model_handler.classify_item(DummyItem("Min kat"))["classification"] == 'kat'
+    model_handler.close()
+
+
+def test_failed_background_load_fails_classification_by_model(registry, config, mocker):
+    config["LOAD_MODEL_IN_BACKGROUND"] = True
+    mocker.patch.object(registry, 'acquire', side_effect=OSError("model not found"))
+    model_handler = ModelHandler(config)
+
+    assert model_handler.classify_item(DummyItem("Faktura"))["call_type"] == 'rule faktura'
+    with pytest.raises(OSError):
+        model_handler.classify_item(DummyItem("Min kat"))
+
+
+def test_tensorflow_is_not_imported_without_model(config, mocker):
+    # importing the model module, and with it TensorFlow, fails
+    mocker.patch.dict(sys.modules, {"classification.model": None})
+    config["MODEL_VERSION"] = None
+
+    model_handler = ModelHandler(config)
+    result = model_handler.classify_item(DummyItem("Min kat"))
+    assert result["classification"] == "manuel@kommune.dk" and result["call_type"] == 'no_rule_nor_att_applied'
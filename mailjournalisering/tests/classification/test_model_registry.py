@@ -0,0 +1,81 @@
+import pickle
+import sys
+import threading
+import types
+import pytest
+from classification.model_registry import ModelRegistry
+from classification.vocabulary import VocabularyTable
+
+
+class DummyModel:
+    loads = 0
+
+    def __init__(self, model_path, vocabulary_cache=None):
+        DummyModel.loads += 1
+        if model_path == "broken":
+            raise OSError("model not found")
+        self.model_path = model_path
+
+    def predict(self, text):
+        return [1.]
+
+
+@pytest.fixture()
+def registry(mocker):
+    DummyModel.loads = 0
+    module = types.ModuleType("classification.model")
+    module.Model = DummyModel
+    mocker.patch.dict(sys.modules, {"classification.model": module})
+    return ModelRegistry()
+
+
+def test_model_is_loaded_once(registry):
+    models = []
+    threads = [threading.Thread(target=lambda: models.append(registry.acquire("models/v1"))) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert DummyModel.loads == 1
+    assert all(m is models[0] for m in models)
+    assert registry.entries["models/v1"].references == 4
+
+
+def test_unload_idle(registry):
+    registry.acquire("models/v1")
+    registry.acquire("models/v2")
+    registry.release("models/v1")
+
+    assert registry.unload_idle(max_idle=60) == []
+    assert registry.unload_idle() == ["models/v1"]
+
+    registry.acquire("models/v1")
+    assert DummyModel.loads == 3
+
+
+def test_failed_load_is_retried(registry):
+    with pytest.raises(OSError):
+        registry.acquire("broken")
+    with pytest.raises(OSError):
+        registry.acquire("broken")
+    assert DummyModel.loads == 2
+    assert "broken" not in registry.entries
+
+
+def test_vocabulary_table(tmp_path):
+    word_index = {f"ord{i}": i for i in range(1, 1000)}
+    word_index.update({"æble": 1000, "søg": 1001, "x": 1002})
+    pickle_path = tmp_path / "word_index.pickle"
+    with open(pickle_path, 'wb') as fh:
+        pickle.dump(word_index, fh)
+
+    table = VocabularyTable.from_pickle(str(pickle_path), str(tmp_path / "cache"))
+    assert len(table) == len(word_index)
+    assert all(table.get(token) == i for token, i in word_index.items())
+    assert table.get("ukendt", 0) == 0
+    assert "æble" in table and "æbler" not in table
+
+    # the table is built once and reused
+    assert VocabularyTable.from_pickle(str(pickle_path), str(tmp_path / "cache")).path == table.path
+    assert len(list((tmp_path / "cache").iterdir())) == 1
@@ -1,5 +1,5 @@
 import pytest
-from classification.rule_engine import RuleEngine
+from classification.rule_engine import RuleEngine, needs_full_attachment_text
 
 
 class DummySender:
@@ -113,3 +113,110 @@ def test_multi_condition_rule(rule_type, condition1, condition2, item_params, sh
     if should_apply:
         assert return_value == return_address
         assert r.name == rule_name
+
+
+def test_first_matching_rule_wins_with_overlapping_tokens():
+    rule_engine = RuleEngine()
+    rule_engine.add_rule("SubjectContainsRule", token="katte", return_value="first", name="first")
+    rule_engine.add_rule("AnyTextContainsRule", token="kat", return_value="second", name="second")
+    rule_engine.add_rule("AnyTextContainsRule", token="hund", return_value="third", name="third")
+
+    applies, return_value, r = rule_engine.execute(DummyItem("Må jeg købe en kat?", "og en hund"))
+    assert applies and return_value == "second"
+
+    applies, return_value, r = rule_engine.execute(DummyItem("Må jeg købe to KATTE?", "og en hund"))
+    assert applies and return_value == "first"
+
+
+@pytest.mark.parametrize("pattern,should_apply", [
+    (r"\d{5}", True),
+    (r"(\d{3}) \1", True),
+    (r"^jeg", True),
+    (r"^har", False),
+    (r"(?i)ABE", True),
+])
+def test_regex_rule_among_other_patterns(pattern, should_apply):
+    rule_engine = RuleEngine()
+    rule_engine.add_rule("AnyTextRegEx", pattern=r"kat\d", return_value="kat@adresse.dk")
+    rule_engine.add_rule("AnyTextRegEx", pattern=pattern, return_value="abe@adresse.dk")
+    rule_engine.add_rule("AnyTextRegEx", pattern=r"\d{2}", return_value="tal@adresse.dk")
+
+    applies, return_value, r = rule_engine.execute(DummyItem("Jeg har 12345 aber", "og 123 123 abe"))
+    assert applies
+    assert return_value == ("abe@adresse.dk" if should_apply else "tal@adresse.dk")
+
+
+@pytest.mark.parametrize("token,subject,should_apply", [
+    ("købe en kat", "Må jeg KØBE EN KAT?", True),
+    ("købe en kat", "Må jeg købe\nen kat?", False),
+    ("købe en kat", "Må jeg købe  en kat?", False),
+])
+def test_contains_rule_is_lower_case_substring(token, subject, should_apply):
+    rule_engine = RuleEngine()
+    rule_engine.add_rule("SubjectContainsRule", token=token, return_value="kat@adresse.dk")
+    applies, return_value, r = rule_engine.execute(DummyItem(subject))
+    assert applies == should_apply
+
+
+class MemoizedItem(DummyItem):
+    """Item that keeps its lower cased texts, like PreprocessedItem. Records which texts are lower cased."""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.lowered = []
+
+    def lower_text(self):
+        self.lowered.append('anytext')
+        return self.extract_text().lower()
+
+    def lower_subject(self):
+        self.lowered.append('subject')
+        return self.subject.lower()
+
+    def lower_body(self):
+        self.lowered.append('body')
+        return self.body.lower()
+
+    def lower_attachment_texts(self):
+        self.lowered.append('attachments')
+        return [at.lower() for at in self.attachment_texts]
+
+
+def test_rules_use_lower_cased_texts_of_item():
+    rule_engine = RuleEngine()
+    rule_engine.add_rule("BodyContainsRule", token="HUND", return_value="hund@adresse.dk")
+    rule_engine.add_rule("AnyTextRegEx", pattern=r"\d{5}", return_value="tal@adresse.dk")
+
+    item = MemoizedItem("Emne", "Jeg har en hund", ["12345"])
+    applies, return_value, r = rule_engine.execute(item)
+    assert applies and return_value == "hund@adresse.dk"
+    # the body is needed by the first rule and scanned once, the other fields are never lower cased
+    assert item.lowered == ['body']
+
+
+@pytest.mark.parametrize("rules,needs_full_text", [
+    ([{"rule_type": "SubjectContainsRule", "token": "kat", "return_value": "kat@adresse.dk"}], False),
+    ([{"rule_type": "AttachmenttextContainsRule", "token": "kat", "return_value": "kat@adresse.dk"}], True),
+    ([{"rule_type": "AnyTextRegEx", "pattern": r"\d{5}", "return_value": "kat@adresse.dk"}], True),
+    ([{"rule_type": "AnyTextRegEx", "pattern": r"\d{5}", "return_value": "kat@adresse.dk", "full_text": False}], False),
+    ([{"rule_type": "AndRule", "return_value": "kat@adresse.dk",
+       "condition1": {"condition_type": "SenderEquals", "token": "kat@gmail.com"},
+       "condition2": {"condition_type": "AttachmentTextContains", "token": "kat"}}], True),
+    ([{"rule_type": "OrRule", "return_value": "kat@adresse.dk",
+       "condition1": {"condition_type": "SenderEquals", "token": "kat@gmail.com"},
+       "condition2": {"condition_type": "BodyContains", "token": "kat"}}], False),
+])
+def test_rules_on_attachment_text_need_full_text(rules, needs_full_text):
+    assert needs_full_attachment_text(rules) == needs_full_text
+
+
+def test_rules_can_be_built_again_from_configuration():
+    rule = {"rule_type": "AndRule", "return_value": "hund@adresse.dk",
+            "condition1": {"condition_type": "SubjectContains", "token": "hund"},
+            "condition2": {"condition_type": "SenderEquals", "token": "hund@gmail.com"}}
+    for _ in range(2):
+        rule_engine = RuleEngine()
+        rule_engine.add_rule(**rule)
+        applies, return_value, r = rule_engine.execute(DummyItem("En hund", "", [], "hund@gmail.com"))
+        assert applies and return_value == "hund@adresse.dk"
+    assert needs_full_attachment_text([rule]) is False
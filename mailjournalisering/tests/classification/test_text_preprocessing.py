@@ -0,0 +1,52 @@
+import random
+import re
+import string
+import pytest
+from classification.text_preprocessing import preprocess_text, texts_to_ids
+
+
+def _clean_numbers(x):
+    x = re.sub('[0-9]{5,}', '#####', x)
+    x = re.sub('[0-9]{4}', '####', x)
+    x = re.sub('[0-9]{3}', '###', x)
+    x = re.sub('[0-9]{2}', '##', x)
+    return x
+
+
+def reference_preprocess_text(text):
+    """The preprocessing of Model before it was rewritten, with the regex of the nltk RegexpTokenizer"""
+    text = re.sub(r"<.*?>", " ", text)
+    text = re.sub(r"\[.*?\]", " ", text)
+    text = re.sub(r"[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+", "EMAILTOKEN", text)
+    text = text.translate(str.maketrans(string.punctuation, ' ' * len(string.punctuation)))
+    text = _clean_numbers(text)
+    text = text.lower()
+    return re.findall(r'\w+|\S+', text, flags=re.UNICODE | re.MULTILINE | re.DOTALL)
+
+
+@pytest.mark.parametrize("text,tokens", [
+    ("Jeg skal bruge et nyt job, tak!", ["jeg", "skal", "bruge", "et", "nyt", "job", "tak"]),
+    ("Sag 1 12 123 1234 12345 1234567", ["sag", "1", "##", "###", "####", "#####", "#####"]),
+    ("Skriv til kim@kommune.dk <b>nu</b> [1]", ["skriv", "til", "emailtoken", "nu"]),
+    ("Tlf.: 86 12-34 56", ["tlf", "##", "##", "##", "##"]),
+    ("", []),
+])
+def test_golden_tokens(text, tokens):
+    assert preprocess_text(text) == tokens
+    assert reference_preprocess_text(text) == tokens
+
+
+def test_same_tokens_as_reference():
+    random.seed(0)
+    alphabet = list("abcæøåÆØÅΣ 0123456789<>[]@.-_\n\t!,#") + [" ", "kommune", "kim@kommune.dk"]
+    for _ in range(2000):
+        text = "".join(random.choice(alphabet) for _ in range(random.randint(0, 200)))
+        for chunk_size in [1, 7, 4096]:
+            assert preprocess_text(text, max_tokens=None, chunk_size=chunk_size) == reference_preprocess_text(text)
+            assert preprocess_text(text, max_tokens=10, chunk_size=chunk_size) == reference_preprocess_text(text)[:10]
+
+
+def test_texts_to_ids():
+    word_index = {"jeg": 1, "skal": 2, "#####": 3}
+    assert texts_to_ids(["Jeg skal 12345", "ukendt jeg"], word_index) == [[1, 2, 3], [0, 1]]
+    assert texts_to_ids(["jeg " * 2000], word_index) == [[1] * 1000]
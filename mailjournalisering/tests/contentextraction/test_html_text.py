@@ -0,0 +1,22 @@
+import pytest
+from contentextraction.html_text import html_to_text, plain_text
+
+MAIL = '<html><head><meta http-equiv="Content-Type" content="text/html; charset=iso-8859-1">' \
+       '<style>p {color: red}</style></head><body><div>Hej&nbsp;med&amp;dig<br>linje 2</div>' \
+       '<p>Vh <b>Kim</b></p><table><tr><td>a</td><td>b</td></tr></table><!-- skjult -->' \
+       '<script>var x = "<p>";</script>æøå</body></html>'
+
+
+@pytest.mark.parametrize("content", [MAIL, MAIL.encode('iso-8859-1')])
+def test_html_to_text(content):
+    assert html_to_text(content) == "Hej med&dig linje 2 Vh Kim a b æøå"
+
+
+@pytest.mark.parametrize("content", ["", "<p>\r\n </p>", b""])
+def test_no_text(content):
+    assert html_to_text(content) == " "
+
+
+def test_plain_text():
+    assert plain_text("Hej\r\n\r\n  med dig\t") == "Hej med dig"
+    assert plain_text("a < b og c<d") == "a < b og c<d"
@@ -0,0 +1,47 @@
+import pytest
+from contentextraction.text_cache import TextCache
+
+
+@pytest.fixture()
+def text_cache(tmp_path):
+    return TextCache(str(tmp_path), max_bytes=100, max_entries=3)
+
+
+def test_hit_and_miss(text_cache):
+    key = TextCache.key(b"%PDF-1.4 some pdf content")
+    assert text_cache.get(key) is None
+    text_cache.put(key, "some pdf content")
+    assert text_cache.get(key) == "some pdf content"
+    assert text_cache.hits == 1
+    assert text_cache.misses == 1
+
+
+def test_key_is_content_addressed():
+    assert TextCache.key(b"abc") == TextCache.key("abc")
+    assert TextCache.key(b"abc") != TextCache.key(b"abd")
+
+
+def test_evict_least_recently_used_entry(text_cache):
+    for i in range(3):
+        text_cache.put(str(i), f"text {i}")
+
+    # use entry 0, so entry 1 is the least recently used
+    assert text_cache.get("0") == "text 0"
+    text_cache.put("3", "text 3")
+
+    assert text_cache.get("1") is None
+    assert text_cache.get("0") == "text 0"
+    assert text_cache.get("3") == "text 3"
+
+
+def test_evict_on_size(text_cache):
+    text_cache.put("a", 60 * "a")
+    text_cache.put("b", 60 * "b")
+    assert text_cache.get("a") is None
+    assert text_cache.get("b") == 60 * "b"
+    assert text_cache.total_bytes == 60
+
+
+def test_reload_from_disk(tmp_path):
+    TextCache(str(tmp_path)).put("a", "text a")
+    assert TextCache(str(tmp_path)).get("a") == "text a"
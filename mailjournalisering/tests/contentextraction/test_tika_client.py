@@ -0,0 +1,135 @@
+import http.server
+import json
+import socket
+import socketserver
+import threading
+import time
+import requests
+import pytest
+from contentextraction.tika_client import TikaClient, TikaUnavailableError
+
+
+class StubTikaHandler(http.server.BaseHTTPRequestHandler):
+    """Answers /rmeta/text with the uploaded text as content and an embedded document. A server that hangs, and any
+    server with the text 'slow', answers after 0.5 seconds."""
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+        self.server.requests += 1
+        if body == "slow" or self.server.hanging:
+            time.sleep(0.5)
+        self._reply([{"Content-Type": "application/pdf", "X-TIKA:content": body},
+                     {"Content-Type": "image/png", "X-TIKA:content": " embedded"}])
+
+    def do_GET(self):
+        self._reply("This is Tika Server")
+
+    def _reply(self, obj):
+        data = json.dumps(obj).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubTikaServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture()
+def stub_servers():
+    servers = []
+    for _ in range(2):
+        server = StubTikaServer(('127.0.0.1', 0), StubTikaHandler)
+        server.requests = 0
+        server.hanging = False
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    yield servers
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def _url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def _unused_url():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return f"http://127.0.0.1:{s.getsockname()[1]}"
+
+
+def test_from_buffer_like_tika_parser(stub_servers):
+    client = TikaClient([_url(stub_servers[0])])
+    parsed = client.from_buffer(b"some pdf text")
+    assert parsed['status'] == 200
+    assert parsed['content'] == "some pdf text embedded"
+    assert parsed['metadata']['Content-Type'] == ["application/pdf", "image/png"]
+
+
+def test_round_robin(stub_servers):
+    client = TikaClient([_url(s) for s in stub_servers])
+    for _ in range(4):
+        client.from_buffer(b"text")
+    assert [s.requests for s in stub_servers] == [2, 2]
+
+
+def test_skip_endpoint_that_is_down(stub_servers):
+    client = TikaClient([_unused_url(), _url(stub_servers[0])], failure_threshold=2, reset_timeout=60,
+                        connect_timeout=1)
+    for _ in range(4):
+        assert client.from_buffer(b"text")['content'] == "text embedded"
+
+    assert client.endpoints[0].is_open()
+    assert stub_servers[0].requests == 4
+
+
+def test_health_check_closes_circuit(stub_servers):
+    client = TikaClient([_url(stub_servers[0])], failure_threshold=1, reset_timeout=0)
+    client.endpoints[0].failure()
+    assert client.endpoints[0].is_open()
+
+    assert client.from_buffer(b"text")['content'] == "text embedded"
+    assert not client.endpoints[0].is_open()
+
+
+def test_no_endpoint_available():
+    client = TikaClient([_unused_url()], failure_threshold=1, reset_timeout=60, connect_timeout=1)
+    with pytest.raises(TikaUnavailableError):
+        client.from_buffer(b"text")
+    with pytest.raises(TikaUnavailableError):
+        client.from_buffer(b"text")
+
+
+def test_str_is_sent_as_utf8(stub_servers):
+    client = TikaClient([_url(stub_servers[0])])
+    assert client.from_buffer("Faktura på 100 € – betalt")['content'] == "Faktura på 100 € – betalt embedded"
+
+
+def test_slow_document_is_not_retried(stub_servers):
+    client = TikaClient([_url(s) for s in stub_servers], timeout=0.2, failure_threshold=2)
+    with pytest.raises(requests.ReadTimeout):
+        client.from_buffer(b"slow")
+
+    # the slow document is not tried on the other endpoint, and a single timeout does not open the circuit
+    assert sum(s.requests for s in stub_servers) == 1
+    assert not any(e.is_open() for e in client.endpoints)
+    assert client.from_buffer(b"text")['content'] == "text embedded"
+
+
+def test_endpoint_that_hangs_is_skipped(stub_servers):
+    stub_servers[0].hanging = True
+    client = TikaClient([_url(s) for s in stub_servers], timeout=0.2, failure_threshold=1, reset_timeout=60)
+    with pytest.raises(requests.ReadTimeout):
+        client.from_buffer(b"text")
+
+    # the timeout opened the circuit of the endpoint, so the following requests go to the other endpoint
+    assert client.endpoints[0].is_open()
+    for _ in range(3):
+        assert client.from_buffer(b"text")['content'] == "text embedded"
+    assert stub_servers[0].requests == 1 and stub_servers[1].requests == 3
@@ -3,6 +3,7 @@ from dataaccess.sql_logger import SQLLogger
 import sqlite3
 import datetime
 import os
+import time
 
 @pytest.fixture()
 def connection():
@@ -66,3 +67,172 @@ def test_log_entry(connection_mock):
     assert len(res) == 1
     for table_val, data_val in zip(res[0][1:], data_tuple):
         assert str(table_val) == str(data_val)
+
+
+def _data_tuple(message_id):
+    return (message_id,
+            datetime.datetime.now(),
+            datetime.datetime.now(),
+            datetime.datetime.now(),
+            "sender@email.com",
+            "classification@domain.com",
+            0.42,
+            "model_call_type",
+            "Email body string",
+            0.9,
+            "default_sorting_threshold",
+            "classification@domain.com",
+            0,
+            "modelversion42")
+
+
+def test_queue_entry_flush(connection_mock):
+    connection_mock, connection = connection_mock
+    logger = SQLLogger(table="auditlog", buffer_size=10, flush_interval=3600)
+    for i in range(3):
+        logger.queue_entry(*_data_tuple(f"messageid{i}"))
+
+    # nothing is inserted before the buffer is flushed
+    assert connection.execute("select count(*) from auditlog").fetchone()[0] == 0
+
+    logger.flush()
+    res = connection.execute("select message_id from auditlog order by message_id").fetchall()
+    assert [r[0] for r in res] == ["messageid0", "messageid1", "messageid2"]
+    assert logger.buffer == []
+
+
+def test_queue_entry_flush_on_buffer_size(connection_mock):
+    connection_mock, connection = connection_mock
+    logger = SQLLogger(table="auditlog", buffer_size=2, flush_interval=3600)
+    logger.queue_entry(*_data_tuple("messageid0"))
+    logger.queue_entry(*_data_tuple("messageid1"))
+
+    assert connection.execute("select count(*) from auditlog").fetchone()[0] == 2
+
+
+class Row:
+    def __init__(self, *values, **fields):
+        self.values = values
+        self.__dict__.update(fields)
+
+    def __getitem__(self, i):
+        return self.values[i]
+
+
+class RecordingCursor:
+    """Cursor that records the statements and returns the rows in results for the statements starting with a key"""
+
+    def __init__(self, results):
+        self.results = results
+        self.statements = []
+        self.rows = []
+        self.fast_executemany = False
+        self.fail_insert = False
+
+    def execute(self, statement, *params):
+        self.statements.append(" ".join(statement.split()))
+        self.rows = next((rows for key, rows in self.results.items() if statement.strip().startswith(key)), [])
+        return self
+
+    def executemany(self, statement, rows):
+        self.statements.append(statement)
+        self.inserted = list(rows)
+        self.inserted_fast = self.fast_executemany
+        if self.fail_insert:
+            raise ConnectionError("insert failed")
+
+    def fetchall(self):
+        return self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+@pytest.fixture()
+def recording_cursor(mocker):
+    columns = [Row(name=name, data_type=data_type, max_length=max_length, is_nullable=True)
+               for name, data_type, max_length in [("message_id", "nvarchar", 1000), ("text", "varchar", -1)]]
+    cursor = RecordingCursor({"select col.name": columns})
+    connection = mocker.Mock()
+    connection.cursor.return_value = cursor
+    mocker.patch("pyodbc.connect", return_value=connection)
+    return cursor
+
+
+class Item:
+    def __init__(self, id, received_time):
+        self.id = id
+        self.received_time = received_time
+
+
+def test_contains_items(recording_cursor):
+    logger = SQLLogger(table="auditlog")
+    recording_cursor.results["SELECT DISTINCT c.idx"] = [Row(0), Row(2)]
+    t = datetime.datetime(2020, 6, 1, 12)
+    items = [Item("a", t), Item("b", t), Item("c", t)]
+
+    assert logger.contains_items(items, 42) == [True, False, True]
+    assert recording_cursor.inserted == [(0, "a", t), (1, "b", t), (2, "c", t)]
+
+    # the candidates have the type of the auditlog column and the collation of the database, not the one of tempdb
+    create = next(s for s in recording_cursor.statements if s.startswith("CREATE TABLE #candidates"))
+    assert "message_id nvarchar(500) COLLATE DATABASE_DEFAULT NOT NULL" in create
+    assert logger._column_type("text") == "varchar(max)"
+
+
+def test_fast_executemany_is_only_used_for_bulk_insert(recording_cursor):
+    logger = SQLLogger(table="auditlog")
+    t = datetime.datetime(2020, 6, 1, 12)
+    logger.contains_items([Item("a", t)], 42)
+    assert recording_cursor.inserted_fast and not recording_cursor.fast_executemany
+
+    # the setting is restored when the insert fails too
+    recording_cursor.fail_insert = True
+    with pytest.raises(ConnectionError):
+        logger._insert_many_into("INSERT INTO #candidates VALUES (?, ?, ?)", [(0, "a", t)])
+    assert recording_cursor.inserted_fast and not recording_cursor.fast_executemany
+
+
+def test_contains_items_without_items(recording_cursor):
+    logger = SQLLogger(table="auditlog")
+    statements = len(recording_cursor.statements)
+    assert logger.contains_items([], 42) == []
+    assert len(recording_cursor.statements) == statements
+
+
+def test_get_processed_items(recording_cursor):
+    logger = SQLLogger(table="auditlog")
+    newest, oldest = datetime.datetime(2020, 6, 2), datetime.datetime(2020, 6, 1)
+    recording_cursor.results["SELECT TOP (?) message_id"] = [Row(message_id="b", timestamp_email=newest),
+                                                             Row(message_id="a", timestamp_email=oldest)]
+
+    # rows are returned newest first, the items are oldest first
+    assert logger.get_processed_items(42, since=oldest) == [("a", oldest), ("b", newest)]
+
+
+def test_queue_entry_flush_on_timer(mocker, tmp_path):
+    # the timer inserts from another thread
+    connection = sqlite3.connect(str(tmp_path / "test.db"), check_same_thread=False)
+    connection.execute("CREATE TABLE auditlog(message_id varchar(500), timestamp_in datetime2(7), "
+                       "timestamp_out datetime2(7), timestamp_email datetime2(7), sender varchar(100), "
+                       "classification varchar(100), confidence float, call_type varchar(50), text varchar(5100), "
+                       "sorting_threshold float, sorting_threshold_type varchar(500), model_classification varchar(100), "
+                       "customerID int, model_version varchar(32))")
+    mocker.patch("pyodbc.connect", return_value=connection)
+    mocker.patch("dataaccess.sql_logger.SQLLogger._set_column_properties")
+    mocker.patch("dataaccess.sql_logger.SQLLogger.preprocessvalues", lambda x, *args: args)
+
+    logger = SQLLogger(table="auditlog", buffer_size=10, flush_interval=0.2)
+    logger.queue_entry(*_data_tuple("messageid0"))
+    assert connection.execute("select count(*) from auditlog").fetchone()[0] == 0
+
+    # flushed without more entries being queued
+    time.sleep(0.5)
+    assert connection.execute("select count(*) from auditlog").fetchone()[0] == 1
+    assert logger.buffer == [] and logger.flush_timer is None
+
+    # a new timer for the next entries
+    logger.queue_entry(*_data_tuple("messageid1"))
+    time.sleep(0.5)
+    assert connection.execute("select count(*) from auditlog").fetchone()[0] == 2
+    connection.close()
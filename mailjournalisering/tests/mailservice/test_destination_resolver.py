@@ -0,0 +1,63 @@
+import pytest
+from mailservice.destination_resolver import DestinationResolver
+
+
+class DummyFolder:
+    def __init__(self, path):
+        self.path = path
+        self.id = 'id:' + path
+
+    def __truediv__(self, name):
+        return DummyFolder(f"{self.path}/{name}")
+
+
+class DummyAccount:
+    created = []
+
+    def __init__(self, primary_smtp_address, **kwargs):
+        DummyAccount.created.append(primary_smtp_address)
+        self.root = type('Root', (), {'tois': DummyFolder(primary_smtp_address)})()
+        self.inbox = DummyFolder(primary_smtp_address + '/Inbox')
+
+
+DESTINATIONS = [{'method': 'move', 'folderparts': ['Sager', 'Byg'], 'mailbox': 'post@kommune.dk'},
+                {'method': 'copy', 'folderparts': ['Sager', 'Miljø'], 'mailbox': 'Post@kommune.dk'},
+                {'method': 'move', 'folderparts': ['Inbox'], 'mailbox': 'borger@kommune.dk'},
+                {'method': 'forward', 'folderparts': '', 'mailbox': 'a@kommune.dk'},
+                {'method': 'copy', 'folderparts': ['Sager', 'Byg'], 'mailbox': 'post@kommune.dk'}]
+
+
+@pytest.fixture()
+def executor_account(mocker):
+    DummyAccount.created = []
+    mocker.patch("exchangelib.Account", DummyAccount)
+    return type('Account', (), {'protocol': type('Protocol', (), {'config': None})()})()
+
+
+def test_resolve_all(executor_account):
+    resolver = DestinationResolver(executor_account)
+    folders = resolver.resolve_all(DESTINATIONS)
+
+    assert [f if f == 'n/a' else f.path for f in folders] == ['post@kommune.dk/Sager/Byg',
+                                                               'post@kommune.dk/Sager/Miljø',
+                                                               'borger@kommune.dk/Inbox', 'n/a',
+                                                               'post@kommune.dk/Sager/Byg']
+    # an account per mailbox and a folder per path
+    assert len(DummyAccount.created) == 2
+    assert folders[0] is folders[4]
+
+
+def test_folder_map_is_persisted(executor_account, tmp_path):
+    folder_map_path = str(tmp_path / "folders.json")
+    DestinationResolver(executor_account, folder_map_path=folder_map_path).resolve_all(DESTINATIONS)
+    DummyAccount.created = []
+
+    # resolved by id without creating accounts
+    resolver = DestinationResolver(executor_account, folder_map_path=folder_map_path)
+    folders = resolver.resolve_all(DESTINATIONS)
+    assert DummyAccount.created == []
+    assert folders[0].id == 'id:post@kommune.dk/Sager/Byg'
+
+    # a stale id is resolved again by path
+    assert resolver.refresh('post@kommune.dk', ['Sager', 'Byg']).path == 'post@kommune.dk/Sager/Byg'
+    assert DummyAccount.created == ['post@kommune.dk']
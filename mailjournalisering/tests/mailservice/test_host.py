@@ -0,0 +1,172 @@
+import threading
+import time
+import pytest
+from mailservice.host import MailCheckHost
+
+
+class DummyMonitor:
+    def exception(self, message):
+        pass
+
+
+class DummyService:
+    """Service whose polls are recorded, customer 'failing' fails and customer 'busy' always has more items"""
+    polls = []
+    lock = threading.Lock()
+
+    def __init__(self, config):
+        if config["CUSTOMERID"] == "broken":
+            raise ConnectionError("Exchange is down")
+        self.config = config
+        self.terminated_event = threading.Event()
+
+    def setup(self):
+        pass
+
+    def poll_once(self, max_items=None):
+        with self.lock:
+            self.polls.append(self.config["CUSTOMERID"])
+        if self.config["CUSTOMERID"] == "failing":
+            raise RuntimeError("poll failed")
+        time.sleep(0.01)
+        return self.config["CUSTOMERID"] != "busy"
+
+    def has_notifications(self):
+        return False
+
+    def teardown(self):
+        pass
+
+
+def _config(customer_id):
+    return {"CUSTOMERID": customer_id, "SLEEP_DURATION": 0.2, "MONITOR": DummyMonitor(), "DATABASE_URI": "db",
+            "DATABASE_NAME": "db", "AUDIT_LOG_TABLE_NAME": "auditlog", "DATABASE_USER_NAME": "user"}
+
+
+@pytest.fixture()
+def host(mocker):
+    DummyService.polls = []
+    mocker.patch("mailservice.host.MailCheckService", DummyService)
+    mocker.patch("mailservice.host.create_auditlog", side_effect=lambda config: object())
+
+    configs = {cid: _config(cid) for cid in ["idle", "busy", "failing", "broken"]}
+    host = MailCheckHost(configs, workers=2, audit_log_connections=2, max_backoff=60)
+    host.start()
+    time.sleep(1)
+    host.terminated_event.set()
+    host.join()
+    return host
+
+
+def test_failing_customers_are_isolated(host):
+    polls = DummyService.polls
+    assert polls.count("idle") >= 3
+    # polled again with backoff, 0.4 and 0.8 seconds
+    assert 1 <= polls.count("failing") <= 3
+    assert "broken" not in polls
+
+
+def test_busy_customer_is_polled_again_without_holding_back_others(host):
+    polls = DummyService.polls
+    assert polls.count("busy") > polls.count("idle")
+    # the idle customer is polled while the busy customer still has items
+    last_idle = max(i for i, cid in enumerate(polls) if cid == "idle")
+    assert any(cid == "busy" for cid in polls[last_idle:])
+
+
+def test_auditlog_connections_are_shared(host):
+    auditlogs = [c.config["AUDIT_LOG"] for c in host.customers]
+    assert len(set(map(id, auditlogs))) == 2
+    assert sorted(sum(a is b for b in auditlogs) for a in auditlogs) == [2, 2, 2, 2]
+
+
+def test_unreachable_database_only_fails_its_customers(mocker):
+    DummyService.polls = []
+    mocker.patch("mailservice.host.MailCheckService", DummyService)
+    created = []
+
+    def create_auditlog(config):
+        created.append(config["CUSTOMERID"])
+        if config["DATABASE_URI"] == "down":
+            raise ConnectionError("database is down")
+        return object()
+
+    mocker.patch("mailservice.host.create_auditlog", side_effect=create_auditlog)
+    configs = {cid: _config(cid) for cid in ["idle", "other_db", "slow_flush"]}
+    configs["other_db"]["DATABASE_URI"] = "down"
+    configs["slow_flush"]["AUDIT_LOG_FLUSH_INTERVAL"] = 300
+
+    # no database is connected before the first polls
+    host = MailCheckHost(configs, workers=2, audit_log_connections=2, max_backoff=60)
+    assert created == []
+    host.start()
+    time.sleep(1)
+    host.terminated_event.set()
+    host.join()
+
+    assert DummyService.polls.count("idle") >= 3 and DummyService.polls.count("slow_flush") >= 3
+    assert "other_db" not in DummyService.polls
+    # the database is tried again with backoff
+    assert created.count("other_db") >= 2
+    # customers with other auditlog settings do not share auditlogs
+    assert host.customers[0].config["AUDIT_LOG"] is not host.customers[2].config["AUDIT_LOG"]
+
+
+class NotifiedService(DummyService):
+    """Service that always has notifications on new items if NOTIFIED is set"""
+
+    def has_notifications(self):
+        return "NOTIFIED" in self.config
+
+
+def test_customers_with_notifications_are_polled_before_due(mocker):
+    DummyService.polls = []
+    mocker.patch("mailservice.host.MailCheckService", NotifiedService)
+    mocker.patch("mailservice.host.create_auditlog", side_effect=lambda config: object())
+
+    configs = {cid: dict(_config(cid), SLEEP_DURATION=60) for cid in ["notified", "failing", "idle"]}
+    configs["notified"]["NOTIFIED"] = True
+    configs["failing"]["NOTIFIED"] = True
+    host = MailCheckHost(configs, workers=2)
+    host.start()
+    time.sleep(1)
+    host.terminated_event.set()
+    host.join()
+
+    polls = DummyService.polls
+    assert polls.count("notified") >= 3
+    # a failing customer waits for its backoff, also if it has notifications
+    assert polls.count("failing") == 1
+    assert polls.count("idle") == 1
+
+
+class SetupFailingService(DummyService):
+    """Service whose setup fails, services that are torn down are recorded"""
+    torn_down = []
+
+    def setup(self):
+        raise ConnectionError("model storage is down")
+
+    def teardown(self):
+        self.torn_down.append(self)
+
+
+def test_service_is_torn_down_if_setup_fails(mocker):
+    DummyService.polls = []
+    SetupFailingService.torn_down = []
+    created = []
+    mocker.patch("mailservice.host.MailCheckService",
+                 side_effect=lambda config: created.append(SetupFailingService(config)) or created[-1])
+    mocker.patch("mailservice.host.create_auditlog", side_effect=lambda config: object())
+
+    host = MailCheckHost({"setup_failing": dict(_config("setup_failing"), SLEEP_DURATION=0.1)}, max_backoff=0.1)
+    host.start()
+    time.sleep(0.5)
+    host.terminated_event.set()
+    host.join()
+
+    # a service is created for each retry, and each is torn down with its threads stopped
+    assert len(created) >= 2
+    assert SetupFailingService.torn_down == created
+    assert all(service.terminated_event.is_set() for service in created)
+    assert host.customers[0].service is None
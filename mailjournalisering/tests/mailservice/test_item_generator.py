@@ -0,0 +1,100 @@
+import exchangelib as ews
+import pytest
+from mailservice.mailservices import item_generator, ErrorDuringMailRetrieving
+
+UTC = ews.EWSTimeZone('UTC')
+
+
+class DummyMonitor:
+    def __init__(self):
+        self.exceptions = []
+
+    def exception(self, message):
+        self.exceptions.append(message)
+
+    def email_trace(self, item, message):
+        pass
+
+
+class DummyProcessedItems:
+    def contains_items(self, items):
+        return [item.id.startswith('processed') for item in items]
+
+
+class DummyFolder:
+    """Folder whose account.fetch records the ids of each request. Item 'gone' is not found and a request with item
+    'down' fails as a whole."""
+
+    name = 'Indbakke'
+
+    def __init__(self, item_ids):
+        self.account = self
+        self.primary_smtp_address = 'post@kommune.dk'
+        self.default_timezone = UTC
+        self.items = [_item(item_id) for item_id in item_ids]
+        self.fetches = []
+        self.gets = []
+
+    def refresh(self):
+        pass
+
+    def all(self):
+        return self
+
+    def only(self, *fields):
+        return list(self.items)
+
+    def get(self, id):
+        self.gets.append(id)
+        return _item(id)
+
+    def fetch(self, ids, folder, only_fields=None):
+        ids = [item.id for item in ids]
+        self.fetches.append(ids)
+        if 'down' in ids:
+            raise ConnectionError("EWS is down")
+        return [ews.errors.ErrorItemNotFound("gone") if i == 'gone' else _item(i) for i in ids]
+
+
+def _item(item_id):
+    return ews.Message(id=item_id, subject=f"subject {item_id}", body="body",
+                       datetime_received=ews.EWSDateTime(2020, 6, 1, 12, tzinfo=UTC))
+
+
+@pytest.fixture()
+def config():
+    return {"MONITOR": DummyMonitor(), "ALLOWED_CONTENT_TYPES": [], "TIME_ZONE": "Europe/Copenhagen",
+            "EMAIL_TIME_ZONE": "UTC", "FETCH_BATCH_SIZE": 2}
+
+
+def _ids(items):
+    return [item.prep_item.id if isinstance(item, ErrorDuringMailRetrieving) else item.id for item in items]
+
+
+def test_new_items_are_fetched_in_batches(config):
+    folder = DummyFolder(['a', 'processed1', 'b', 'c', 'processed2', 'd', 'e'])
+    items = list(item_generator([folder], DummyProcessedItems(), config))
+
+    assert folder.fetches == [['a', 'b'], ['c', 'd'], ['e']]
+    assert folder.gets == []
+    assert _ids(items) == ['a', 'b', 'c', 'd', 'e']
+    assert not any(isinstance(item, ErrorDuringMailRetrieving) for item in items)
+
+
+def test_failed_items_are_errors_in_order(config):
+    folder = DummyFolder(['a', 'gone', 'b', 'down', 'c'])
+    items = list(item_generator([folder], DummyProcessedItems(), config))
+
+    assert _ids(items) == ['a', 'gone', 'b', 'down', 'c']
+    # the item that was not found and both items of the failed request are errors
+    assert [isinstance(item, ErrorDuringMailRetrieving) for item in items] == [False, True, True, True, False]
+    assert len(config["MONITOR"].exceptions) == 3
+
+
+def test_items_are_fetched_one_by_one_without_batch_size(config):
+    del config["FETCH_BATCH_SIZE"]
+    folder = DummyFolder(['a', 'processed1', 'b'])
+    items = list(item_generator([folder], DummyProcessedItems(), config))
+
+    assert folder.fetches == [] and folder.gets == ['a', 'b']
+    assert _ids(items) == ['a', 'b']
@@ -0,0 +1,181 @@
+import json
+import threading
+import time
+import exchangelib as ews
+import pytest
+from mailservice.mail_distributor import MailDistributor
+from mailservice.destination_resolver import DestinationResolver
+
+
+DESTINATIONS = {'fallback': {'method': 'move', 'folderparts': ['Manuel'], 'mailbox': 'post@kommune.dk'},
+                'a': {'method': 'copy', 'folderparts': ['A'], 'mailbox': 'a@kommune.dk'},
+                'b': {'method': 'forward', 'folderparts': '', 'mailbox': 'b@kommune.dk'},
+                'c': {'method': 'copy', 'folderparts': ['C'], 'mailbox': 'c@kommune.dk'},
+                'd': {'method': 'move', 'folderparts': ['D'], 'mailbox': 'd@kommune.dk'},
+                'p': {'method': 'copy', 'folderparts': ['P'], 'mailbox': 'post@kommune.dk'}}
+
+
+class DummyItem:
+    subject = 'subject'
+
+    def __init__(self, id='id'):
+        self.id = id
+
+
+class DummyAccount:
+    """Records bulk calls, items with id 'bad' fail. For a folder in another mailbox only the errors are returned."""
+    primary_smtp_address = 'post@kommune.dk'
+
+    def __init__(self):
+        self.calls = []
+
+    def bulk_copy(self, items, folder):
+        self.calls.append(('bulk_copy', folder, [item.id for item in items]))
+        return self._results(items, folder)
+
+    def bulk_move(self, items, folder):
+        self.calls.append(('bulk_move', folder, [item.id for item in items]))
+        return self._results(items, folder)
+
+    def _results(self, items, folder):
+        if folder.startswith(self.primary_smtp_address):
+            return [ValueError("ErrorItemNotFound") if item.id == 'bad' else (item.id, 'changekey') for item in items]
+        return [ValueError("ErrorItemNotFound") for item in items if item.id == 'bad']
+
+
+@pytest.fixture()
+def distributor(mocker):
+    mocker.patch.object(DestinationResolver, 'resolve_all')
+    mocker.patch.object(MailDistributor, '_validate_destination',
+                        side_effect=lambda dest: (True, '/'.join([dest['mailbox']] + list(dest['folderparts']))))
+    distributor = MailDistributor(DummyAccount(), threading.Event(), mode='production',
+                                  destinations={k: dict(v) for k, v in DESTINATIONS.items()})
+
+    distributor.calls = []
+
+    def record(method):
+        def call(item, target, *args):
+            time.sleep(0.05)
+            distributor.calls.append((method, target, time.time()))
+        return call
+
+    mocker.patch.object(distributor, '_copy_item', side_effect=record('copy'))
+    mocker.patch.object(distributor, '_forward_item', side_effect=record('forward'))
+    mocker.patch.object(distributor, '_move_item', side_effect=record('move'))
+    yield distributor
+    distributor.shutdown()
+
+
+def test_move_after_concurrent_copies_and_forwards(distributor):
+    start = time.time()
+    assert distributor.distribute_to_many(DummyItem(), ['a', 'b', 'c', 'd'])
+
+    methods = [call[0] for call in distributor.calls]
+    assert sorted(methods[:3]) == ['copy', 'copy', 'forward']
+    assert methods[3] == 'move'
+    # the copies and forward run concurrently, then the move
+    assert time.time() - start < 0.15
+
+
+def test_distribute_once_per_destination(distributor):
+    assert distributor.distribute_to_many(DummyItem(), ['a', 'a', 'unknown', 'fallback'])
+    assert [(call[0], call[1]) for call in distributor.calls] == [('copy', 'a@kommune.dk/A'),
+                                                                  ('move', 'post@kommune.dk/Manuel')]
+
+
+def test_no_move_if_copy_fails(distributor, mocker):
+    mocker.patch.object(distributor, '_copy_item', side_effect=ConnectionError("EWS is down"))
+    with pytest.raises(ConnectionError):
+        distributor.distribute_to_many(DummyItem(), ['a', 'b', 'd'])
+    assert [call[0] for call in distributor.calls] == ['forward']
+
+
+def test_distribute_batch_with_a_bulk_call_per_folder(distributor):
+    items = [DummyItem(str(i)) for i in range(4)]
+    keys = ['p', ['p', 'b', 'fallback'], 'fallback', ['c', 'fallback']]
+    assert distributor.distribute_batch(list(zip(items, keys))) == [True] * 4
+
+    calls = sorted(distributor.account.calls)
+    assert calls == [('bulk_copy', 'c@kommune.dk/C', ['3']),
+                     ('bulk_copy', 'post@kommune.dk/P', ['0', '1']),
+                     ('bulk_move', 'post@kommune.dk/Manuel', ['1', '2', '3'])]
+    assert [(call[0], call[1]) for call in distributor.calls] == [('forward', 'b@kommune.dk')]
+
+
+def test_distribute_batch_success_per_item(distributor):
+    items = [DummyItem('bad'), DummyItem('good')]
+    assert distributor.distribute_batch([(item, ['a', 'd']) for item in items]) == [False, True]
+
+    # the item that was not copied is not moved either
+    assert ('bulk_move', 'd@kommune.dk/D', ['good']) in distributor.account.calls
+
+
+@pytest.mark.parametrize("key,method,folder", [('d', 'bulk_move', 'd@kommune.dk/D'),
+                                               ('a', 'bulk_copy', 'a@kommune.dk/A')])
+def test_distribute_batch_partial_failure_in_another_mailbox(distributor, key, method, folder):
+    # the errors of a folder in another mailbox can't be matched to the items, so each item is distributed alone
+    items = [DummyItem('good'), DummyItem('bad'), DummyItem('other')]
+    assert distributor.distribute_batch([(item, key) for item in items]) == [True, False, True]
+    assert distributor.account.calls == [(method, folder, ['good']), (method, folder, ['bad']),
+                                         (method, folder, ['other'])]
+
+
+def test_distribute_batch_partial_failure_in_own_mailbox(distributor):
+    items = [DummyItem('good'), DummyItem('bad'), DummyItem('other')]
+    assert distributor.distribute_batch([(item, 'fallback') for item in items]) == [True, False, True]
+    assert distributor.account.calls == [('bulk_move', 'post@kommune.dk/Manuel', ['good', 'bad', 'other'])]
+
+
+class DummyFolder:
+    def __init__(self, path):
+        self.path = path
+        self.id = 'id:' + path
+
+    def __truediv__(self, name):
+        return DummyFolder(f"{self.path}/{name}")
+
+
+class DummyMailbox:
+    def __init__(self, primary_smtp_address, **kwargs):
+        self.root = type('Root', (), {'tois': DummyFolder(primary_smtp_address)})()
+
+
+class StaleFolderAccount:
+    """Moves and copies to a folder with a stale id fail, as EWS returns the error instead of raising it"""
+    protocol = type('Protocol', (), {'config': None})()
+
+    def __init__(self):
+        self.folders = []
+
+    def bulk_move(self, items, folder):
+        self.folders.append(folder.id)
+        return [ews.errors.ErrorFolderNotFound("stale")] if folder.id == 'stale' else []
+
+    bulk_copy = bulk_move
+
+
+def test_stale_folder_id_is_refreshed(mocker, tmp_path):
+    mocker.patch("exchangelib.Account", DummyMailbox)
+    folder_map_path = tmp_path / "folders.json"
+    folder_map_path.write_text(json.dumps({'d@kommune.dk/D': 'stale', 'post@kommune.dk/Manuel': 'stale'}))
+
+    account = StaleFolderAccount()
+    distributor = MailDistributor(account, threading.Event(), mode='production',
+                                  destinations={k: dict(v) for k, v in DESTINATIONS.items()},
+                                  folder_map_path=str(folder_map_path))
+    refresh = mocker.spy(distributor.resolver, 'refresh')
+    try:
+        with pytest.raises(ews.errors.ErrorFolderNotFound):
+            distributor.distribute(DummyItem(), 'd')
+        refresh.assert_called_once_with('d@kommune.dk', ['D'])
+
+        # the item is distributed to the folder resolved by path, and the new id is persisted
+        assert distributor.distribute(DummyItem(), 'd')
+        assert account.folders == ['stale', 'id:d@kommune.dk/D']
+        assert json.loads(folder_map_path.read_text())['d@kommune.dk/D'] == 'id:d@kommune.dk/D'
+
+        with pytest.raises(ews.errors.ErrorFolderNotFound):
+            distributor.distribute_to_many(DummyItem(), ['a', 'fallback'])
+        refresh.assert_called_with('post@kommune.dk', ['Manuel'])
+    finally:
+        distributor.shutdown()
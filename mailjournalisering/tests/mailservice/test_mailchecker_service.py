@@ -17,4 +17,10 @@ def connection(mocker):
         def __contains__(self, item):
             return False
 
+        def contains_items(self, items):
+            return [False for item in items]
+
+        def add(self, item):
+            pass
+
     mail_distributor = mocker.patch("mailservice.mailservices.processed_item_handler", dummy_processed_item_handler)
\ No newline at end of file
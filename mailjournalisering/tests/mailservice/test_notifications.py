@@ -0,0 +1,202 @@
+import threading
+import time
+import exchangelib as ews
+from exchangelib.properties import Notification, CreatedEvent, MovedEvent, CopiedEvent, DeletedEvent, StatusEvent, \
+    NewMailEvent, ItemId, ParentFolderId
+import pytest
+from mailservice.mailservices import MailCheckService, notified_item_generator
+from mailservice.notifications import StreamingNotificationListener
+
+UTC = ews.EWSTimeZone('UTC')
+
+
+class DummyFolder:
+    """Folder whose streaming connections return the notifications in connections, one list per connection. The
+    listener is terminated when there are no connections left."""
+    id = 'source'
+
+    def __init__(self, connections, terminated_event):
+        self.account = None
+        self.connections = list(connections)
+        self.terminated_event = terminated_event
+        self.subscriptions = []
+        self.unsubscribed = []
+
+    def get_streaming_events(self, subscription_id, connection_timeout=1):
+        self.subscriptions.append(subscription_id)
+        if not self.connections:
+            self.terminated_event.set()
+            return
+        notifications = self.connections.pop(0)
+        if isinstance(notifications, Exception):
+            raise notifications
+        yield from notifications
+
+    def unsubscribe(self, subscription_id):
+        self.unsubscribed.append(subscription_id)
+
+
+def _event(cls, item_id, folder_id='source'):
+    return cls(item_id=ItemId(id=item_id, changekey='ck-' + item_id), parent_folder_id=ParentFolderId(id=folder_id))
+
+
+@pytest.fixture()
+def subscriptions(mocker):
+    """Subscription ids returned by FolderCollection.subscribe_to_streaming, exceptions are returned as errors"""
+    subscriptions = []
+
+    def subscribe_to_streaming(self, event_types):
+        yield subscriptions.pop(0)
+
+    mocker.patch.object(ews.FolderCollection, 'subscribe_to_streaming', subscribe_to_streaming)
+    return subscriptions
+
+
+def test_listener_collects_ids_of_new_items(subscriptions):
+    terminated_event = threading.Event()
+    subscriptions.append('sub-1')
+    folder = DummyFolder([[Notification(events=[_event(CreatedEvent, 'a'), StatusEvent(), NewMailEvent()])],
+                          [Notification(events=[_event(MovedEvent, 'b'), _event(DeletedEvent, 'c')]),
+                           Notification(events=[_event(CopiedEvent, 'd')])]], terminated_event)
+
+    listener = StreamingNotificationListener([folder], terminated_event)
+    listener.run()
+
+    assert folder.subscriptions == ['sub-1'] * 3
+    assert folder.unsubscribed == ['sub-1']
+    assert listener.new_items_event.is_set()
+    assert listener.pop_item_ids() == [('a', 'ck-a'), ('b', 'ck-b'), ('d', 'ck-d')]
+    assert not listener.new_items_event.is_set()
+    assert listener.pop_item_ids() is None
+
+
+def test_listener_ignores_items_moved_or_copied_out_of_source_folders(subscriptions):
+    terminated_event = threading.Event()
+    subscriptions.append('sub-1')
+    # the service moves and copies items to destination folders, the events carry the new ids of the items
+    folder = DummyFolder([[Notification(events=[_event(MovedEvent, 'moved', folder_id='destination'),
+                                                _event(CopiedEvent, 'copied', folder_id='destination'),
+                                                _event(CreatedEvent, 'created', folder_id='other')])]],
+                         terminated_event)
+
+    listener = StreamingNotificationListener([folder], terminated_event)
+    listener.run()
+
+    assert listener.pop_item_ids() is None
+    assert not listener.new_items_event.is_set()
+
+
+def test_listener_subscribes_again_after_errors(subscriptions):
+    terminated_event = threading.Event()
+    subscriptions.extend([ews.errors.ErrorInvalidSubscription("expired"), 'sub-1', 'sub-2'])
+    folder = DummyFolder([ews.errors.ErrorInvalidSubscription("expired"),
+                          [Notification(events=[_event(CreatedEvent, 'a')])]], terminated_event)
+
+    listener = StreamingNotificationListener([folder], terminated_event, retry_sleep=0)
+    listener.run()
+
+    assert folder.subscriptions == ['sub-1', 'sub-2', 'sub-2']
+    assert folder.unsubscribed == ['sub-1', 'sub-2']
+    assert listener.pop_item_ids() == [('a', 'ck-a')]
+
+
+def test_listener_wait_wakes_on_new_items():
+    listener = StreamingNotificationListener([], threading.Event())
+    threading.Timer(0.1, listener.new_items_event.set).start()
+    start = time.time()
+    listener.wait(5)
+    assert time.time() - start < 1
+
+
+class DummyMonitor:
+    def __init__(self):
+        self.heartbeats = 0
+
+    def send_heartbeat(self):
+        self.heartbeats += 1
+
+    def email_trace(self, item, message):
+        pass
+
+
+class DummyListener:
+    def __init__(self):
+        self.item_ids = None
+
+    def pop_item_ids(self):
+        item_ids, self.item_ids = self.item_ids, None
+        return item_ids
+
+
+@pytest.fixture()
+def service():
+    # a service without connections to Exchange or the database, only the scheduling of polls is used
+    service = MailCheckService.__new__(MailCheckService)
+    service.config = {"MONITOR": DummyMonitor()}
+    service.auditlog = type('AuditLog', (), {'flush': lambda self: None})()
+    service.listener = DummyListener()
+    service.fallback_interval = 60
+    service.last_poll = None
+    service.pipeline = service.model_handler = service.time_zone = None
+
+    service.polls = []
+    service.new_full_items = lambda: service.polls.append('full') or []
+    service.notified_full_items = lambda item_ids: service.polls.append(item_ids) or []
+    service._process = lambda full_items, *args: list(full_items)
+    return service
+
+
+def test_poll_notified_items_between_full_polls(service):
+    service.poll_once()
+    service.poll_once()
+    service.listener.item_ids = [('a', 'ck-a')]
+    service.poll_once()
+    assert service.polls == ['full', [('a', 'ck-a')]]
+
+    # a full poll when the fallback interval has passed
+    service.last_poll -= 60
+    service.listener.item_ids = [('b', 'ck-b')]
+    service.poll_once()
+    assert service.polls == ['full', [('a', 'ck-a')], 'full']
+    assert service.config["MONITOR"].heartbeats == 4
+
+
+class DummyProcessedItems:
+    def contains_items(self, items):
+        return [item.id == 'processed' for item in items]
+
+
+class DummyFetchFolder:
+    def __init__(self, items):
+        self.items = {item.id: item for item in items}
+        self.account = self
+        self.fetches = []
+
+    def fetch(self, ids, folder, only_fields=None):
+        self.fetches.append(list(ids))
+        # items moved or deleted since the notification are errors
+        return [self.items[i] if i in self.items else ews.errors.ErrorItemNotFound("gone") for i, _ in ids]
+
+    def get(self, id):
+        return self.items[id]
+
+
+def test_notified_item_generator_skips_processed_and_missing_items():
+    items = [ews.Message(id=i, subject=i, datetime_received=ews.EWSDateTime(2020, 6, 1, 12, tzinfo=UTC))
+             for i in ['new', 'processed']]
+    config = {"MONITOR": DummyMonitor(), "ALLOWED_CONTENT_TYPES": [], "TIME_ZONE": "Europe/Copenhagen",
+              "EMAIL_TIME_ZONE": "UTC"}
+    item_ids = [('new', 'ck'), ('processed', 'ck'), ('gone', 'ck')]
+    full_items = notified_item_generator([DummyFetchFolder(items)], item_ids, DummyProcessedItems(), config)
+    assert [full_item.id for _, full_item in full_items] == ['new']
+
+
+def test_notified_item_generator_fetches_each_item_once():
+    items = [ews.Message(id='new', subject='new', datetime_received=ews.EWSDateTime(2020, 6, 1, 12, tzinfo=UTC))]
+    config = {"MONITOR": DummyMonitor(), "ALLOWED_CONTENT_TYPES": [], "TIME_ZONE": "Europe/Copenhagen",
+              "EMAIL_TIME_ZONE": "UTC"}
+    folder = DummyFetchFolder(items)
+    item_ids = [('new', 'ck1'), ('new', 'ck2')]
+    full_items = notified_item_generator([folder], item_ids, DummyProcessedItems(), config)
+    assert [full_item.id for _, full_item in full_items] == ['new']
+    assert folder.fetches[0] == [('new', 'ck2')]
@@ -0,0 +1,147 @@
+import itertools
+import threading
+import time
+import pytest
+from mailservice.pipeline import ItemPipeline
+
+
+class Stages:
+    """Records the items taken from the input and the batches classified and distributed. A stage sleeps on its first
+    call for the seconds in first_sleep, so the items after it pile up in the queue before it."""
+
+    def __init__(self, items, first_sleep=None):
+        self.items = items
+        self.first_sleep = first_sleep or {}
+        self.fetched = []
+        self.classified = []
+        self.distributed = []
+
+    def input(self):
+        for item in self.items:
+            self.fetched.append(item)
+            yield (item,)
+
+    def preprocess(self, item):
+        return item
+
+    def classify(self, items):
+        self._sleep('classify')
+        self.classified.append(items)
+        return [(item,) for item in items]
+
+    def distribute(self, batch):
+        self._sleep('distribute')
+        self.distributed.append([item for item, in batch])
+
+    def _sleep(self, stage):
+        if stage in self.first_sleep:
+            time.sleep(self.first_sleep.pop(stage))
+
+    def run(self, pipeline):
+        pipeline.run(self.input(), self.preprocess, self.classify, self.distribute)
+
+
+@pytest.fixture()
+def terminated_event():
+    return threading.Event()
+
+
+@pytest.fixture()
+def pipeline(terminated_event):
+    pipeline = ItemPipeline(terminated_event, workers=2, queue_size=4, batch_size=3, distribute_batch_size=4)
+    yield pipeline
+    pipeline.shutdown()
+
+
+def _run_in_thread(stages, pipeline):
+    errors = []
+
+    def run():
+        try:
+            stages.run(pipeline)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, errors
+
+
+def test_items_keep_order(pipeline):
+    stages = Stages(list(range(50)))
+    stages.run(pipeline)
+    assert [item for batch in stages.classified for item in batch] == list(range(50))
+    assert [item for batch in stages.distributed for item in batch] == list(range(50))
+
+
+def test_items_are_classified_and_distributed_in_batches(pipeline):
+    stages = Stages(list(range(20)), first_sleep={'classify': 0.3, 'distribute': 0.3})
+    stages.run(pipeline)
+
+    # the items that pile up while a stage is busy are taken together, up to the batch sizes
+    assert max(len(batch) for batch in stages.classified) == 3
+    assert max(len(batch) for batch in stages.distributed) == 4
+    assert [item for batch in stages.distributed for item in batch] == list(range(20))
+
+
+def test_fetching_is_held_back_by_slow_classification(pipeline):
+    classify_done = threading.Event()
+    stages = Stages(list(range(20)))
+    classify = stages.classify
+
+    def slow_classify(items):
+        classify_done.wait(10)
+        return classify(items)
+
+    stages.classify = slow_classify
+    thread, errors = _run_in_thread(stages, pipeline)
+    time.sleep(0.5)
+    # a batch is being classified, queue_size items wait for it and one is waiting for room in the queue
+    assert len(stages.fetched) <= 3 + 4 + 1
+
+    classify_done.set()
+    thread.join(10)
+    assert not thread.is_alive() and not errors
+    assert len(stages.fetched) == 20
+    assert [item for batch in stages.distributed for item in batch] == list(range(20))
+
+
+def test_terminated_event_stops_pipeline(pipeline, terminated_event):
+    stages = Stages(itertools.count())
+    classify = stages.classify
+
+    def classify_until_terminated(items):
+        if items[-1] >= 10:
+            terminated_event.set()
+        return classify(items)
+
+    stages.classify = classify_until_terminated
+    thread, errors = _run_in_thread(stages, pipeline)
+    thread.join(10)
+    assert not thread.is_alive() and not errors
+    assert len(stages.fetched) < 30
+
+
+def test_fetch_error_is_raised_after_fetched_items(pipeline):
+    def items():
+        yield from range(5)
+        raise ConnectionError("fetch failed")
+
+    stages = Stages(items())
+    with pytest.raises(ConnectionError):
+        stages.run(pipeline)
+    # the items fetched before the error are still processed
+    assert [item for batch in stages.distributed for item in batch] == list(range(5))
+
+
+def test_distribute_error_stops_pipeline(pipeline):
+    stages = Stages(itertools.count())
+
+    def distribute(batch):
+        raise RuntimeError("distribution failed")
+
+    stages.distribute = distribute
+    thread, errors = _run_in_thread(stages, pipeline)
+    thread.join(10)
+    assert not thread.is_alive()
+    assert len(errors) == 1 and isinstance(errors[0], RuntimeError)
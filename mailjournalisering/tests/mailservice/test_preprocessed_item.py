@@ -0,0 +1,250 @@
+import concurrent.futures
+import io
+import time
+import exchangelib as ews
+import pytest
+from exchangelib.attachments import AttachmentId
+from contentextraction.text_cache import TextCache
+from mailservice.preprocessed_item import PreprocessedItem
+
+UTC = ews.EWSTimeZone('UTC')
+
+
+class DummyMonitor:
+    def __init__(self):
+        self.exceptions = []
+
+    def exception(self, message):
+        self.exceptions.append(message)
+
+
+class LazyFuture:
+    """Future that runs its function when the result is read, unless it is cancelled"""
+
+    def __init__(self, executor, fn, args):
+        self.executor = executor
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        return True
+
+    def result(self):
+        assert not self.cancelled
+        self.executor.runs += 1
+        return self.fn(*self.args)
+
+
+class LazyExecutor:
+    def __init__(self):
+        self.futures = []
+        self.runs = 0
+
+    def submit(self, fn, *args):
+        future = LazyFuture(self, fn, args)
+        self.futures.append(future)
+        return future
+
+
+@pytest.fixture()
+def config():
+    return {"ALLOWED_CONTENT_TYPES": ["application/pdf"], "TIME_ZONE": "Europe/Copenhagen", "EMAIL_TIME_ZONE": "UTC",
+            "MONITOR": DummyMonitor()}
+
+
+@pytest.fixture()
+def extracted(mocker):
+    """Content of the attachments is the text, extraction sleeps for the number of seconds after a '|'. Content
+    'fail' raises."""
+    extracted = []
+
+    def get_text(self, byte_string, max_string_length=1e30):
+        if hasattr(byte_string, 'read'):
+            byte_string = byte_string.read()
+        text = byte_string.decode()
+        if text == 'fail':
+            raise ValueError("extraction failed")
+        if '|' in text:
+            text, sleep = text.split('|')
+            time.sleep(float(sleep))
+        extracted.append(text)
+        return text
+
+    mocker.patch.object(PreprocessedItem, '_get_text', get_text)
+    return extracted
+
+
+def _item(*contents, body="krop"):
+    attachments = [ews.FileAttachment(name=f"{i}.pdf", content_type='application/pdf', content=content.encode())
+                   for i, content in enumerate(contents)]
+    return ews.Message(subject="emne", body=body, attachments=attachments,
+                       datetime_received=ews.EWSDateTime(2020, 6, 1, 12, tzinfo=UTC))
+
+
+def test_attachment_texts_keep_order_of_attachments(config, extracted):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        config["ATTACHMENT_EXECUTOR"] = executor
+        item = PreprocessedItem(_item("første|0.3", "anden|0.1", "tredje|0"), config)
+
+    assert extracted == ["tredje", "anden", "første"]
+    assert item.attachment_texts == ["første", "anden", "tredje"]
+
+
+def test_extraction_stops_at_text_budget(config, extracted):
+    executor = LazyExecutor()
+    config["ATTACHMENT_EXECUTOR"] = executor
+    config["MAX_TEXT_CHARS"] = len("emne") + len("krop") + 10
+
+    item = PreprocessedItem(_item("0123456789", "ikke brugt", "heller ikke"), config)
+    assert item.attachment_texts == ["0123456789", " ", " "]
+    assert extracted == ["0123456789"]
+    assert executor.runs == 1
+    assert all(future.cancelled for future in executor.futures[1:])
+
+
+def test_no_extraction_is_started_when_body_fills_budget(config, extracted):
+    executor = LazyExecutor()
+    config["ATTACHMENT_EXECUTOR"] = executor
+    config["MAX_TEXT_CHARS"] = 8
+
+    item = PreprocessedItem(_item("ikke brugt", "heller ikke"), config)
+    assert item.attachment_texts == [" ", " "]
+    assert executor.futures == [] and extracted == []
+
+
+def test_failed_extraction_is_empty_text(config, extracted):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        config["ATTACHMENT_EXECUTOR"] = executor
+        item = PreprocessedItem(_item("første", "fail", "tredje"), config)
+
+    assert item.attachment_texts == ["første", " ", "tredje"]
+    assert config["MONITOR"].exceptions == ["extraction failed"]
+
+
+def test_attributes_are_read_from_item(config, extracted):
+    item = _item("bilag")
+    item.sender = ews.Mailbox(email_address="borger@mail.dk")
+    item.importance = 'High'
+    prep = PreprocessedItem(item, config)
+
+    assert prep.id == item.id and prep.subject == "emne" and prep.sender.email_address == "borger@mail.dk"
+    assert prep.attachments is item.attachments and prep.datetime_received == item.datetime_received
+    # other attributes of the item are found with __getattr__
+    assert prep.importance == 'High'
+    # the received time is converted to the time zone of the customer
+    assert prep.received_time.isoformat() == "2020-06-01T14:00:00+02:00"
+
+    with pytest.raises(AttributeError):
+        prep.no_such_attribute
+    # attributes are slots, so an attribute cannot be added by mistake
+    with pytest.raises(AttributeError):
+        prep.no_such_attribute = 1
+
+
+def test_missing_item_raises_attribute_error():
+    # like an object being unpickled or copied, before __init__ has set the item
+    prep = PreprocessedItem.__new__(PreprocessedItem)
+    with pytest.raises(AttributeError):
+        prep.subject
+    with pytest.raises(AttributeError):
+        prep.importance
+
+
+class StoredAttachment(ews.FileAttachment):
+    """Attachment stored in Exchange, the content is downloaded when it is read. Records the downloads."""
+    __slots__ = ('data',)
+    downloads = []
+
+    def __init__(self, data, **kwargs):
+        super().__init__(attachment_id=AttachmentId(id=kwargs['name']), **kwargs)
+        self.data = data
+
+    @property
+    def content(self):
+        StoredAttachment.downloads.append(('content', self.name))
+        return self.data
+
+    @property
+    def fp(self):
+        StoredAttachment.downloads.append(('fp', self.name))
+        return io.BytesIO(self.data)
+
+
+def _stored_item(*attachments):
+    item = _item()
+    item.attachments = list(attachments)
+    return item
+
+
+def test_ineligible_attachments_are_not_downloaded(config, extracted):
+    StoredAttachment.downloads = []
+    config["MAX_ATTACHMENT_SIZE"] = 1000
+    item = _stored_item(StoredAttachment(b"billede", name="a.png", content_type='image/png', size=10),
+                        StoredAttachment(b"stor", name="b.pdf", content_type='application/pdf', size=1000),
+                        StoredAttachment(b"lille", name="c.pdf", content_type='application/pdf', size=999))
+
+    prep = PreprocessedItem(item, config)
+    assert prep.attachment_texts == [" ", " ", "lille"]
+    assert StoredAttachment.downloads == [('content', 'c.pdf')]
+
+
+def test_large_attachment_is_streamed(config, extracted, tmp_path):
+    StoredAttachment.downloads = []
+    data = b"ord " * 100000
+    config["STREAM_ATTACHMENT_SIZE"] = 1024
+    config["TEXT_CACHE"] = TextCache(str(tmp_path))
+    item = _stored_item(StoredAttachment(data, name="a.pdf", content_type='application/pdf', size=len(data)),
+                        StoredAttachment(b"ukendt", name="b.pdf", content_type='application/pdf'))
+
+    prep = PreprocessedItem(item, config)
+    assert prep.attachment_texts == [data.decode(), "ukendt"]
+    # attachments of unknown size are streamed too, so their size can be checked
+    assert StoredAttachment.downloads == [('fp', 'a.pdf'), ('fp', 'b.pdf')]
+    # the cache key is computed while streaming
+    assert config["TEXT_CACHE"].get(TextCache.key(data)) == data.decode()
+
+
+def test_streamed_attachment_over_size_limit_is_skipped(config, extracted):
+    config["MAX_ATTACHMENT_SIZE"] = 100 * 1024
+    item = _stored_item(StoredAttachment(b"x" * 200 * 1024, name="a.pdf", content_type='application/pdf'))
+
+    prep = PreprocessedItem(item, config)
+    assert prep.attachment_texts == [" "]
+    assert extracted == []
+
+
+class DummyTikaClient:
+    """Returns the content as text, with extra white-space. Records the headers of each request."""
+
+    def __init__(self):
+        self.headers = []
+
+    def from_buffer(self, content, headers=None):
+        self.headers.append(headers)
+        return {'content': "  " + "\n".join(content.decode().split())}
+
+
+def test_texts_are_limited_by_budgets(config, tmp_path):
+    config.update({"TIKA_CLIENT": DummyTikaClient(), "TEXT_CACHE": TextCache(str(tmp_path)), "MAX_BODY_CHARS": 10,
+                   "MAX_ATTACHMENT_CHARS": 12})
+    prep = PreprocessedItem(_item("et to tre fire fem", "seks", body="en lang krop af tekst"), config)
+
+    assert prep.body == "en lang kr"
+    assert prep.attachment_texts == ["et to tre fi", "seks"]
+    # Tika stops writing at twice the limit, as white-space is replaced afterwards
+    assert config["TIKA_CLIENT"].headers == [{'writeLimit': '24'}, {'writeLimit': '24'}]
+    # limited texts are cached apart from the full texts
+    assert config["TEXT_CACHE"].get(TextCache.key(b"et to tre fire fem")) is None
+    assert config["TEXT_CACHE"].get(TextCache.key(b"et to tre fire fem") + ".12") == "et to tre fi"
+
+
+def test_full_attachment_text_turns_off_attachment_limits(config):
+    config.update({"TIKA_CLIENT": DummyTikaClient(), "MAX_BODY_CHARS": 10, "MAX_ATTACHMENT_CHARS": 12,
+                   "MAX_TEXT_CHARS": 20, "FULL_ATTACHMENT_TEXT": True})
+    prep = PreprocessedItem(_item("et to tre fire fem", "seks", body="en lang krop af tekst"), config)
+
+    assert prep.body == "en lang kr"
+    assert prep.attachment_texts == ["et to tre fire fem", "seks"]
+    assert config["TIKA_CLIENT"].headers == [None, None]
@@ -0,0 +1,44 @@
+import pytest
+import datetime
+from mailservice.processed_cache import ProcessedItemCache
+
+t0 = datetime.datetime(2020, 11, 2, 12, 0, 0)
+
+
+def test_tolerance():
+    cache = ProcessedItemCache()
+    cache.add("id0", t0)
+    assert cache.contains("id0", t0 + datetime.timedelta(milliseconds=999))
+    assert cache.contains("id0", t0 - datetime.timedelta(milliseconds=999))
+    assert not cache.contains("id0", t0 + datetime.timedelta(seconds=1))
+    assert not cache.contains("id1", t0)
+    assert cache.hits == 2
+    assert cache.misses == 2
+    assert cache.hit_rate() == 0.5
+
+
+def test_same_id_several_timestamps():
+    cache = ProcessedItemCache()
+    cache.add("id0", t0)
+    cache.add("id0", t0 + datetime.timedelta(hours=1))
+    cache.add("id0", t0 + datetime.timedelta(hours=1))
+    assert len(cache) == 2
+    assert cache.contains("id0", t0)
+    assert cache.contains("id0", t0 + datetime.timedelta(hours=1))
+
+
+@pytest.mark.parametrize("eviction,expected", [
+    ("lru", ["id0", "id2", "id3"]),
+    ("fifo", ["id1", "id2", "id3"]),
+])
+def test_eviction(eviction, expected):
+    cache = ProcessedItemCache(maxlen=3, eviction=eviction)
+    for i in range(3):
+        cache.add(f"id{i}", t0)
+
+    # use id0, so it is the most recently used
+    cache.contains("id0", t0)
+    cache.add("id3", t0)
+
+    assert len(cache) == 3
+    assert [f"id{i}" for i in range(4) if cache.contains(f"id{i}", t0)] == expected
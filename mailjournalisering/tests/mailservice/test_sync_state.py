@@ -0,0 +1,195 @@
+import datetime
+import threading
+import exchangelib as ews
+import pytest
+from mailservice.mailservices import full_item_generator, MailCheckService
+from mailservice.sync_state import SyncStateStore
+
+UTC = ews.EWSTimeZone('UTC')
+
+
+class DummyMonitor:
+    def __init__(self):
+        self.warnings = []
+
+    def warning(self, message):
+        self.warnings.append(message)
+
+    def email_trace(self, item, message):
+        pass
+
+
+class DummyProcessedItems:
+    def __init__(self):
+        self.ids = set()
+
+    def contains_items(self, items):
+        return [item.id in self.ids for item in items]
+
+
+class DummyFolder:
+    """Folder with the sync_items of exchangelib 4.1. changes is a list of (sync state, [(change type, item)]), a sync
+    from a state returns the changes after it. An unknown sync state raises like an invalid one in EWS."""
+
+    name = 'Indbakke'
+    id = 'folder-id'
+
+    def __init__(self, items, changes):
+        self.account = type('Account', (), {'primary_smtp_address': 'post@kommune.dk', 'default_timezone': UTC})()
+        self.items = {item.id: item for item in items}
+        self.changes = changes
+        self.item_sync_state = None
+        self.syncs = []
+        self.full_scans = 0
+
+    def refresh(self):
+        pass
+
+    def all(self):
+        self.full_scans += 1
+        return self
+
+    def only(self, *fields):
+        return list(self.items.values())
+
+    def get(self, id):
+        return self.items[id]
+
+    def sync_items(self, sync_state=None, only_fields=None):
+        self.syncs.append(sync_state)
+        states = [None] + [state for state, _ in self.changes]
+        if sync_state not in states:
+            raise ews.errors.ErrorInvalidSyncStateData("invalid sync state")
+        for state, changes in self.changes[states.index(sync_state):]:
+            yield from changes
+            self.item_sync_state = state
+
+
+def _item(item_id):
+    return ews.Message(id=item_id, subject=f"subject {item_id}",
+                       datetime_received=ews.EWSDateTime(2020, 6, 1, 12, tzinfo=UTC))
+
+
+@pytest.fixture()
+def config(tmp_path):
+    return {"SYNC_STATE_STORE": SyncStateStore(str(tmp_path), full_scan_interval=3600), "MONITOR": DummyMonitor(),
+            "ALLOWED_CONTENT_TYPES": [], "TIME_ZONE": "Europe/Copenhagen", "EMAIL_TIME_ZONE": "UTC"}
+
+
+def _new_item_ids(folder, config):
+    # a poll where all items are distributed, so the sync states are saved
+    item_ids = [full_item.id for _, full_item in full_item_generator([folder], DummyProcessedItems(), config)]
+    config["SYNC_STATE_STORE"].commit()
+    return item_ids
+
+
+def test_sync_only_lists_changed_items(config):
+    a, b, c = _item('a'), _item('b'), _item('c')
+    folder = DummyFolder([a, b, c], [('state1', [('create', a), ('create', b)]),
+                                     ('state2', [('update', b), ('delete', a.id), ('read_flag_change', (b.id, True)),
+                                                 ('create', c)])])
+    store = config["SYNC_STATE_STORE"]
+
+    # the first check is a full scan, then the folder is synced from the stored state
+    assert _new_item_ids(folder, config) == ['a', 'b', 'c']
+    assert folder.full_scans == 1 and folder.syncs == []
+    assert _new_item_ids(folder, config) == ['a', 'b', 'b', 'c']
+    assert folder.syncs == [None]
+    assert store.load(folder) == 'state2'
+
+    # the sync state survives a restart
+    folder.changes.append(('state3', []))
+    config["SYNC_STATE_STORE"] = SyncStateStore(store.path, full_scan_interval=3600)
+    config["SYNC_STATE_STORE"].full_scan_done(folder)
+    assert _new_item_ids(folder, config) == []
+    assert folder.syncs == [None, 'state2']
+    assert config["SYNC_STATE_STORE"].load(folder) == 'state3'
+
+
+def test_full_scan_when_due(config):
+    folder = DummyFolder([_item('a')], [('state1', [])])
+    config["SYNC_STATE_STORE"].full_scan_interval = 0
+
+    _new_item_ids(folder, config)
+    _new_item_ids(folder, config)
+    assert folder.full_scans == 2 and folder.syncs == []
+
+
+def test_invalid_sync_state_falls_back_to_full_scan(config):
+    folder = DummyFolder([_item('a')], [('state1', [])])
+    store = config["SYNC_STATE_STORE"]
+    store.save(folder, 'expired')
+    store.full_scan_done(folder)
+
+    assert _new_item_ids(folder, config) == ['a']
+    assert folder.syncs == ['expired'] and folder.full_scans == 1
+    assert store.load(folder) is None
+    assert len(config["MONITOR"].warnings) == 1
+
+
+def test_state_is_not_saved_if_generator_is_stopped(config):
+    a, b = _item('a'), _item('b')
+    folder = DummyFolder([a, b], [('state1', [('create', a), ('create', b)])])
+    store = config["SYNC_STATE_STORE"]
+    store.full_scan_done(folder)
+
+    items = full_item_generator([folder], DummyProcessedItems(), config)
+    next(items)
+    items.close()
+    assert store.load(folder) is None
+
+
+@pytest.fixture()
+def service(config):
+    # a service without connections to Exchange or the database, the items are distributed by distribute
+    service = MailCheckService.__new__(MailCheckService)
+    service.config = config
+    config["MONITOR"].send_heartbeat = lambda: None
+    service.auditlog = type('AuditLog', (), {'flush': lambda self: None})()
+    service.listener = None
+    service.last_poll = None
+    service.terminated_event = threading.Event()
+    service.pipeline = service.model_handler = service.time_zone = None
+    service.distribute = lambda item_id: True
+
+    def process(full_items, *args):
+        for _, full_item in full_items:
+            if not service.distribute(full_item.id):
+                service.failed_items += 1
+
+    service._process = process
+    return service
+
+
+def test_sync_state_is_saved_when_items_are_distributed(service, config):
+    a, b = _item('a'), _item('b')
+    folder = DummyFolder([a, b], [('state1', [('create', a)]), ('state2', [('create', b)])])
+    service.new_full_items = lambda: full_item_generator([folder], DummyProcessedItems(), config)
+    store = config["SYNC_STATE_STORE"]
+    store.full_scan_done(folder)
+
+    # an item that fails is synced again at the next poll
+    service.distribute = lambda item_id: item_id != 'b'
+    service.poll_once()
+    assert store.load(folder) is None
+
+    service.distribute = lambda item_id: True
+    service.poll_once()
+    assert folder.syncs == [None, None]
+    assert store.load(folder) == 'state2'
+    assert store.pending == {}
+
+
+def test_sync_state_is_not_saved_when_poll_fails(service, config):
+    folder = DummyFolder([_item('a')], [('state1', [('create', _item('a'))])])
+    service.new_full_items = lambda: full_item_generator([folder], DummyProcessedItems(), config)
+    config["SYNC_STATE_STORE"].full_scan_done(folder)
+
+    def distribute(item_id):
+        raise RuntimeError("Exchange is down")
+
+    service.distribute = distribute
+    with pytest.raises(RuntimeError):
+        service.poll_once()
+    assert config["SYNC_STATE_STORE"].load(folder) is None
+    assert config["SYNC_STATE_STORE"].pending == {}